@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""Transfer files with rsync driven from a single asyncio event loop.
+
+`RSyncTransfer` dedicates a pool worker (thread or process) to babysitting
+each rsync child, so hundreds of concurrent streams cost hundreds of Python
+threads or processes. `AsyncRSyncTransfer` instead runs every rsync child on
+one event loop in one background thread: output is read without blocking,
+and a semaphore bounds the number of concurrent transfers.
+
+Requires Python 3.
+"""
+
+import asyncio
+import logging
+import os
+import shlex
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .bandwidth import BandwidthGovernor, WAIT_INTERVAL
+from .rsync import (
+    PARTIAL_DIR,
+    _ignore_sigint,
+    _LineSplitter,
+    _rsync_command,
+    _StatusUpdater,
+    _with_manifest
+)
+from .transfer import (
+    Transfer,
+    TransferCancelledError,
+    TransferFailedError
+)
+from .utils import Success, Failure
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _use_pidfd_watcher(loop):
+    """Before Python 3.12, asyncio waits for each child on a dedicated thread
+    by default. Where pidfds are available, watch children from `loop`
+    instead so concurrent transfers do not cost a thread each."""
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open') or \
+            not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(loop)
+    asyncio.set_child_watcher(watcher)
+
+
+class AsyncResult(object):
+    """Result of a transfer submitted to `AsyncRSyncTransfer`. Mirrors the
+    interface of `multiprocessing.pool.AsyncResult`.
+    """
+
+    def __init__(self, future):
+        self._future = future
+
+    def ready(self):
+        """Whether the transfer has completed"""
+        return self._future.done()
+
+    def successful(self):
+        """Whether the transfer completed without raising. Raises ValueError
+        if the transfer is not ready."""
+        if not self.ready():
+            raise ValueError("{!r} not ready".format(self))
+        return self._future.exception() is None
+
+    def wait(self, timeout=None):
+        """Wait until the transfer has completed or `timeout` seconds pass"""
+        try:
+            self._future.exception(timeout)
+        except Exception:
+            pass
+
+    def get(self, timeout=None):
+        """The result of the transfer, a `Success` or `Failure`, once it is
+        available"""
+        return self._future.result(timeout)
+
+
+class AsyncRSyncTransfer(Transfer):
+    """Transfer files by running rsync children on an asyncio event loop
+
+    Attributes
+    ----------
+    host: str
+        Remote SSH host name
+    user: str
+        SSH user name
+    keypath: str
+        Path to private key
+    port: int, optional
+        Port to connect on. Default is 22.
+    partial: str or bool, optional
+        Hidden directory, relative to each destination directory, to keep
+        partially transferred files in (`--partial-dir`), True to keep them
+        in place (`--partial`) or False. Default is PARTIAL_DIR.
+    compress: bool, optional
+        Enable compression of data prior to transfer (default is False). This
+        flag is passed to rsync as `-z`.
+    retry: int, optional
+        Number of SSH connect retries. Passed as retry + 1 ConnectionAttempts
+        option to SSH.
+    concurrency: int, optional
+        Maximum number of concurrent rsync processes. Default is 16.
+    bandwidth: asynchy.bandwidth.Schedule, optional
+        Schedule of the total rate to share between all transfers. Default
+        is None, i.e. unlimited.
+    checksum: bool, optional
+        Record the checksum the sender computed of each file in the manifest
+        (default is False). Requires rsync 3.2 on both ends.
+    """
+
+    def __init__(self, host, user, keypath, port=22, partial=PARTIAL_DIR,
+                 compress=False, retry=0, concurrency=16, bandwidth=None,
+                 checksum=False):
+        self.host = host
+        self.user = user
+        self.keypath = keypath
+        self.port = port
+        self.partial = partial
+        self.compress = compress
+        self.retry = retry
+        self.concurrency = concurrency
+        self.checksum = checksum
+        self.governor = None
+        if bandwidth is not None:
+            self.governor = BandwidthGovernor(bandwidth, concurrency)
+        self._progress = queue.Queue()
+
+        self._loop = asyncio.new_event_loop()
+        _use_pidfd_watcher(self._loop)
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name="asynchy-event-loop")
+        self._thread.daemon = True
+        self._thread.start()
+        # asyncio primitives must be created on the loop they are used from
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._cancelled = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._active = 0
+
+    def _command(self, src, dest, bwlimit=None):
+        return shlex.split(_rsync_command(
+            src, dest, host=self.host, port=self.port, user=self.user,
+            keypath=self.keypath, partial=self.partial,
+            compress=self.compress, retry=self.retry, bwlimit=bwlimit,
+            checksum=self.checksum
+        ))
+
+    async def _acquire_bandwidth(self):
+        """Wait for a share of the bandwidth budget without blocking the
+        loop. Returns (acquired, share) like `BandwidthGovernor.acquire`."""
+        while not self._cancelled.is_set():
+            acquired, share = self.governor.try_acquire()
+            if acquired:
+                return True, share
+            try:
+                await asyncio.wait_for(self._cancelled.wait(), WAIT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return False, None
+
+    async def _transfer(self, src, dest):
+        async with self._semaphore:
+            if self._cancelled.is_set():
+                return Failure(TransferCancelledError(
+                    "Transfer cancel signal received"
+                ))
+
+            self._active += 1
+            self._idle.clear()
+            share = None
+            try:
+                if self.governor is not None:
+                    acquired, share = await self._acquire_bandwidth()
+                    if not acquired:
+                        return Failure(TransferCancelledError(
+                            "Transfer cancel signal received"
+                        ))
+                try:
+                    return await self._rsync(src, dest, share)
+                finally:
+                    if self.governor is not None:
+                        self.governor.release(share)
+            except (IOError, OSError) as err:
+                return Failure(TransferFailedError(
+                    "Rsync transfer for \"{}\" failed to start: {}"
+                    .format(src, err)
+                ))
+            finally:
+                self._active -= 1
+                if not self._active:
+                    self._idle.set()
+
+    async def _rsync(self, src, dest, bwlimit=None):
+        status = _StatusUpdater(self._progress, prefix=os.path.basename(
+            os.path.normpath(src)).encode("utf-8") + b'/',
+            checksum=self.checksum)
+        proc = await asyncio.create_subprocess_exec(
+            *self._command(src, dest, bwlimit),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_ignore_sigint
+        )
+
+        async def read_stdout():
+            splitter = _LineSplitter()
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                for line in splitter.feed(chunk):
+                    status(line)
+            for line in splitter.close():
+                status(line)
+
+        reading = asyncio.ensure_future(asyncio.gather(
+            read_stdout(), proc.stderr.read()
+        ))
+        exited = asyncio.ensure_future(proc.wait())
+        cancelled = asyncio.ensure_future(self._cancelled.wait())
+        await asyncio.wait([exited, cancelled],
+                           return_when=asyncio.FIRST_COMPLETED)
+
+        if not exited.done():
+            proc.terminate()
+            await exited
+            reading.cancel()
+            return _with_manifest(Failure(TransferCancelledError(
+                "Transfer cancel signal received"
+            )), src, dest, status)
+
+        cancelled.cancel()
+        _, err = await reading
+        if proc.returncode != 0:
+            return _with_manifest(Failure(TransferFailedError(
+                "Rsync transfer for \"{}\" "
+                "failed with the following code: {}\n"
+                "Error: {}"
+                "See Rsync 'man' page for an explanation.\n"
+                .format(src, proc.returncode, err.decode("utf-8")),
+                proc.returncode
+            )), src, dest, status)
+
+        return _with_manifest(Success(None), src, dest, status)
+
+    def _submit(self, coro, callback):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+        def done(fut):
+            exc = fut.exception()
+            callback(fut.result() if exc is None else Failure(exc))
+
+        future.add_done_callback(done)
+        return AsyncResult(future)
+
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
+        return self._submit(self._transfer(src, dest), callback)
+
+    def transfer_batch(self, srcs, dest, callback):
+        async def batch():
+            return await asyncio.gather(
+                *[self._transfer(src, dest) for src in srcs]
+            )
+
+        return self._submit(batch(), callback)
+
+    def progress(self):
+        return self._progress
+
+    def cancel(self):
+        async def cancel():
+            self._cancelled.set()
+            # wait for running transfers to terminate their children
+            await self._idle.wait()
+
+        asyncio.run_coroutine_threadsafe(cancel(), self._loop).result()
+
+        return True
@@ -5,14 +5,42 @@
 import logging
 import os
 import signal
+import socket
 import sqlite3
 import sys
-
-from tqdm import tqdm
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import scheduling
+from .db import (
+    DB_TIMEOUT,
+    ResultWriter,
+    ensure_schema,
+    optimize,
+    read_manifest
+)
+from .retry import MAX_ERROR_LENGTH, RetryPolicy, RetryQueue
+from .transfer import TransferCancelledError
+from .utils import Success
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Tags for the events posted to the main loop's event queue
+_PROGRESS = 0
+_COMPLETE = 1
+
+# How long the progress pump blocks before checking whether it should exit
+PROGRESS_INTERVAL = 0.5
+
+# Seconds an EPN stays claimed by a node unless it renews the claim
+LEASE = 300
+
 
 def _interrupt_handler(sig, frame, cancel):
     print("Cancellation signal recieved... gives us a moment to "
@@ -31,19 +59,12 @@ def _get_dest_path(base, epn_path):
     return os.path.join(base, os.path.basename(os.path.normpath(epn_path)))
 
 
-def _success_handler_map(db_conn, src_prefix):
+def _success_handler_map(writer, src_prefix):
     """Callback to handle successful transfers."""
     def handler(results):
         def update_db(res):
-            epn = res.src[len(src_prefix)+1:]
-            db_conn.execute(
-                '''UPDATE epns
-                   SET complete = 1, bytesTransferred = ?
-                   WHERE epn = ?
-                ''',
-                (res.bytes_transferred, epn)
-            )
-            db_conn.commit()
+            writer.complete(res.src[len(src_prefix)+1:],
+                            res.bytes_transferred)
 
         def log_err(exc):
             LOGGER.debug(exc)
@@ -55,22 +76,13 @@ def _success_handler_map(db_conn, src_prefix):
     return handler
 
 
-def _transfer_result_callback(db, src_prefix):
+def _transfer_result_callback(writer, src_prefix):
     """Callback to handle successful transfers."""
     def handler(result):
         def update_db(res):
-            db_conn = sqlite3.connect(db)
             epn = res.src[len(src_prefix)+1:]
-            with db_conn:
-                db_conn.execute(
-                    '''UPDATE epns
-                       SET complete = 1, bytesTransferred = ?
-                       WHERE epn = ?
-                    ''',
-                    (res.bytes_transferred, epn)
-                )
-
-            db_conn.close()
+            writer.complete(epn, res.bytes_transferred)
+            writer.manifest(epn, res.files)
 
         def log_err(exc):
             LOGGER.error(exc)
@@ -81,60 +93,522 @@ def _transfer_result_callback(db, src_prefix):
     return handler
 
 
+def _completion_callback(events, callback, item):
+    """Wrap a transfer callback so that every completed transfer is also
+    posted, along with the `item` it transferred, onto the main loop's event
+    queue."""
+    def handler(result):
+        try:
+            callback(result)
+        finally:
+            events.put((_COMPLETE, (item, result)))
+
+    return handler
+
+
+def _pump_progress(progress, events, finished, interval=PROGRESS_INTERVAL):
+    """Forward byte deltas from a transfer's progress queue onto the main
+    loop's event queue.
+
+    Blocks on the progress queue rather than polling it and returns once
+    `finished` is set and the progress queue has been drained, or the queue
+    goes away (e.g. the transfer was cancelled and its manager shut down).
+    """
+    while True:
+        try:
+            delta = progress.get(timeout=interval)
+        except queue.Empty:
+            if finished.is_set():
+                return
+            continue
+        except (EOFError, IOError, OSError) as err:
+            LOGGER.debug("Progress queue closed: %s", err)
+            return
+
+        events.put((_PROGRESS, delta))
+
+
 def get_size(epns):
     """Gets the estimated total size of all epns passed in"""
     return sum(s for _, s in epns)
 
 
-def get_epns(db, order="ASC", limit=None):
-    """Intelligently get a list of EPN paths and the expected size of
-    the transfer"""
-    db_conn = sqlite3.connect(db)
-
-    if limit is None:
-        result = db_conn.execute(
-            '''
-            SELECT epn, size
-            FROM epns
-            WHERE complete = 0
-            ORDER BY modified {}
-            '''.format(order)
-        )
-    else:
-        result = db_conn.execute(
-            '''
-            SELECT epn, size
+def _iter_rows(cursor, batch_size):
+    """Lazily yield rows from `cursor`, fetching `batch_size` at a time, and
+    close its connection once exhausted or abandoned"""
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+    finally:
+        cursor.connection.close()
+
+
+def _pending_query(order, limit, policy, now, sort=True):
+    """Query for pending EPNs that are not backing off after a failure nor
+    claimed by a node. EPNs interrupted part way come first, so rsync
+    resumes them from their partial files, then the rest in the order of the
+    scheduling `policy`. They are left unsorted if not `sort`."""
+    order_by, params = scheduling.order_by(policy, order, now=now)
+    order_by = order_by.replace("ORDER BY", "ORDER BY started IS NULL,", 1)
+    if not sort:
+        order_by, params = "", ()
+    query = '''
+            SELECT epn, size, file_count, COALESCE(attempts, 0)
             FROM epns
             WHERE complete = 0
-            ORDER BY modified {}
-            LIMIT ?
-            '''.format(order),
-            (limit,)
+              AND (next_attempt IS NULL OR next_attempt <= ?)
+              AND (claimed_by IS NULL OR lease_expires <= ?)
+            {}
+            '''.format(order_by)
+    params = (now, now) + tuple(params)
+    if limit is not None:
+        query += "LIMIT ?"
+        params += (limit,)
+
+    return query, params
+
+
+def _pending_totals(conn, order, limit, policy, now):
+    """Expected total size and number of the EPNs `_pending_query` selects,
+    only sorting them if the `limit` picks the first of them"""
+    query, params = _pending_query(order, limit, policy, now,
+                                   sort=limit is not None)
+    return conn.execute(
+        "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM ({})".format(query),
+        params
+    ).fetchone()
+
+
+def get_epns(db, order="ASC", limit=None, batch_size=256,
+             policy=scheduling.MODIFIED):
+    """Intelligently get EPN paths and the expected size of the transfer.
+
+    EPNs are read lazily from a cursor, so memory use does not depend on the
+    number of pending EPNs. EPNs backing off after a failed attempt, or
+    claimed by a node (see `claim_epns`), are left out.
+
+    Parameters
+    ----------
+    db: str
+        Path to the EPN database.
+    order: str, optional
+        Order ("ASC" or "DESC") in which to transfer EPNs by date. Only used
+        by the `modified` scheduling policy.
+    limit: int, optional
+        Maximum number of EPNs to return. All pending EPNs if None.
+    batch_size: int, optional
+        Number of rows to fetch from the database at a time.
+    policy: str, optional
+        Scheduling policy deciding the order of EPNs. See
+        `asynchy.scheduling.POLICIES`.
+
+    Returns
+    -------
+    epns: iterator of (str, int, int, int)
+        Iterator over (epn, size, file_count, attempts) of pending EPNs. The
+        file count is None if it is not known.
+    size: int
+        Expected total size of the EPNs.
+    """
+    now = time.time()
+    query, params = _pending_query(order, limit, policy, now)
+
+    db_conn = sqlite3.connect(db, timeout=DB_TIMEOUT)
+    ensure_schema(db_conn)
+    optimize(db_conn)
+    size, _ = _pending_totals(db_conn, order, limit, policy, now)
+    epns = _iter_rows(db_conn.execute(query, params), batch_size)
+
+    return epns, size
+
+
+def claim_epns(conn, worker, n, lease=LEASE, order="ASC",
+               policy=scheduling.MODIFIED):
+    """Claim up to `n` pending EPNs for `worker`
+
+    Claimed EPNs are left out by other workers until the claim's lease
+    expires, `lease` seconds from now unless the worker renews it (see
+    `asynchy.db.ResultWriter.renew`). The EPNs are selected and claimed in
+    one write transaction, so several processes, on one or more hosts,
+    sharing a database never claim the same EPN.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the EPN database, not in a transaction.
+    worker: str
+        Name of the claiming worker, unique among those sharing the database.
+    n: int
+        Maximum number of EPNs to claim.
+    lease: float, optional
+        Seconds the claim lasts.
+    order: str, optional
+        See `get_epns`.
+    policy: str, optional
+        See `get_epns`.
+
+    Returns
+    -------
+    list of (str, int, int, int)
+        The claimed (epn, size, file_count, attempts), in scheduling order.
+    """
+    now = time.time()
+    query, params = _pending_query(order, n, policy, now)
+    # take the write lock before reading, so no one claims the rows between
+    # our read and our update
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(query, params).fetchall()
+        conn.executemany(
+            '''UPDATE epns SET claimed_by = ?, lease_expires = ?
+               WHERE epn = ?''',
+            [(worker, now + lease, row[0]) for row in rows]
         )
-    epns = result.fetchall()
-
-    db_conn.close()
-
-    return epns, get_size(epns)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return rows
+
+
+def _worker_name():
+    """Name of this process among the nodes sharing a database"""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class _Pending(object):
+    """Pending EPNs, claimed from the database a batch at a time
+
+    When following the database (`poll_interval` is not None), it is checked
+    for new pending EPNs every `poll_interval` seconds once none are left to
+    claim.
+
+    Attributes
+    ----------
+    size: int
+        Expected total size of the EPNs pending at the start.
+    count: int
+        Number of EPNs pending at the start.
+    """
+
+    def __init__(self, db, worker, batch, order, limit, policy,
+                 poll_interval=None, lease=LEASE):
+        self.worker = worker
+        self.batch = max(1, batch)
+        self.order = order
+        self.limit = self.remaining = limit
+        self.policy = policy
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._next_poll = None
+        self._rows = []
+
+        conn = sqlite3.connect(db, timeout=DB_TIMEOUT)
+        try:
+            ensure_schema(conn)
+            optimize(conn)
+            self.size, self.count = _pending_totals(conn, order, limit,
+                                                    policy, time.time())
+        finally:
+            conn.close()
+        self._conn = sqlite3.connect(db, timeout=DB_TIMEOUT,
+                                     isolation_level=None)
+
+    def next(self, exclude=()):
+        """The next pending (epn, size, file_count, attempts) whose EPN is
+        not in `exclude`, None if there is none until the next poll"""
+        while True:
+            while self._rows:
+                row = self._rows.pop(0)
+                if row[0] not in exclude:
+                    return row
+            if self._next_poll is not None:
+                return None
+            if self.remaining == 0:
+                if self.poll_interval is not None:
+                    self._next_poll = time.time() + self.poll_interval
+                return None
+
+            n = self.batch if self.remaining is None \
+                else min(self.batch, self.remaining)
+            self._rows = claim_epns(self._conn, self.worker, n, self.lease,
+                                    self.order, self.policy)
+            if not self._rows:
+                self.remaining = 0
+            elif self.remaining is not None:
+                self.remaining -= len(self._rows)
+
+    def time_to_poll(self):
+        """Seconds until the database should be checked for new EPNs, None
+        if there are EPNs left to claim or we do not follow it"""
+        if self._next_poll is None:
+            return None
+        return max(0.0, self._next_poll - time.time())
+
+    def poll(self):
+        """Check the database for up to `limit` new EPNs on the next
+        claim"""
+        self._next_poll = None
+        self.remaining = self.limit
+
+    def manifest(self, epn):
+        """Files of `epn` that arrived so far, see
+        `asynchy.db.read_manifest`"""
+        return read_manifest(self._conn, epn)
+
+    def close(self):
+        self._conn.close()
+
+
+class _Report(object):
+    """Log the state of a run every `interval` seconds (never if None)"""
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self._last = time.time()
+        self._transferred = 0
+
+    def time_to_report(self):
+        if self.interval is None:
+            return None
+        return max(0.0, self._last + self.interval - time.time())
+
+    def __call__(self, in_flight, retrying, succeeded, failed, transferred):
+        if self.time_to_report() != 0:
+            return
+        now = time.time()
+        rate = (transferred - self._transferred) / max(now - self._last, 1e-6)
+        LOGGER.info("%d transfers in flight, %d waiting to be retried, %d "
+                    "succeeded, %d failed, %.1f MiB/s since the last report",
+                    in_flight, retrying, succeeded, failed,
+                    rate / 1024 ** 2)
+        self._last = now
+        self._transferred = transferred
 
 
 def main(transfer, db, dest_path, src_prefix=None, order="ASC",
-         limit=None):
-    """"""
-    signal.signal(signal.SIGINT,
-                  lambda x, y: _interrupt_handler(x, y, transfer.cancel))
+         limit=None, window=8, policy=scheduling.MODIFIED, controller=None,
+         retry_policy=None, poll_interval=None, report_interval=None,
+         worker=None, lease=LEASE, wal=True):
+    """Transfer pending EPNs from the database and record their completion.
+
+    At most `window` transfers are in flight at any time; new EPNs are read
+    from the database and submitted as earlier transfers complete. If a
+    `controller` (see `asynchy.control.AIMDController`) is given, it is fed
+    the progress stream and sets the window instead.
+
+    Failed attempts are recorded in the database and, as `retry_policy` (see
+    `asynchy.retry.RetryPolicy`) decides, retried later in the run ahead of
+    new EPNs, left for a later run or given up on. By default failures are
+    not retried within the run.
+
+    If `poll_interval` is given, main runs as a daemon: once the pending EPNs
+    run out it checks the database for new ones every `poll_interval`
+    seconds instead of returning. On SIGTERM it starts no more transfers and
+    returns once those in flight have finished (a second SIGTERM or SIGINT
+    cancels them). Every `report_interval` seconds the state of the run is
+    logged.
+
+    EPNs are claimed from the database a window at a time (see
+    `claim_epns`), as `worker` (default host:pid), so several processes on
+    one or more hosts can share the database without transferring an EPN
+    twice. Claims are renewed while their EPNs are in flight and released
+    when the run ends, when the `transfer` is closed too (see
+    `Transfer.close`). Nodes on different hosts cannot share SQLite's
+    write-ahead log, so they must set `wal` to False.
+
+    Returns
+    -------
+    (int, int)
+        Number of transfers that succeeded and failed.
+    """
+    # tqdm is slow to import, only pay for it when we sync
+    from tqdm import tqdm
+
+    cancelled = threading.Event()
+    # set once no more transfers should start: cancelled or draining
+    stopping = threading.Event()
+    events = queue.Queue()
+
+    def cancel():
+        cancelled.set()
+        stopping.set()
+        return transfer.cancel()
+
+    def drain(sig, frame):
+        LOGGER.info("Signal %d received, finishing the transfers in flight. "
+                    "Send it again to cancel them.", sig)
+        stopping.set()
+        signal.signal(sig, lambda x, y: _interrupt_handler(x, y, cancel))
+        events.put((None, None))
 
-    epns, expected_size = get_epns(db, order, limit)
-    srcs = map(lambda epn: os.path.join(src_prefix, epn[0]), epns)
+    signal.signal(signal.SIGINT,
+                  lambda x, y: _interrupt_handler(x, y, cancel))
+    if poll_interval is not None:
+        signal.signal(signal.SIGTERM, drain)
+
+    if worker is None:
+        worker = _worker_name()
+    if controller is not None:
+        window = controller.limit
+    # before any other connection, see ResultWriter
+    writer = ResultWriter(db, wal=wal)
+    pending = _Pending(db, worker, window, order, limit, policy,
+                       poll_interval, lease)
+    LOGGER.info("%d EPNs (%d bytes) pending", pending.count, pending.size)
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    retries = RetryQueue()
+    # EPNs in flight or waiting to be retried, which a poll of the database
+    # still finds pending
+    active = set()
     progress = transfer.progress()
 
-    with tqdm(total=expected_size) as pbar:
-        results = [transfer.transfer(src, dest_path,
-                                     _transfer_result_callback(db, src_prefix))
-                   for src in srcs]
-
-        while not all(r.ready() for r in results):
-            if not progress.empty():
-                pbar.update(progress.get())
-
-    return results
+    finished = threading.Event()
+    pump = threading.Thread(target=_pump_progress,
+                            args=(progress, events, finished))
+    pump.daemon = True
+    pump.start()
+
+    writer.start()
+    # renew our claims well before they expire
+    next_renewal = time.time() + lease / 3.0
+
+    succeeded = failed = transferred = 0
+    try:
+        # a daemon reports its state to the log instead
+        with tqdm(total=pending.size,
+                  disable=poll_interval is not None) as pbar:
+            on_result = _transfer_result_callback(writer, src_prefix)
+
+            def submit(n):
+                """Submit up to n more transfers, due retries first,
+                returning how many were"""
+                submitted = 0
+                while submitted < n:
+                    item = retries.pop_ready()
+                    if item is None:
+                        item = pending.next(active)
+                    if item is None:
+                        break
+                    epn, size, file_count, attempts = item
+                    arrived = None
+                    if attempts:
+                        # resume from the manifest of earlier attempts
+                        writer.flush()
+                        arrived = pending.manifest(epn) or None
+                    active.add(epn)
+                    writer.started(epn)
+                    transfer.transfer(
+                        os.path.join(src_prefix, epn), dest_path,
+                        _completion_callback(events, on_result, item),
+                        size=size, file_count=file_count, arrived=arrived
+                    )
+                    submitted += 1
+                return submitted
+
+            def retry(item, exc):
+                """Record a failed attempt of `item`, returning whether it
+                is retried within this run"""
+                epn, size, file_count, attempts = item
+                writer.manifest(epn, getattr(exc, "files", None))
+                if isinstance(exc, TransferCancelledError):
+                    return False
+
+                attempts += 1
+                kind, delay, again = retry_policy.decide(exc, attempts)
+                now = time.time()
+                writer.failed(epn, attempts, str(exc)[:MAX_ERROR_LENGTH],
+                              None if delay is None else now + delay,
+                              permanent=delay is None)
+
+                if delay is None:
+                    LOGGER.error("Giving up on %s after a %s failure "
+                                 "(attempt %d)", epn, kind, attempts)
+                if delay is None or not again or stopping.is_set():
+                    writer.release(worker, epn)
+                    return False
+
+                LOGGER.warning("Retrying %s in %.0fs after a %s failure "
+                               "(attempt %d of %d)", epn, delay, kind,
+                               attempts, retry_policy.max_attempts)
+                retries.push(now + delay, (epn, size, file_count, attempts))
+                # its bytes are transferred (and counted) again
+                pbar.total += size or 0
+                return True
+
+            report = _Report(report_interval)
+
+            # Block on completions and progress deltas rather than polling
+            # every AsyncResult; each finished transfer costs O(1) and frees
+            # a slot for the next EPN.
+            in_flight = submit(window)
+            while in_flight or not stopping.is_set() and (
+                    retries or poll_interval is not None):
+                timeouts = [t for t in (
+                    retries.time_to_next(),
+                    pending.time_to_poll(),
+                    report.time_to_report(),
+                    max(0.0, next_renewal - time.time()),
+                    None if controller is None
+                    else controller.time_to_update()
+                ) if t is not None]
+                try:
+                    kind, value = events.get(
+                        timeout=min(timeouts) if timeouts else None
+                    )
+                except queue.Empty:
+                    kind = None
+
+                if kind == _PROGRESS:
+                    pbar.update(value)
+                    transferred += value
+                    if controller is not None:
+                        controller.observe(value)
+                elif kind == _COMPLETE:
+                    in_flight -= 1
+                    item, result = value
+                    if isinstance(result, Success):
+                        succeeded += 1
+                        active.discard(item[0])
+                    elif not retry(item, result.failure):
+                        failed += 1
+                        active.discard(item[0])
+
+                if controller is not None:
+                    window = controller.update()
+                if time.time() >= next_renewal:
+                    writer.renew(worker, time.time() + lease)
+                    next_renewal = time.time() + lease / 3.0
+                if not stopping.is_set():
+                    if pending.time_to_poll() == 0:
+                        # see the completions committed so far, so finished
+                        # EPNs are not read as pending again
+                        writer.flush()
+                        pending.poll()
+                    # a shrunk window drains as running transfers complete
+                    if in_flight < window:
+                        in_flight += submit(window - in_flight)
+                report(in_flight, len(retries), succeeded, failed,
+                       transferred)
+
+            finished.set()
+            pump.join()
+            while not events.empty():
+                kind, value = events.get_nowait()
+                if kind == _PROGRESS:
+                    pbar.update(value)
+    finally:
+        pending.close()
+        transfer.close()
+        # let other nodes have what we claimed but did not finish
+        writer.release(worker)
+        # Flush outstanding completions, even if we are cancelled or exiting
+        writer.close()
+
+    return succeeded, failed
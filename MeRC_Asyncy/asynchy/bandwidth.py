@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Share a global bandwidth budget between concurrent transfers.
+
+The budget follows a weekly `Schedule` of rate windows, e.g. a cap during
+business hours and no cap overnight. A `BandwidthGovernor` hands each
+transfer its share of the budget as it starts, which is passed to rsync as
+``--bwlimit``, and takes it back when the transfer finishes.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# How long a transfer waits before checking again for headroom
+WAIT_INTERVAL = 1.0
+
+# Indices of the governor's counters
+ALLOCATED = 0
+ACTIVE = 1
+UNCAPPED = 2
+
+# Number of the governor's counters
+COUNTERS = 3
+
+
+class InvalidScheduleError(Exception):
+    """Raised when a bandwidth schedule cannot be parsed"""
+    pass
+
+
+def _parse_days(days):
+    """Weekday numbers (Monday is 0) from e.g. "mon-fri", "sat,sun" or "*"
+    """
+    if days in (None, "*"):
+        return frozenset(range(7))
+
+    parsed = set()
+    for part in str(days).lower().split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            first = DAYS.index(first[:3])
+            last = first if not last else DAYS.index(last.strip()[:3])
+        except ValueError:
+            raise InvalidScheduleError("Invalid days: {}".format(days))
+        parsed.update(range(first, last + 1) if first <= last else
+                      list(range(first, 7)) + list(range(0, last + 1)))
+
+    return frozenset(parsed)
+
+
+def _parse_time(value):
+    """Minutes since midnight from "HH:MM". YAML reads an unquoted 08:00 as
+    the base 60 integer 480, i.e. already in minutes."""
+    if isinstance(value, int):
+        minutes = value
+    else:
+        try:
+            hours, mins = str(value).split(":")
+            minutes = int(hours) * 60 + int(mins)
+        except ValueError:
+            raise InvalidScheduleError("Invalid time: {}".format(value))
+
+    if not 0 <= minutes <= 24 * 60:
+        raise InvalidScheduleError("Invalid time: {}".format(value))
+
+    return minutes
+
+
+class Window(object):
+    """A weekly rate window
+
+    Attributes
+    ----------
+    days: frozenset
+        Weekdays the window applies on (Monday is 0).
+    start: int
+        Start of the window in minutes since midnight.
+    end: int
+        End (exclusive) of the window in minutes since midnight.
+    rate: int or None
+        Total rate in KiB/s allowed during the window, None for unlimited.
+    """
+
+    def __init__(self, days, start, end, rate):
+        if start >= end:
+            raise InvalidScheduleError(
+                "Window must start before it ends, split windows that span "
+                "midnight in two"
+            )
+        self.days = days
+        self.start = start
+        self.end = end
+        self.rate = rate
+
+    def contains(self, when):
+        minutes = when.hour * 60 + when.minute
+        return when.weekday() in self.days and \
+            self.start <= minutes < self.end
+
+
+class Schedule(object):
+    """Weekly schedule of total transfer rates
+
+    The first window containing a time sets the rate, otherwise `default`
+    applies.
+
+    Attributes
+    ----------
+    windows: list of Window
+        Rate windows, in order of precedence.
+    default: int or None, optional
+        Rate in KiB/s outside any window. Default is None, i.e. unlimited.
+    """
+
+    def __init__(self, windows=(), default=None):
+        self.windows = list(windows)
+        self.default = default
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build a schedule from the ``bandwidth`` section of the config::
+
+            bandwidth:
+              default: null          # KiB/s outside any window, null = no cap
+              windows:
+                - days: mon-fri
+                  start: "08:00"
+                  end: "18:00"
+                  rate: 51200        # KiB/s shared by all transfers
+        """
+        if cfg is None:
+            return cls()
+
+        windows = [
+            Window(_parse_days(w.get("days")), _parse_time(w["start"]),
+                   _parse_time(w["end"]), w.get("rate"))
+            for w in cfg.get("windows", [])
+        ]
+        return cls(windows, cfg.get("default"))
+
+    def rate(self, when=None):
+        """Total rate in KiB/s at `when` (default now), None for unlimited"""
+        when = datetime.datetime.now() if when is None else when
+        for window in self.windows:
+            if window.contains(when):
+                return window.rate
+        return self.default
+
+
+class BandwidthGovernor(object):
+    """Split the scheduled budget among active transfers
+
+    A starting transfer gets the unallocated budget divided by the free
+    transfer slots, so the allocations never add up to more than the budget.
+    Budget freed by a finishing transfer goes to the next ones to start. If
+    the budget has dropped (e.g. business hours began) so that a starting
+    transfer's share would be less than its fair share, budget / slots, it
+    waits for running transfers to finish.
+
+    rsync cannot change the rate of a running transfer, so shares are only
+    rebalanced as transfers start and finish. Transfers started while the
+    rate was unlimited keep running uncapped when a capped window begins,
+    so no transfer starts until they have finished.
+
+    Attributes
+    ----------
+    schedule: Schedule
+        Weekly schedule of the total rate.
+    slots: int
+        Maximum number of concurrent transfers.
+    lock: Lock, optional
+        Lock guarding `counters`. Default is a `threading.Lock`.
+    counters: sequence, optional
+        Mutable sequence of the `COUNTERS` counters: the allocated rate, the
+        number of active transfers and how many of them are uncapped. Pass
+        a `multiprocessing.RawArray` and a
+        `multiprocessing.Lock` to share the governor with worker processes
+        that inherit it, e.g. through a pool initializer.
+    """
+
+    def __init__(self, schedule, slots, lock=None, counters=None):
+        self.schedule = schedule
+        self.slots = slots
+        self._lock = threading.Lock() if lock is None else lock
+        self._counters = [0] * COUNTERS if counters is None else counters
+        for counter in range(COUNTERS):
+            self._counters[counter] = 0
+
+    def try_acquire(self):
+        """Allocate a share of the budget without waiting
+
+        Returns
+        -------
+        (bool, int or None)
+            Whether a share was allocated and the share in KiB/s, None if
+            unlimited.
+        """
+        budget = self.schedule.rate()
+        with self._lock:
+            allocated = self._counters[ALLOCATED]
+            active = self._counters[ACTIVE]
+            share = None
+            if budget is None:
+                self._counters[UNCAPPED] += 1
+            elif self._counters[UNCAPPED]:
+                # the uncapped transfers may use the whole budget already
+                return False, None
+            else:
+                free = max(1, self.slots - active)
+                share = (budget - allocated) // free
+                if share < max(1, budget // self.slots):
+                    return False, None
+                allocated += share
+
+            self._counters[ALLOCATED] = allocated
+            self._counters[ACTIVE] = active + 1
+
+        LOGGER.debug("Allocated %s KiB/s of %s KiB/s to a transfer, %d "
+                     "active", share, budget, active + 1)
+        return True, share
+
+    def acquire(self, stop=None, interval=WAIT_INTERVAL):
+        """Allocate a share of the budget, waiting for headroom
+
+        Returns
+        -------
+        (bool, int or None)
+            False if `stop` was set while waiting, and the share in KiB/s.
+        """
+        while True:
+            acquired, share = self.try_acquire()
+            if acquired:
+                return True, share
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval):
+                return False, None
+
+    def release(self, share):
+        """Return a share of the budget when its transfer finishes"""
+        with self._lock:
+            if share is None:
+                self._counters[UNCAPPED] -= 1
+            else:
+                self._counters[ALLOCATED] -= share
+            self._counters[ACTIVE] -= 1
@@ -1 +1,6 @@
 # -*- coding: utf-8 -*-
+
+from .base import cli, _read_config, InvalidConfigError
+
+# the command group and config reader, as the tests import them
+__all__ = ["cli", "_read_config", "InvalidConfigError"]
@@ -6,7 +6,11 @@ import sys
 import yaml
 
 from .init import init
+from .merge import merge_db
+from .serve import serve
 from .sync import sync
+from .verify import verify
+from .walk import walk
 
 class InvalidConfigError(Exception):
     """Raised when the config is invalid"""
@@ -52,7 +56,7 @@ def _read_config(path):
         If the config is invalid
     """
     with open(path, "r") as rdr:
-        cfg = yaml.load(rdr)
+        cfg = yaml.safe_load(rdr)
         if not validate_config(cfg):
             raise InvalidConfigError(
                 "Config is not valid. It must contain 'host', 'port' "
@@ -89,6 +93,10 @@ def cli(ctx, config):
 
 cli.add_command(init)
 cli.add_command(sync)
+cli.add_command(serve)
+cli.add_command(verify)
+cli.add_command(walk)
+cli.add_command(merge_db)
 
 
 if __name__ == "__main__":
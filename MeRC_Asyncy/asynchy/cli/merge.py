@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Console script merging EPN databases."""
+import sys
+
+import click
+
+from asynchy.merge import NEWEST, PREFERENCES
+
+
+@click.command("merge-db")
+@click.argument("sources", nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option("--prefer", default=NEWEST, type=click.Choice(PREFERENCES),
+              help="Which copy of an EPN found in several databases to "
+              "keep: the one modified last or the largest",
+              show_default=True)
+@click.pass_context
+def merge_db(ctx, sources, prefer):
+    """Merge EPN databases, e.g. those produced by AS-Walker, into the
+    configured database
+
+    EPNs already in the database keep their transfer state.
+    """
+    # imported here so the rest of the CLI (init, --help) starts quickly
+    from asynchy.merge import MergeError, merge
+
+    try:
+        counts = merge(ctx.obj['db'], list(sources), prefer=prefer)
+    except MergeError as err:
+        click.echo(err)
+        sys.exit(1)
+
+    for count in counts:
+        click.echo("{}: {} EPNs, {} new, {} updated".format(*count))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Console script running asynchy as a daemon."""
+import logging
+
+import click
+
+from .sync import run, transfer_options
+
+
+@click.command()
+@click.option("--limit", default=None, type=int,
+              help="Maximum number of EPNs read from the database at a time")
+@click.option("--poll_interval", default=60.0,
+              help="Seconds between checks for new pending EPNs once all "
+              "known ones are transferred",
+              show_default=True)
+@click.option("--report_interval", default=300.0,
+              help="Seconds between reports of the daemon's state",
+              show_default=True)
+@transfer_options
+@click.pass_context
+def serve(ctx, limit, poll_interval, report_interval, **options):
+    """Keep syncing new EPNs from a configured asynchy remote
+
+    Keeps one transfer engine (worker pool and SSH connections) alive and
+    transfers EPNs as they are added to the database. On SIGTERM no more
+    transfers are started and asynchy exits once those in flight have
+    finished; interrupt it again to cancel them.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    run(ctx, limit, poll_interval=poll_interval,
+        report_interval=report_interval, **options)
@@ -1,64 +1,233 @@
 # -*- coding: utf-8 -*-
 
 """Console script for asynchy."""
-import signal
 import click
 
-from multiprocessing import cpu_count
-from asynchy.asynchy import main
-from asynchy.rsync import RSyncTransfer
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
+from asynchy.scheduling import POLICIES, MODIFIED
+
+
+# Options of the commands that transfer EPNs
+_TRANSFER_OPTIONS = [
+    click.option("--dest", default="./",
+                 help="Destination directory",
+                 show_default=True),
+    click.option("--src_prefix", default="/",
+                 help="Prefix to append to EPNs to create their path",
+                 show_default=True),
+    click.option("--order", default="ASC",
+                 type=click.Choice(["ASC", "DESC"], case_sensitive=False),
+                 help="Order of transfers by date",
+                 show_default=True),
+    click.option("--policy", default=MODIFIED, type=click.Choice(POLICIES),
+                 help="Scheduling policy: by date (modified), largest "
+                 "first to minimise batch time (lpt), smallest first to "
+                 "maximise EPNs per hour (smallest) or smallest first with "
+                 "aging (hybrid)",
+                 show_default=True),
+    click.option("--retry", default=0,
+                 help="Number of time to retry SSH connection",
+                 show_default=True),
+    click.option("--engine", default="pool",
+                 type=click.Choice(["pool", "asyncio"]),
+                 help="Transfer engine: a pool of workers each running one "
+                 "rsync, or a single asyncio event loop running --threads "
+                 "rsyncs concurrently",
+                 show_default=True),
+    click.option("--parallel", default=False,
+                 help="Use multiple processes for parallelisation",
+                 is_flag=True, show_default=True),
+    click.option("--threads", default=cpu_count(),
+                 help="Number of threads to use. If parallel, the number of "
+                 "Python processes to use",
+                 show_default=True),
+    click.option("--partial_dir", default=".rsync-partial",
+                 help="Hidden directory, in each destination directory, that "
+                 "partially transferred files are kept in so the next "
+                 "attempt resumes them. Empty to disable",
+                 show_default=True),
+    click.option("--partial", is_flag=True, default=False,
+                 help="Keep partially transferred files in place when "
+                 "--partial_dir is empty",
+                 show_default=True),
+    click.option("--compress", is_flag=True, default=False,
+                 help="Enable compression prior to transfer",
+                 show_default=True),
+    click.option("--shard_size", default=None, type=float,
+                 help="Split EPNs larger than this many GiB across several "
+                 "concurrent rsync streams (pool engine only)"),
+    click.option("--shards", default=4,
+                 help="Number of rsync streams to split large EPNs across",
+                 show_default=True),
+    click.option("--multiplex/--no_multiplex", default=True,
+                 help="Share one persistent SSH connection between all "
+                 "transfers (pool engine only)",
+                 show_default=True),
+    click.option("--small_file_size", default=None, type=float,
+                 help="Stream EPNs whose mean file size is below this many "
+                 "KiB as a single tar archive instead of using rsync"),
+    click.option("--adaptive", is_flag=True, default=False,
+                 help="Adjust the number of concurrent transfers between "
+                 "--min_threads and --threads to maximise throughput",
+                 show_default=True),
+    click.option("--min_threads", default=1,
+                 help="Minimum number of concurrent transfers when --adaptive",
+                 show_default=True),
+    click.option("--adapt_interval", default=30.0,
+                 help="Seconds of throughput measured between adjustments "
+                 "when --adaptive",
+                 show_default=True),
+    click.option("--bwlimit", default=None, type=int,
+                 help="Total rate in KiB/s shared by all transfers. Overrides "
+                 "the bandwidth schedule in the config"),
+    click.option("--lease", default=300.0,
+                 help="Seconds an EPN stays claimed by this process unless "
+                 "renewed, after which another process sharing the "
+                 "database may transfer it",
+                 show_default=True),
+    click.option("--wal/--no_wal", default=True,
+                 help="Use SQLite's write-ahead log. Turn it off when "
+                 "processes on several hosts share the database",
+                 show_default=True),
+    click.option("--checksum", is_flag=True, default=False,
+                 help="Record the checksum of each file computed by the "
+                 "sender, for asynchy verify to check received files "
+                 "against (rsync engines, needs rsync 3.2 on both ends)",
+                 show_default=True),
+    click.option("--attempts", default=3,
+                 help="Attempts of an EPN that fails with a transient (e.g. "
+                 "network) or partial (files changed as they were read) "
+                 "error before it is left for a later run",
+                 show_default=True),
+    click.option("--retry_delay", default=30.0,
+                 help="Seconds before the first retry of a failed EPN, "
+                 "doubling with every further attempt",
+                 show_default=True),
+]
+
+
+def transfer_options(func):
+    """Add the options shared by the commands that transfer EPNs"""
+    for option in reversed(_TRANSFER_OPTIONS):
+        func = option(func)
+    return func
 
 
 @click.command()
-@click.option("--dest", default="./",
-              help="Destination directory",
-              show_default=True)
-@click.option("--src_prefix", default="/",
-              help="Prefix to append to EPNs to create their path",
-              show_default=True)
-@click.option("--order", default="ASC",
-              help="Order of transfers by date",
-              show_default=True)
 @click.option("--limit", default=50,
               help="Number of EPNs transfer",
               show_default=True)
-@click.option("--retry", default=0,
-              help="Number of time to retry SSH connection",
-              show_default=True)
-@click.option("--parallel", default=False,
-              help="Use multiple processes for parallelisation",
-              is_flag=True, show_default=True)
-@click.option("--threads", default=cpu_count(),
-              help="Number of threads to use. If parallel, the number of "
-              "Python processes to use",
-              show_default=True)
-@click.option("--partial", is_flag=True, default=False,
-              help="Enable partial transfers",
-              show_default=True)
-@click.option("--compress", is_flag=True, default=False,
-              help="Enable compression prior to transfer",
-              show_default=True)
+@transfer_options
 @click.pass_context
-def sync(ctx, dest, src_prefix, order, limit, retry, parallel,
-         threads, partial, compress):
+def sync(ctx, limit, **options):
     """Sync data from a configured asynchy remote"""
-    if parallel:
-        from multiprocessing.pool import Pool
+    run(ctx, limit, **options)
+
+
+def run(ctx, limit, dest, src_prefix, order, policy, retry, engine,
+        parallel, threads, partial_dir, partial, compress, shard_size,
+        shards, multiplex, small_file_size, adaptive, min_threads,
+        adapt_interval, bwlimit, lease, wal, checksum, attempts,
+        retry_delay, poll_interval=None, report_interval=None):
+    """Build the transfer engine from the config and `options` and transfer
+    pending EPNs, see `asynchy.asynchy.main`"""
+    # imported here so the rest of the CLI (init, --help) starts quickly
+    from asynchy.asynchy import main
+    from asynchy.bandwidth import Schedule
+    from asynchy.control import AIMDController
+    from asynchy.retry import RetryPolicy
+    from asynchy.rsync import RSyncTransfer
+    from asynchy.tar import TarTransfer
+    from asynchy.transfer import RoutingTransfer, small_files
+
+    partial = partial_dir or partial
+
+    bandwidth = None
+    if bwlimit is not None:
+        bandwidth = Schedule(default=bwlimit)
+    elif ctx.obj.get('bandwidth') is not None:
+        bandwidth = Schedule.from_config(ctx.obj['bandwidth'])
+
+    shard_threshold = None
+    if shard_size is not None:
+        shard_threshold = int(shard_size * 1024 ** 3)
+
+    # mirrors of the remote to balance transfers across, e.g.
+    # hosts: [{host: sftp1.synchrotron.org.au, limit: 4}, ...]
+    hosts = None
+    if ctx.obj.get('hosts'):
+        hosts = [(h['host'], h.get('limit', threads))
+                 for h in ctx.obj['hosts']]
+
+    if engine == "asyncio":
+        from asynchy.aiorsync import AsyncRSyncTransfer
+
+        if hosts:
+            click.echo("Balancing across hosts requires the pool engine, "
+                       "transferring from {}".format(ctx.obj['host']))
+
+        rst = AsyncRSyncTransfer(
+            host=ctx.obj['host'],
+            user=ctx.obj['user'],
+            keypath=ctx.obj['keypath'],
+            port=ctx.obj['port'],
+            partial=partial,
+            compress=compress,
+            retry=retry,
+            concurrency=threads,
+            bandwidth=bandwidth,
+            checksum=checksum
+        )
+        shared = {}
     else:
-        from multiprocessing.dummy import Pool
-
-    # disable default interrupt handlers for Pool processes
-    default_int_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    pool = Pool(processes=threads)
-    rst = RSyncTransfer(
-        host=ctx.obj['host'],
-        user=ctx.obj['user'],
-        keypath=ctx.obj['keypath'],
-        port=ctx.obj['port'],
-        partial=partial,
-        compress=compress,
-        retry=retry,
-        pool=pool
-    )
-    signal.signal(signal.SIGINT, default_int_handler)
-    main(rst, ctx.obj['db'], dest, src_prefix, order, limit)
+        rst = RSyncTransfer(
+            host=ctx.obj['host'],
+            user=ctx.obj['user'],
+            keypath=ctx.obj['keypath'],
+            port=ctx.obj['port'],
+            partial=partial,
+            compress=compress,
+            retry=retry,
+            processes=threads,
+            parallel=parallel,
+            shard_threshold=shard_threshold,
+            shards=shards,
+            multiplex=multiplex,
+            bandwidth=bandwidth,
+            hosts=hosts,
+            checksum=checksum
+        )
+        shared = dict(share_with=rst)
+
+    transfer = rst
+    if small_file_size is not None:
+        tar = TarTransfer(
+            host=ctx.obj['host'],
+            user=ctx.obj['user'],
+            keypath=ctx.obj['keypath'],
+            port=ctx.obj['port'],
+            retry=retry,
+            progress_queue=rst.progress(),
+            **shared
+        )
+        transfer = RoutingTransfer(
+            rst, [(small_files(small_file_size * 1024), tar)]
+        )
+
+    controller = None
+    if adaptive:
+        # the pool is sized for the upper bound; the controller decides how
+        # many of its workers are busy
+        controller = AIMDController(min(min_threads, threads), threads,
+                                    interval=adapt_interval)
+
+    # keep a transfer queued for each worker so none idles between EPNs
+    main(transfer, ctx.obj['db'], dest, src_prefix, order, limit,
+         window=2 * threads, policy=policy, controller=controller,
+         retry_policy=RetryPolicy(attempts, retry_delay),
+         poll_interval=poll_interval, report_interval=report_interval,
+         lease=lease, wal=wal)
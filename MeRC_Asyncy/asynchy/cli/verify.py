@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Console script verifying transferred EPNs."""
+import logging
+import sys
+
+import click
+
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
+
+@click.command()
+@click.option("--dest", default="./",
+              help="Destination directory the EPNs were transferred to",
+              show_default=True)
+@click.option("--epn", "epns", multiple=True,
+              help="EPN to verify, may be repeated. Default is every "
+              "complete EPN")
+@click.option("--processes", default=cpu_count(),
+              help="Number of processes hashing files",
+              show_default=True)
+@click.option("--src_prefix", default="/",
+              help="Prefix to append to EPNs to create their path",
+              show_default=True)
+@click.option("--list/--no_list", "listing", default=True,
+              help="List each EPN's source to check that none of its files "
+              "are missing. Without it, only EPNs whose manifest holds "
+              "every file `asynchy walk` counted can be verified",
+              show_default=True)
+@click.option("--repair", is_flag=True, default=False,
+              help="Delete files that do not match and mark their EPNs "
+              "pending so the next sync transfers them again",
+              show_default=True)
+@click.pass_context
+def verify(ctx, dest, epns, processes, src_prefix, listing, repair):
+    """Check transferred files against their EPN's source and manifest
+
+    Checks that every file at the source arrived with the same size and,
+    for EPNs transferred with --checksum, compares its checksum. Digests
+    are cached in the database so files that have not changed since they
+    were last verified are not read again.
+    """
+    # imported here so the rest of the CLI (init, --help) starts quickly
+    from asynchy.verify import verify as run
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    remote = {}
+    if listing:
+        remote = dict(src_prefix=src_prefix, host=ctx.obj['host'],
+                      user=ctx.obj['user'], keypath=ctx.obj['keypath'],
+                      port=ctx.obj['port'])
+    results = run(ctx.obj['db'], dest, list(epns) or None,
+                  processes=processes, repair=repair, **remote)
+    failed = [r.epn for r in results if r.missing or r.mismatched]
+    incomplete = [r.epn for r in results
+                  if r.incomplete and r.epn not in failed]
+    click.echo("Verified {} of {} EPNs".format(
+        len(results) - len(failed) - len(incomplete), len(results)
+    ))
+    if incomplete:
+        click.echo("Unable to verify: {}".format(", ".join(incomplete)))
+    if failed:
+        click.echo("Failed verification: {}".format(", ".join(failed)))
+    if failed or incomplete:
+        sys.exit(1)
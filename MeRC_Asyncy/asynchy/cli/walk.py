@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Console script populating the EPN database from the remote."""
+import logging
+import sys
+
+import click
+
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
+
+@click.command()
+@click.option("--root", default="/data",
+              help="Remote directory whose top-level directories are EPNs",
+              show_default=True)
+@click.option("--processes", default=cpu_count(),
+              help="Number of EPN directories listed concurrently",
+              show_default=True)
+@click.option("--batch_size", default=1000,
+              help="Number of EPNs written to the database per transaction",
+              show_default=True)
+@click.option("--retry", default=0,
+              help="Number of time to retry SSH connection",
+              show_default=True)
+@click.option("--multiplex/--no_multiplex", default=True,
+              help="Share one persistent SSH connection between all "
+              "listings",
+              show_default=True)
+@click.option("--wal/--no_wal", default=True,
+              help="Use SQLite's write-ahead log. Turn it off when "
+              "processes on several hosts share the database",
+              show_default=True)
+@click.option("--full", is_flag=True, default=False,
+              help="List every EPN rather than only those whose directory "
+              "changed since the last walk",
+              show_default=True)
+@click.pass_context
+def walk(ctx, root, processes, batch_size, retry, multiplex, wal, full):
+    """Add the EPNs on a configured asynchy remote to the database
+
+    Lists each EPN under --root recursively and records its size, file
+    count, path and latest modification time, replacing a separate
+    AS-Walker run. Walking again only lists new EPNs and those whose
+    directory changed since, and queues the EPNs whose contents changed to
+    be transferred again.
+    """
+    # imported here so the rest of the CLI (init, --help) starts quickly
+    from asynchy.walk import walk as run
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    written, changed, failed = run(
+        ctx.obj['db'], root, host=ctx.obj['host'], user=ctx.obj['user'],
+        keypath=ctx.obj['keypath'], port=ctx.obj['port'], retry=retry,
+        processes=processes, batch_size=batch_size, multiplex=multiplex,
+        wal=wal, full=full
+    )
+    click.echo("Walked {} EPNs, {} changed".format(written, len(changed)))
+    if failed:
+        click.echo("Unable to walk: {}".format(", ".join(failed)))
+        sys.exit(1)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Adaptive control of the number of concurrent transfers.
+
+Too many concurrent streams just share the same WAN link and get us
+throttled by the remote; too few leave the link idle. `AIMDController`
+measures aggregate throughput from the progress stream and climbs towards
+the concurrency that maximises it.
+"""
+
+import logging
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+INCREASE = "increase"
+DECREASE = "decrease"
+REVERT = "revert"
+
+
+class AIMDController(object):
+    """Adjust the number of concurrent transfers with additive-increase /
+    multiplicative-decrease hill climbing on aggregate throughput.
+
+    Every `interval` seconds the throughput over the last interval is
+    compared with the one before:
+
+    - if it improved by more than `tolerance`, add `increase` transfers;
+    - if it fell by more than `tolerance`, the link is saturated or we are
+      being throttled, so multiply the number of transfers by `decrease`;
+    - if it stayed flat after an increase, the extra transfers did not help
+      so take them back; otherwise probe upwards again.
+
+    The limit always stays within [`minimum`, `maximum`].
+
+    Attributes
+    ----------
+    minimum: int
+        Lower bound on concurrent transfers.
+    maximum: int
+        Upper bound on concurrent transfers.
+    limit: int
+        Current number of concurrent transfers.
+    interval: float, optional
+        Seconds between decisions. Default is 30.
+    increase: int, optional
+        Transfers added on an increase. Default is 1.
+    decrease: float, optional
+        Factor applied on a decrease. Default is 0.5.
+    tolerance: float, optional
+        Relative change in throughput regarded as significant. Default is
+        0.05.
+    """
+
+    def __init__(self, minimum, maximum, initial=None, interval=30.0,
+                 increase=1, decrease=0.5, tolerance=0.05):
+        if not 1 <= minimum <= maximum:
+            raise ValueError(
+                "Bounds must satisfy 1 <= minimum <= maximum, got [{}, {}]"
+                .format(minimum, maximum)
+            )
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = self._clamp(minimum if initial is None else initial)
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self._bytes = 0
+        self._started = None
+        self._throughput = None
+        self._last_action = None
+
+    def _clamp(self, limit):
+        return max(self.minimum, min(self.maximum, int(limit)))
+
+    def observe(self, nbytes, now=None):
+        """Record `nbytes` transferred"""
+        if self._started is None:
+            self._started = time.time() if now is None else now
+        self._bytes += nbytes
+
+    def time_to_update(self, now=None):
+        """Seconds until the next decision is due"""
+        now = time.time() if now is None else now
+        if self._started is None:
+            self._started = now
+        return max(0.0, self._started + self.interval - now)
+
+    def update(self, now=None):
+        """Make a decision if one is due
+
+        Returns
+        -------
+        int
+            The number of concurrent transfers to run.
+        """
+        now = time.time() if now is None else now
+        if self.time_to_update(now) > 0:
+            return self.limit
+
+        throughput = self._bytes / (now - self._started)
+        previous = self._throughput
+        old = self.limit
+
+        if previous is None:
+            action = INCREASE
+        elif throughput > previous * (1 + self.tolerance):
+            action = INCREASE
+        elif throughput < previous * (1 - self.tolerance):
+            action = DECREASE
+        elif self._last_action == INCREASE:
+            action = REVERT
+        else:
+            action = INCREASE
+
+        if action == INCREASE:
+            self.limit = self._clamp(self.limit + self.increase)
+        elif action == DECREASE:
+            self.limit = self._clamp(self.limit * self.decrease)
+        else:
+            self.limit = self._clamp(self.limit - self.increase)
+
+        LOGGER.info(
+            "Concurrency %d -> %d (%s): throughput %.2f MiB/s, previously "
+            "%s", old, self.limit, action, throughput / 1024 ** 2,
+            "n/a" if previous is None
+            else "{:.2f} MiB/s".format(previous / 1024 ** 2)
+        )
+
+        self._throughput = throughput
+        self._last_action = action
+        self._bytes = 0
+        self._started = now
+
+        return self.limit
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+
+"""EPN database module"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+LOGGER = logging.getLogger(__name__)
+
+_COMPLETE_SQL = '''UPDATE epns
+                   SET complete = 1, bytesTransferred = ?
+                   WHERE epn = ?'''
+
+_FAILED_SQL = '''UPDATE epns
+                 SET attempts = ?, last_error = ?, next_attempt = ?,
+                     complete = CASE WHEN ? THEN -1 ELSE complete END
+                 WHERE epn = ?'''
+
+_STARTED_SQL = '''UPDATE epns SET started = ? WHERE epn = ?'''
+
+_RENEW_SQL = '''UPDATE epns
+                SET lease_expires = ?
+                WHERE claimed_by = ? AND complete = 0'''
+
+_RELEASE_SQL = '''UPDATE epns
+                  SET claimed_by = NULL, lease_expires = NULL
+                  WHERE claimed_by = ? AND complete != 1'''
+
+_MANIFEST_SQL = '''INSERT OR REPLACE INTO files
+                       (epn, path, size, mtime, checksum)
+                   VALUES (?, ?, ?, ?, ?)'''
+
+# AS-Walker's table of EPNs, created when asynchy walks the remote itself
+_EPNS_TABLE = '''CREATE TABLE IF NOT EXISTS epns (
+                     epn TEXT,
+                     size INTEGER,
+                     path TEXT,
+                     modified DATETIME,
+                     complete INTEGER DEFAULT 0,
+                     bytesTransferred INTEGER DEFAULT 0
+                 )'''
+
+# Manifest of the files of each EPN that arrived, see `ResultWriter.manifest`
+_FILES_TABLE = '''CREATE TABLE IF NOT EXISTS files (
+                      epn TEXT NOT NULL,
+                      path TEXT NOT NULL,
+                      size INTEGER NOT NULL,
+                      mtime INTEGER,
+                      PRIMARY KEY (epn, path)
+                  ) WITHOUT ROWID'''
+
+# Digests of received files computed by `asynchy.verify`, valid while the
+# file at (device, inode) keeps its size and modification time
+_CHECKSUMS_TABLE = '''CREATE TABLE IF NOT EXISTS checksums (
+                          device INTEGER NOT NULL,
+                          inode INTEGER NOT NULL,
+                          size INTEGER NOT NULL,
+                          mtime_ns INTEGER NOT NULL,
+                          algorithm TEXT NOT NULL,
+                          digest TEXT NOT NULL,
+                          PRIMARY KEY (device, inode)
+                      ) WITHOUT ROWID'''
+
+# Tables asynchy creates in the EPN database
+_TABLES = [("epns", _EPNS_TABLE), ("files", _FILES_TABLE),
+           ("checksums", _CHECKSUMS_TABLE)]
+
+# Seconds to wait for another process to release its lock on the database
+DB_TIMEOUT = 30
+
+# Columns asynchy relies on that an AS-Walker epns table may lack, as
+# (name, declaration). Columns added later need a migration of their own.
+COLUMNS = [
+    ("path", "TEXT"),
+    ("file_count", "INTEGER"),
+    ("attempts", "INTEGER DEFAULT 0"),
+    ("last_error", "TEXT"),
+    ("next_attempt", "REAL"),
+    ("claimed_by", "TEXT"),
+    ("lease_expires", "REAL"),
+    ("started", "REAL"),
+    ("verified", "REAL"),
+    ("dir_mtime", "REAL"),
+]
+
+# Columns added to the files table after it was first created
+FILES_COLUMNS = [
+    ("checksum", "TEXT"),
+]
+
+# Indexes of the queries asynchy runs on the epns table: updates by EPN, and
+# the pending EPNs in the order of the `modified` and size based scheduling
+# policies (see `asynchy.asynchy._pending_query`). The pending indexes only
+# hold EPNs still to transfer and cover the query, so selecting the next
+# EPNs reads neither the complete ones nor the table.
+_INDEXES = [
+    '''CREATE INDEX IF NOT EXISTS epns_epn ON epns (epn)''',
+    '''CREATE INDEX IF NOT EXISTS epns_pending_modified
+       ON epns (started IS NULL, modified, size, epn, file_count, attempts,
+                next_attempt, claimed_by, lease_expires, complete, started)
+       WHERE complete = 0''',
+    '''CREATE INDEX IF NOT EXISTS epns_pending_size
+       ON epns (started IS NULL, size, modified, epn, file_count, attempts,
+                next_attempt, claimed_by, lease_expires, complete, started)
+       WHERE complete = 0''',
+    '''CREATE INDEX IF NOT EXISTS epns_claimed_by ON epns (claimed_by)
+       WHERE claimed_by IS NOT NULL''',
+]
+
+# The UNIX timestamp `{0}` as a `modified` datetime like AS-Walker stores,
+# e.g. '2018-06-14 10:00:00' in local time
+_DATETIME_SQL = "datetime({0}, 'unixepoch', 'localtime')"
+
+# Rows ANALYZE samples per index, so it takes moments on millions of rows
+_ANALYSIS_LIMIT = 1000
+
+# Sentinel posted to a ResultWriter's queue to ask it to flush and exit
+_CLOSE = object()
+
+# Tag of the events posted to a ResultWriter's queue by `flush`
+_FLUSH = object()
+
+
+def _adopt(conn):
+    """Migration 1: create the tables asynchy keeps if they are missing and
+    add the `COLUMNS` and `FILES_COLUMNS` missing from the epns and files
+    tables. Databases made by AS-Walker, or by versions of asynchy that did
+    not number their schema, may have any of them already."""
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ))
+    for name, sql in _TABLES:
+        if name not in tables:
+            conn.execute(sql)
+
+    for table, wanted in (("epns", COLUMNS), ("files", FILES_COLUMNS)):
+        existing = set(row[1] for row in conn.execute(
+            'PRAGMA table_info({})'.format(table)
+        ))
+        for name, decl in wanted:
+            if name not in existing:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'
+                             .format(table, name, decl))
+
+
+def _index(conn):
+    """Migration 2: create the `_INDEXES` and the statistics the query
+    planner chooses between them with"""
+    for sql in _INDEXES:
+        conn.execute(sql)
+    conn.execute('PRAGMA analysis_limit = {}'.format(_ANALYSIS_LIMIT))
+    conn.execute('ANALYZE epns')
+
+
+def _datetimes(conn):
+    """Migration 3: store every `modified` as a datetime like AS-Walker
+    does. `asynchy walk` used to store UNIX timestamps, which SQLite sorts
+    ahead of any datetime."""
+    conn.execute("UPDATE epns SET modified = {} "
+                 "WHERE typeof(modified) IN ('integer', 'real')"
+                 .format(_DATETIME_SQL.format("modified")))
+
+
+# Migrations of the schema, each run once on a database, in order. The
+# version of a database's schema (`PRAGMA user_version`) is the number of
+# migrations it has had.
+MIGRATIONS = [_adopt, _index, _datetimes]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    """Version of the schema of the EPN database on `conn`"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def ensure_schema(conn):
+    """Migrate the EPN database to the current SCHEMA_VERSION
+
+    The migrations a database has not had yet run in a single transaction,
+    so a database is never left half migrated. Databases newer than this
+    version of asynchy are left alone.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the EPN database.
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return
+
+    # another process sharing the database may be migrating it too, check
+    # again once we hold the write lock
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = schema_version(conn)
+        for number in range(version, SCHEMA_VERSION):
+            MIGRATIONS[number](conn)
+            conn.execute('PRAGMA user_version = {}'.format(number + 1))
+            LOGGER.info("Migrated the EPN database to schema version %d",
+                        number + 1)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def as_datetime(column):
+    """SQL expression of the `modified` value `column` as a datetime like
+    AS-Walker stores, converting the UNIX timestamps earlier versions of
+    `asynchy walk` stored"""
+    return ("CASE WHEN typeof({0}) IN ('integer', 'real') THEN {1} "
+            "ELSE {0} END".format(column, _DATETIME_SQL.format(column)))
+
+
+def as_timestamp(column):
+    """SQL expression of the `modified` value `column` as a UNIX timestamp,
+    for arithmetic on it. AS-Walker stores datetimes, e.g. '2018-06-14
+    10:00:00' in local time, which SQLite sorts after every number."""
+    return ("CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} "
+            "ELSE CAST(strftime('%s', {0}, 'utc') AS REAL) END"
+            .format(column))
+
+
+def optimize(conn):
+    """Let SQLite refresh the query planner's statistics of tables that
+    changed a lot since they were last analysed. Cheap when nothing did."""
+    conn.execute('PRAGMA analysis_limit = {}'.format(_ANALYSIS_LIMIT))
+    conn.execute('PRAGMA optimize')
+
+
+def _set_journal_mode(conn, mode, timeout=DB_TIMEOUT, interval=0.1):
+    """Switch the database to the journal `mode`, e.g. WAL or DELETE.
+    Changing the journal mode does not wait for other connections' locks,
+    so retry for up to `timeout` seconds."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            (current,) = conn.execute(
+                'PRAGMA journal_mode={}'.format(mode)
+            ).fetchone()
+            if current.upper() == mode.upper():
+                return
+            error = sqlite3.OperationalError(
+                "Unable to switch the journal mode from {} to {}"
+                .format(current, mode)
+            )
+        except sqlite3.OperationalError as err:
+            error = err
+        if time.time() >= deadline:
+            raise error
+        time.sleep(interval)
+
+
+def read_manifest(conn, epn):
+    """Size and modification time of each file of `epn` that arrived, by
+    path
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the EPN database.
+    epn: str
+        The EPN.
+
+    Returns
+    -------
+    dict
+        (size, mtime) of each file, by path relative to the EPN. The mtime
+        is a UNIX timestamp, None if it was not recorded.
+    """
+    return dict((path, (size, mtime)) for path, size, mtime in conn.execute(
+        'SELECT path, size, mtime FROM files WHERE epn = ?', (epn,)
+    ))
+
+
+class ResultWriter(threading.Thread):
+    """Single writer that owns the connection to the EPN database and
+    group-commits updates posted from transfer callbacks.
+
+    Callbacks only enqueue their updates, so the thread delivering results
+    never waits on SQLite. Updates are committed in batches once
+    `batch_size` updates are pending or the oldest pending update is
+    `interval` seconds old, which turns one fsync per EPN into one per batch.
+    The database is switched to WAL mode so readers are not blocked by the
+    writer, unless `wal` is False, in which case it is switched back from
+    WAL mode if an earlier run left it there. Do this before opening other
+    connections to the database.
+
+    Parameters
+    ----------
+    db: str
+        Path to the EPN database.
+    batch_size: int, optional
+        Maximum number of updates per commit.
+    interval: float, optional
+        Maximum time (seconds) an update waits before it is committed.
+    wal: bool, optional
+        Switch the database to WAL mode, otherwise to the default rollback
+        journal. Only processes on the same host can share a database in
+        WAL mode.
+
+    Attributes
+    ----------
+    commits: int
+        Number of transactions committed.
+    rows: int
+        Number of updates committed.
+    total_latency: float
+        Total time (seconds) spent committing.
+    max_latency: float
+        Longest time (seconds) spent on a single commit.
+    """
+
+    def __init__(self, db, batch_size=500, interval=1.0, wal=True):
+        super(ResultWriter, self).__init__(name="asynchy-result-writer")
+        self.daemon = True
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wal = wal
+        # the journal mode is stored in the database, so a database an
+        # earlier run left in WAL mode stays in it unless switched back.
+        # Switch now, as leaving WAL mode waits for every other connection
+        # to close.
+        conn = sqlite3.connect(db, timeout=DB_TIMEOUT)
+        try:
+            _set_journal_mode(conn, "WAL" if wal else "DELETE")
+        finally:
+            conn.close()
+        self.commits = 0
+        self.rows = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._queue = queue.Queue()
+
+    def execute(self, sql, params=()):
+        """Queue an arbitrary write statement to be committed in the next
+        batch"""
+        self._queue.put((sql, params, False))
+
+    def executemany(self, sql, rows):
+        """Queue a write statement to be executed for each of `rows` in the
+        next batch"""
+        self._queue.put((sql, rows, True))
+
+    def complete(self, epn, bytes_transferred):
+        """Queue marking `epn` as complete"""
+        self.execute(_COMPLETE_SQL, (bytes_transferred, epn))
+
+    def started(self, epn, when=None):
+        """Queue recording that a transfer of `epn` started at `when`
+        (default now). An EPN that started but is not complete was
+        interrupted, or failed, part way."""
+        self.execute(_STARTED_SQL,
+                     (time.time() if when is None else when, epn))
+
+    def failed(self, epn, attempts, error, next_attempt=None,
+               permanent=False):
+        """Queue recording a failed attempt of `epn`
+
+        Parameters
+        ----------
+        epn: str
+            The EPN that failed.
+        attempts: int
+            Attempts of the EPN so far.
+        error: str
+            Why the latest attempt failed.
+        next_attempt: float, optional
+            UNIX time before which the EPN is not attempted again.
+        permanent: bool, optional
+            Give up on the EPN: it is marked complete = -1 and no longer
+            pending.
+        """
+        self.execute(_FAILED_SQL, (attempts, error, next_attempt,
+                                   permanent, epn))
+
+    def manifest(self, epn, files):
+        """Queue recording the `files` of `epn` that arrived
+
+        Parameters
+        ----------
+        epn: str
+            The EPN.
+        files: list of (str, int, int, str)
+            Path (relative to the EPN), size, modification time and checksum
+            of each file, see `asynchy.transfer.TransferResult`.
+        """
+        if files:
+            self.executemany(_MANIFEST_SQL,
+                             [(epn, path, size, mtime, checksum)
+                              for path, size, mtime, checksum in files])
+
+    def renew(self, worker, lease_expires):
+        """Queue extending the claims of `worker` on unfinished EPNs to
+        `lease_expires` (UNIX time)"""
+        self.execute(_RENEW_SQL, (lease_expires, worker))
+
+    def release(self, worker, epn=None):
+        """Queue releasing the claims of `worker` on unfinished EPNs, or
+        only on `epn` if given"""
+        if epn is None:
+            self.execute(_RELEASE_SQL, (worker,))
+        else:
+            self.execute(_RELEASE_SQL + " AND epn = ?", (worker, epn))
+
+    def flush(self):
+        """Block until everything queued before the call has been
+        committed (or failed to commit)"""
+        if self.is_alive():
+            done = threading.Event()
+            self._queue.put((_FLUSH, done, False))
+            done.wait()
+
+    def close(self):
+        """Flush all pending updates and stop the writer. Blocks until
+        everything that was queued before the call has been committed."""
+        if self.is_alive():
+            self._queue.put(_CLOSE)
+            self.join()
+
+    @property
+    def mean_latency(self):
+        """Mean time (seconds) spent per commit"""
+        return self.total_latency / self.commits if self.commits else 0.0
+
+    def run(self):
+        conn = sqlite3.connect(self.db, timeout=DB_TIMEOUT)
+
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = None
+                if batch:
+                    timeout = max(0, deadline - time.time())
+
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    batch = self._flush(conn, batch)
+                    deadline = time.time() + self.interval
+                    continue
+
+                if item is _CLOSE:
+                    break
+
+                if item[0] is _FLUSH:
+                    batch = self._flush(conn, batch)
+                    deadline = time.time() + self.interval
+                    item[1].set()
+                    continue
+
+                if not batch:
+                    deadline = time.time() + self.interval
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    batch = self._flush(conn, batch)
+                    deadline = time.time() + self.interval
+
+            batch = self._flush(conn, batch)
+            if batch:
+                LOGGER.error("Failed to record %d updates: %s",
+                             len(batch), batch)
+        finally:
+            conn.close()
+            LOGGER.info("Committed %d updates in %d transactions "
+                        "(mean commit latency %.1f ms, max %.1f ms)",
+                        self.rows, self.commits,
+                        self.mean_latency * 1000, self.max_latency * 1000)
+
+    def _flush(self, conn, batch):
+        """Commit `batch` in a single transaction. Returns the updates that
+        still need committing, i.e. the whole batch if the commit failed."""
+        if not batch:
+            return batch
+
+        start = time.time()
+        try:
+            with conn:
+                for sql, params, many in batch:
+                    if many:
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+        except sqlite3.Error as err:
+            LOGGER.warning("Commit of %d updates failed, will retry: %s",
+                           len(batch), err)
+            return batch
+
+        latency = time.time() - start
+        self.commits += 1
+        self.rows += len(batch)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        LOGGER.debug("Committed %d updates in %.1f ms",
+                     len(batch), latency * 1000)
+
+        return []
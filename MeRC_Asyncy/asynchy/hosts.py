@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""Balance transfers across several mirrors of the same data.
+
+The Synchrotron serves the same EPNs from more than one SFTP host (e.g.
+sftp1 and sftp2). A `HostPool` dispatches each transfer to the least loaded
+healthy host, tracks each host's latency and throughput, and takes a host
+that keeps failing out of rotation for a while (a circuit breaker).
+"""
+
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+# How long a transfer waits before checking again for a free host
+WAIT_INTERVAL = 0.5
+
+# Per host fields of the pool's stats
+ACTIVE = 0
+FAILURES = 1
+OPEN_UNTIL = 2
+LATENCY = 3
+THROUGHPUT = 4
+TRANSFERS = 5
+FIELDS = 6
+
+
+class HostPool(object):
+    """Dispatch transfers to the least loaded healthy host
+
+    A host is loaded by the fraction of its concurrency limit in use. Ties
+    go to the host with the best throughput so far, or to one not tried yet.
+    After `failure_threshold` consecutive failed transfers a host is out of
+    rotation for `cooldown` seconds; it then gets a single trial transfer,
+    which puts it back into rotation if it succeeds or out again if not.
+
+    Latency (time to first byte) and throughput of each host are tracked as
+    exponentially weighted moving averages.
+
+    Attributes
+    ----------
+    hosts: list of (str, int)
+        Host names and the maximum number of concurrent transfers on each.
+    failure_threshold: int, optional
+        Consecutive failures that take a host out of rotation. Default is 3.
+    cooldown: float, optional
+        Seconds a failing host stays out of rotation. Default is 300.
+    alpha: float, optional
+        Weight of the latest transfer in the moving averages. Default is 0.3.
+    lock: Lock, optional
+        Lock guarding `stats`. Default is a `threading.Lock`.
+    stats: sequence, optional
+        Mutable sequence of FIELDS numbers per host. Pass a
+        `multiprocessing.RawArray('d', ...)` and a `multiprocessing.Lock` to
+        share the pool with worker processes that inherit it, e.g. through a
+        pool initializer.
+    """
+
+    def __init__(self, hosts, failure_threshold=3, cooldown=300, alpha=0.3,
+                 lock=None, stats=None):
+        if not hosts:
+            raise ValueError("A host pool needs at least one host")
+        self.names = [name for name, _ in hosts]
+        self.limits = [limit for _, limit in hosts]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._lock = threading.Lock() if lock is None else lock
+        self._stats = [0.0] * (len(hosts) * FIELDS) if stats is None \
+            else stats
+        for i in range(len(self._stats)):
+            self._stats[i] = 0
+
+    @staticmethod
+    def size(hosts):
+        """Length of the `stats` sequence for `hosts`"""
+        return len(hosts) * FIELDS
+
+    def _get(self, host, field):
+        return self._stats[host * FIELDS + field]
+
+    def _set(self, host, field, value):
+        self._stats[host * FIELDS + field] = value
+
+    def _available(self, host, now):
+        """Whether `host` can take another transfer"""
+        active = self._get(host, ACTIVE)
+        if active >= self.limits[host]:
+            return False
+        if self._get(host, FAILURES) < self.failure_threshold:
+            return True
+        # out of rotation until the cooldown ends, then one trial transfer
+        return now >= self._get(host, OPEN_UNTIL) and active == 0
+
+    def try_acquire(self):
+        """Reserve a slot on the least loaded healthy host
+
+        Returns
+        -------
+        int or None
+            Index of the host, None if every host is busy or failing.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [h for h in range(len(self.names))
+                          if self._available(h, now)]
+            if not candidates:
+                return None
+
+            # hosts without transfers yet are assumed fastest, so that
+            # every host gets tried
+            host = min(candidates, key=lambda h: (
+                self._get(h, ACTIVE) / float(self.limits[h]),
+                -self._get(h, THROUGHPUT) if self._get(h, TRANSFERS)
+                else -float("inf")
+            ))
+            self._set(host, ACTIVE, self._get(host, ACTIVE) + 1)
+
+        return host
+
+    def acquire(self, stop=None, interval=WAIT_INTERVAL):
+        """Reserve a slot on the least loaded healthy host, waiting for one
+
+        Returns
+        -------
+        int or None
+            Index of the host, None if `stop` was set while waiting.
+        """
+        while True:
+            host = self.try_acquire()
+            if host is not None:
+                return host
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval):
+                return None
+
+    def _average(self, host, field, value):
+        if self._get(host, TRANSFERS) == 0:
+            self._set(host, field, value)
+        else:
+            self._set(host, field, self.alpha * value +
+                      (1 - self.alpha) * self._get(host, field))
+
+    def release(self, host, succeeded, nbytes=0, elapsed=None,
+                latency=None):
+        """Release the slot of a finished transfer and record its outcome
+
+        Parameters
+        ----------
+        host: int
+            Index of the host returned by `acquire`.
+        succeeded: bool or None
+            Whether the transfer succeeded, None if the outcome says nothing
+            about the host (e.g. it was cancelled).
+        nbytes: int, optional
+            Bytes transferred.
+        elapsed: float, optional
+            Duration of the transfer in seconds.
+        latency: float, optional
+            Seconds until the transfer received its first bytes.
+        """
+        name = self.names[host]
+        with self._lock:
+            self._set(host, ACTIVE, self._get(host, ACTIVE) - 1)
+            if succeeded is None:
+                return
+
+            if not succeeded:
+                failures = self._get(host, FAILURES) + 1
+                self._set(host, FAILURES, failures)
+                if failures >= self.failure_threshold:
+                    self._set(host, OPEN_UNTIL, time.time() + self.cooldown)
+                    LOGGER.warning(
+                        "Taking %s out of rotation for %ds after %d "
+                        "consecutive failures", name, self.cooldown, failures
+                    )
+                return
+
+            if self._get(host, FAILURES) >= self.failure_threshold:
+                LOGGER.info("%s is back in rotation", name)
+            self._set(host, FAILURES, 0)
+            if latency is not None:
+                self._average(host, LATENCY, latency)
+            if elapsed and nbytes:
+                self._average(host, THROUGHPUT, nbytes / float(elapsed))
+            self._set(host, TRANSFERS, self._get(host, TRANSFERS) + 1)
+
+    def stats(self):
+        """Snapshot of each host's state
+
+        Returns
+        -------
+        list of dict
+            Per host name, active transfers, consecutive failures, whether
+            it is in rotation, latency (s) and throughput (bytes/s).
+        """
+        now = time.time()
+        with self._lock:
+            return [
+                dict(host=name,
+                     active=int(self._get(h, ACTIVE)),
+                     failures=int(self._get(h, FAILURES)),
+                     healthy=self._get(h, FAILURES) < self.failure_threshold
+                     or now >= self._get(h, OPEN_UNTIL),
+                     latency=self._get(h, LATENCY),
+                     throughput=self._get(h, THROUGHPUT),
+                     transfers=int(self._get(h, TRANSFERS)))
+                for h, name in enumerate(self.names)
+            ]
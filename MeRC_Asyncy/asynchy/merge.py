@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Merge EPN databases, e.g. the several produced by AS-Walker.
+
+The sources are ATTACHed to the target database and each is merged with a
+single ``INSERT ... SELECT ... ON CONFLICT`` statement, so rows never pass
+through Python and millions of them merge in seconds. All the sources are
+merged in one transaction, or one per SQLITE_MAX_ATTACHED sources if there
+are more.
+
+An EPN that is in several databases keeps the values of the newest (largest
+`modified`) or, if preferred, the largest (`size`) copy. The transfer state
+of EPNs already in the target (`complete`, `bytesTransferred`) is never
+changed; EPNs new to the target take their state from the source, if it has
+one.
+"""
+
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+
+from .db import (
+    DB_TIMEOUT,
+    as_datetime,
+    as_timestamp,
+    ensure_schema,
+    optimize
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+NEWEST = "modified"
+LARGEST = "size"
+
+PREFERENCES = (NEWEST, LARGEST)
+"""Which copy of an EPN found in several databases is kept
+
+modified
+    The one modified last, the largest if they were modified at the same
+    time.
+size
+    The largest one, the one modified last if they are the same size.
+"""
+
+# SQLite's default limit on the number of attached databases
+MAX_ATTACHED = 10
+
+# Columns describing an EPN, updated from the copy that is kept
+_DATA_COLUMNS = ["size", "path", "modified", "file_count"]
+
+# Columns of an EPN's transfer state, only taken from a source for EPNs new
+# to the target
+_STATE_COLUMNS = ["complete", "bytesTransferred"]
+
+# Unique key the upserts resolve conflicts on
+_EPN_KEY = '''CREATE UNIQUE INDEX IF NOT EXISTS epns_epn_key ON epns (epn)'''
+
+
+class MergeError(Exception):
+    """Raised when databases cannot be merged"""
+    pass
+
+
+MergeCount = namedtuple('MergeCount', ['source', 'rows', 'inserted',
+                                       'updated'])
+"""Outcome of merging a source database.
+
+Attributes
+----------
+source: str
+    Path to the source database.
+rows: int
+    Number of EPNs in the source.
+inserted: int
+    Number of EPNs new to the target.
+updated: int
+    Number of EPNs of the target replaced by the source's copy.
+"""
+
+
+def _merge_sql(schema, columns, prefer):
+    """The upsert merging the epns table of the attached database `schema`,
+    which has `columns`, into the target"""
+    data = [c for c in _DATA_COLUMNS if c in columns]
+    insert = ["epn"] + data + [c for c in _STATE_COLUMNS if c in columns]
+    # sources walked by earlier versions of asynchy hold timestamps
+    select = [as_datetime(c) if c == "modified" else c for c in insert]
+
+    order = ["modified", "size"] if prefer == NEWEST else ["size", "modified"]
+
+    def key(table):
+        # compare datetimes as timestamps, SQLite ranks any text above every
+        # number
+        values = {"modified": as_timestamp("{}.modified".format(table)),
+                  "size": "{}.size".format(table)}
+        return ", ".join("COALESCE({}, -1)".format(values[c])
+                         for c in order)
+
+    newer = "({}) > ({})".format(key("excluded"), key("epns"))
+
+    # WHERE true resolves the ambiguity between a join and ON CONFLICT
+    return '''INSERT INTO main.epns ({insert})
+              SELECT {select} FROM {schema}.epns
+              WHERE epn IS NOT NULL
+              ON CONFLICT (epn) DO UPDATE SET {update}
+              WHERE {newer}'''.format(
+        insert=", ".join(insert), select=", ".join(select), schema=schema,
+        update=", ".join("{0} = excluded.{0}".format(c) for c in data),
+        newer=newer
+    )
+
+
+def _merge_source(conn, schema, source, prefer):
+    """Merge the attached database `schema` into the target, returning its
+    MergeCount"""
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM {}.sqlite_master WHERE type = 'table'"
+        .format(schema)
+    ))
+    if "epns" not in tables:
+        raise MergeError("{} has no epns table".format(source))
+    columns = set(row[1] for row in conn.execute(
+        'PRAGMA {}.table_info(epns)'.format(schema)
+    ))
+    missing = set(["epn", "size", "modified"]) - columns
+    if missing:
+        raise MergeError("The epns table of {} has no {} column".format(
+            source, ", ".join(sorted(missing))
+        ))
+
+    rows = conn.execute(
+        'SELECT COUNT(*) FROM {}.epns'.format(schema)
+    ).fetchone()[0]
+    before = conn.execute('SELECT COUNT(*) FROM main.epns').fetchone()[0]
+    changes = conn.total_changes
+    conn.execute(_merge_sql(schema, columns, prefer))
+    inserted = conn.execute(
+        'SELECT COUNT(*) FROM main.epns'
+    ).fetchone()[0] - before
+
+    return MergeCount(source, rows, inserted,
+                      conn.total_changes - changes - inserted)
+
+
+def merge(db, sources, prefer=NEWEST):
+    """Merge the epns tables of `sources` into the database `db`
+
+    Parameters
+    ----------
+    db: str
+        Path to the target EPN database. It is created if it does not
+        exist.
+    sources: list of str
+        Paths to the databases to merge into it.
+    prefer: str, optional
+        One of PREFERENCES: which copy of an EPN in several databases is
+        kept. Default is NEWEST.
+
+    Returns
+    -------
+    list of MergeCount
+        What was merged from each source, in order.
+
+    Raises
+    ------
+    MergeError
+        If a source is missing or has no epns table, or the target holds
+        the same EPN more than once. Nothing is merged from the sources of
+        the transaction that failed.
+    """
+    if prefer not in PREFERENCES:
+        raise MergeError("Unknown preference '{}'. Choose one of: {}"
+                         .format(prefer, ", ".join(PREFERENCES)))
+    for source in sources:
+        if not os.path.isfile(source):
+            raise MergeError("No database at {}".format(source))
+
+    conn = sqlite3.connect(db, timeout=DB_TIMEOUT, isolation_level=None)
+    counts = []
+    try:
+        ensure_schema(conn)
+        try:
+            conn.execute(_EPN_KEY)
+        except sqlite3.IntegrityError:
+            raise MergeError("{} holds some EPNs more than once, remove the "
+                             "duplicates before merging into it".format(db))
+
+        for start in range(0, len(sources), MAX_ATTACHED):
+            chunk = sources[start:start + MAX_ATTACHED]
+            schemas = ["source{}".format(i) for i in range(len(chunk))]
+            for schema, source in zip(schemas, chunk):
+                conn.execute('ATTACH DATABASE ? AS {}'.format(schema),
+                             (source,))
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    merged = [_merge_source(conn, schema, source, prefer)
+                              for schema, source in zip(schemas, chunk)]
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            finally:
+                for schema in schemas:
+                    conn.execute('DETACH DATABASE {}'.format(schema))
+
+            for count in merged:
+                LOGGER.info("Merged %s: %d EPNs, %d new, %d updated",
+                            *count)
+            counts.extend(merged)
+
+        optimize(conn)
+    finally:
+        conn.close()
+
+    return counts
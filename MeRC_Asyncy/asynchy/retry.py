@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Classify failed transfers and decide when to try them again.
+
+rsync's exit code tells a dropped connection, which is worth retrying soon,
+apart from an EPN that cannot be transferred at all (e.g. it does not exist
+on the remote), which only wastes a slot every time it is submitted. Other
+transfer engines, whose exit codes mean something else, classify their
+failures themselves (see `TransferFailedError.kind`).
+"""
+
+import heapq
+import itertools
+import random
+import time
+
+from .transfer import TransferFailedError
+
+
+TRANSIENT = "transient"
+PARTIAL = "partial"
+PERMANENT = "permanent"
+
+# rsync exit codes (see rsync(1)) of failures worth retrying soon: error
+# starting the client-server protocol, socket I/O error, file I/O error (e.g.
+# the destination disk is full), protocol data stream error, timeouts and
+# ssh (255) failing to connect
+TRANSIENT_CODES = frozenset([5, 10, 11, 12, 30, 35, 255])
+
+# Partial transfer due to an error, or because source files vanished
+PARTIAL_CODES = frozenset([23, 24])
+
+# Longest an EPN's error message stored in the database
+MAX_ERROR_LENGTH = 1000
+
+
+def classify(exc):
+    """Classify why a transfer failed
+
+    Failures without an exit code (the process could not be started or was
+    killed by a signal) are assumed transient, as are failures that are not
+    a `TransferFailedError`. Failures that carry their `kind` are classified
+    as such, the others by their rsync exit code: those not known to be
+    transient or partial are permanent.
+
+    Parameters
+    ----------
+    exc: Exception
+        The failure of a transfer.
+
+    Returns
+    -------
+    str
+        One of TRANSIENT, PARTIAL or PERMANENT.
+    """
+    if not isinstance(exc, TransferFailedError):
+        return TRANSIENT
+    if exc.kind is not None:
+        return exc.kind
+    rc = exc.returncode
+    if rc is None or rc < 0 or rc in TRANSIENT_CODES:
+        return TRANSIENT
+    if rc in PARTIAL_CODES:
+        return PARTIAL
+    return PERMANENT
+
+
+class RetryPolicy(object):
+    """When to try a failed EPN again
+
+    Transient failures are retried with exponential backoff and jitter: the
+    n-th retry waits between half and all of ``base_delay * 2 ** (n - 1)``
+    seconds, capped at `max_delay`. Within a run an EPN is attempted at most
+    `max_attempts` times; transient and partial failures beyond that are
+    left for a later run, after their backoff. Partial transfers, of files
+    that vanished or changed while they were read, are never given up on:
+    they are what EPNs still being written fail with. Permanent failures are
+    given up on straight away.
+
+    Attributes
+    ----------
+    max_attempts: int, optional
+        Attempts of an EPN, counted across runs. Default is 1, i.e. failures
+        are not retried within a run.
+    base_delay: float, optional
+        Seconds before the first retry. Default is 30.
+    max_delay: float, optional
+        Longest wait before a retry. Default is an hour.
+    """
+
+    def __init__(self, max_attempts=1, base_delay=30.0, max_delay=3600.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempts):
+        """Seconds to wait after the `attempts`-th failed attempt"""
+        delay = min(self.max_delay,
+                    self.base_delay * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def decide(self, exc, attempts):
+        """Decide what to do with an EPN that failed
+
+        Parameters
+        ----------
+        exc: Exception
+            The failure of the EPN's latest attempt.
+        attempts: int
+            Attempts of the EPN so far, including the one that failed.
+
+        Returns
+        -------
+        (str, float or None, bool)
+            Classification of the failure, seconds before the EPN may be
+            attempted again (None if it should not be) and whether to retry
+            it within this run.
+        """
+        kind = classify(exc)
+        if kind == PERMANENT:
+            return kind, None, False
+        return kind, self.backoff(attempts), attempts < self.max_attempts
+
+
+class RetryQueue(object):
+    """EPNs waiting to be retried, earliest first"""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, when, item):
+        """Retry `item` once the clock reaches `when`"""
+        heapq.heappush(self._heap, (when, next(self._counter), item))
+
+    def pop_ready(self, now=None):
+        """Remove and return the earliest item that is due, or None"""
+        now = time.time() if now is None else now
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def time_to_next(self, now=None):
+        """Seconds until the earliest item is due, None if there is none"""
+        if not self._heap:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self._heap[0][0] - now)
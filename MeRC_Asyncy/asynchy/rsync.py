@@ -1,19 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import logging
+import os
+import re
+import select
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 
-from multiprocessing import cpu_count
-from multiprocessing.managers import SyncManager
-from multiprocessing.pool import Pool
+import multiprocessing
+import multiprocessing.dummy
+import multiprocessing.pool
+
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
 try:
     from shlex import quote
 except ImportError:
     from pipes import quote
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
 from .transfer import (
     Transfer,
@@ -21,11 +35,41 @@ from .transfer import (
     TransferFailedError,
     TransferResult
 )
+from .bandwidth import COUNTERS, BandwidthGovernor
+from .hosts import HostPool
+from .retry import TRANSIENT, classify
+from .scheduling import partition
+from .ssh import SSHMaster
 from .utils import Success, Failure, AtomicCounter
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 LOGGER = logging.getLogger(__name__)
 
+# Maximum time (seconds) a running transfer takes to notice cancellation
+CANCEL_INTERVAL = 0.5
+
+# Minimum time (seconds) between progress updates posted by a transfer
+PROGRESS_INTERVAL = 0.5
+
+# Directory, in each destination directory, that partially transferred files
+# are kept in until a later attempt resumes them
+PARTIAL_DIR = ".rsync-partial"
+
+# Algorithm of the file checksums rsync is asked to log (`--checksum-choice`)
+# so that they can be checked with hashlib, see `asynchy.verify`
+CHECKSUM = "md5"
+
+# Width of a logged checksum, blank for entries rsync did not checksum
+_CHECKSUM_WIDTH = 32
+
+# rsync redraws its progress line with carriage returns
+_LINE_BREAK = re.compile(b'[\r\n]')
+
 
 class RSyncNotFoundError(Exception):
     """Raised when rsync is not found."""
@@ -60,37 +104,524 @@ def _parse_byte_number(line):
         )
 
 
+def _parse_mtime(stamp):
+    """UNIX timestamp of an rsync `%M` modification time, e.g.
+    ``2018/06/14-10:00:00``. Slices rather than strptime, which is too slow
+    for hundreds of thousands of files."""
+    return int(time.mktime((
+        int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+        int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]), 0, 0, -1
+    )))
+
+
+def _parse_file_line(line, checksum=False):
+    """Parse the line rsync logs for each file with
+    `--out-format='%l %M %n'`, e.g. ``1024 2018/06/14-10:00:00 dir/file``,
+    or with `--out-format='%l %M %C %n'` if `checksum`
+
+    Returns
+    -------
+    (int, int, bytes, str)
+        Length, modification time as a UNIX timestamp, name and checksum
+        (None if not logged) of the file. Names of directories end with a
+        slash.
+    """
+    try:
+        length, stamp, name = line.split(b' ', 2)
+        digest = None
+        if checksum:
+            if name[_CHECKSUM_WIDTH:_CHECKSUM_WIDTH + 1] != b' ':
+                raise ValueError(line)
+            digest = name[:_CHECKSUM_WIDTH].strip().decode("ascii") or None
+            name = name[_CHECKSUM_WIDTH + 1:]
+        return int(length), _parse_mtime(stamp), name, digest
+    except (ValueError, UnicodeDecodeError):
+        raise RSyncOutputParseError(
+            "Unable to parse file from rsync line:\n%s" % line
+        )
+
+
+def _parse_progress_line(line):
+    """Parse the bytes of the current file received so far from an rsync
+    `--progress` line, e.g. ``   510,033  48%    6.49MB/s    0:00:01``"""
+    fields = line.split()
+    if len(fields) < 2 or not fields[1].endswith(b'%'):
+        raise RSyncOutputParseError(
+            "Not an rsync progress line:\n%s" % line
+        )
+    try:
+        return int(fields[0].replace(b',', b''))
+    except ValueError:
+        raise RSyncOutputParseError(
+            "Unable to parse progress from rsync line:\n%s" % line
+        )
+
+
+class _LineSplitter(object):
+    """Split chunks of rsync output into lines, treating the carriage
+    returns of progress updates as line breaks. Empty lines are dropped."""
+
+    def __init__(self):
+        self._partial = b''
+
+    def feed(self, chunk):
+        """Lines completed by `chunk`"""
+        lines = _LINE_BREAK.split(self._partial + chunk)
+        self._partial = lines.pop()
+        return [line for line in lines if line]
+
+    def close(self):
+        """Any trailing line without a line break"""
+        partial, self._partial = self._partial, b''
+        return [partial] if partial else []
+
+
+def _read_lines(stream, on_output):
+    """Call `on_output` with each line read from `stream`"""
+    splitter = _LineSplitter()
+    for chunk in iter(lambda: os.read(stream.fileno(), 65536), b''):
+        for line in splitter.feed(chunk):
+            on_output(line)
+    for line in splitter.close():
+        on_output(line)
+
+
+def _wait_for_exit(proc, stop, interval=CANCEL_INTERVAL):
+    """Block until `proc` exits or `stop` is set, without busy waiting.
+
+    Where the platform supports it (Linux, Python >= 3.9), we wait on a pidfd
+    for the child so we are woken as soon as it exits. Otherwise we fall back
+    to `Popen.wait` with a timeout. In both cases we wake up at least every
+    `interval` seconds to check `stop`.
+
+    Parameters
+    ----------
+    proc: subprocess.Popen
+        Child process to wait on.
+    stop: threading.Event
+        Event signalling that the transfer should be cancelled.
+    interval: float, optional
+        Maximum time to block before checking `stop`.
+
+    Returns
+    -------
+    bool
+        True if the process exited, False if `stop` was set first.
+    """
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None
+
+    try:
+        while not stop.is_set():
+            if pidfd is not None:
+                ready, _, _ = select.select([pidfd], [], [], interval)
+                if ready:
+                    proc.wait()
+                    return True
+            else:
+                try:
+                    proc.wait(timeout=interval)
+                    return True
+                except subprocess.TimeoutExpired:
+                    pass
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    return proc.poll() is not None
+
+
+def _read_stream(stream, chunks):
+    """Drain `stream` into the list `chunks` so the child never blocks on a
+    full pipe"""
+    for chunk in iter(lambda: stream.read(4096), b''):
+        chunks.append(chunk)
+
+
+def _ssh_option(host=None, port=22, user=None, keypath=None, retry=0,
+                ssh_options=None):
+    """Build the rsync remote shell option and remote path prefix.
+
+    `ssh_options` are extra options appended to the ssh command, e.g.
+    `asynchy.ssh.SSHMaster.options()`.
+
+    Returns
+    -------
+    (str, str)
+        The `-e` option (empty for a local transfer) and the `user@host:`
+        prefix for remote paths (empty for a local transfer).
+    """
+    if not all([host, user, keypath]):
+        return "", ""
+
+    opt = "-e 'ssh -p {} -i {} -o\"BatchMode=yes\" "\
+        "-o\"ConnectionAttempts={}\"{}' "\
+        .format(quote(str(port)), quote(keypath), quote(str(retry + 1)),
+                " " + ssh_options if ssh_options else "")
+    return opt, "{}@{}:".format(user, host)
+
+
 def _rsync_command(src, dest, host=None, port=22, user=None,
-                   keypath=None, partial=False, compress=False,
-                   retry=0):
-    cmd = "rsync -rlt "
+                   keypath=None, partial=PARTIAL_DIR, compress=False,
+                   retry=0, files_from=None, ssh_options=None,
+                   bwlimit=None, checksum=False):
+    """Build the rsync command line to transfer `src` to `dest`.
+
+    If `files_from` is given, only the NUL separated paths (relative to
+    `src`) listed in that file are transferred. Listed directories are created
+    but not recursed into. `bwlimit` caps the rate in KiB/s. `partial` is
+    either a directory (relative to each destination directory) to keep
+    partially transferred files in, or True to keep them in place. If
+    `checksum`, rsync logs the CHECKSUM of each file the sender computed
+    while transferring it (requires rsync 3.2 on both ends).
+    """
+    cmd = "rsync -rlt " if files_from is None else "rsync -lt "
 
     if compress:
         cmd += "-z "
 
-    if all([host, user, keypath]):
-        cmd += "-e 'ssh -p {} -i {} -o\"BatchMode=yes\" "\
-            "-o\"ConnectionAttempts={}\"' "\
-            .format(quote(str(port)), quote(keypath),
-                    quote(str(retry + 1)))
+    ssh, remote = _ssh_option(host, port, user, keypath, retry, ssh_options)
+    cmd += ssh
+
+    if partial is True:
+        cmd += "--partial "
+    elif partial:
+        cmd += "--partial-dir={} ".format(quote(partial))
+
+    if bwlimit is not None:
+        cmd += "--bwlimit={} ".format(int(bwlimit))
 
-        if partial:
-            cmd += "--partial "
+    if files_from is not None:
+        cmd += "--from0 --files-from={} ".format(quote(files_from))
 
-        cmd += "--out-format='%-10l' {}@{}:{} {}"\
-            .format(quote(user), quote(host), quote(src), quote(dest))
-    else:
-        if partial:
-            cmd += "--partial "
+    out_format = "%l %M %n"
+    if checksum:
+        cmd += "--checksum-choice={} ".format(CHECKSUM)
+        out_format = "%l %M %C %n"
 
-        cmd += "--out-format='%-10l' {} {}".format(quote(src), quote(dest))
+    cmd += "--progress --out-format='{}' {} {}"\
+        .format(out_format, quote(remote + src), quote(dest))
 
     return cmd
 
 
+def _list_command(src, host=None, port=22, user=None, keypath=None,
+                  retry=0, ssh_options=None, recursive=True):
+    """Build the rsync command line to list `src`, recursively unless
+    `recursive` is False"""
+    ssh, remote = _ssh_option(host, port, user, keypath, retry, ssh_options)
+    return "rsync {}--list-only {}{}".format("-r " if recursive else "", ssh,
+                                            quote(remote + src))
+
+
+def _parse_list_line(line):
+    """Parse a line of `rsync --list-only` output
+
+    Parameters
+    ----------
+    line: bytes
+        Line of output, e.g.
+        ``-rw-r--r--      1,024 2018/06/14 10:00:00 path/to/file``
+
+    Returns
+    -------
+    (bytes, int, float, bytes)
+        File type (first character of the mode, e.g. b'd' or b'-'), size,
+        modification time as a UNIX timestamp and path.
+
+    Raises
+    ------
+    RSyncOutputParseError
+        If the line is not a listing line.
+    """
+    try:
+        mode, size, date, clock, name = line.rstrip(b'\r\n').split(None, 4)
+        mtime = time.mktime(time.strptime(
+            (date + b' ' + clock).decode("ascii"), "%Y/%m/%d %H:%M:%S"
+        ))
+        size = int(size.replace(b',', b''))
+    except ValueError:
+        raise RSyncOutputParseError(
+            "Unable to parse rsync listing line:\n%s" % line
+        )
+
+    if mode.startswith(b'l') and b' -> ' in name:
+        name = name.split(b' -> ', 1)[0]
+
+    return mode[:1], size, mtime, name
+
+
+def _list_files(src, stop, host=None, port=22, user=None, keypath=None,
+                retry=0, ssh_options=None):
+    """List the contents of the `src` directory
+
+    Returns
+    -------
+    Success([(bytes, int, float, bytes)]) or Failure(exc)
+        The parsed listing of all entries under `src` (excluding `src`
+        itself) or the exception raised while listing it.
+    """
+    cmd = _list_command(src.rstrip('/') + '/', host=host, port=port,
+                        user=user, keypath=keypath, retry=retry,
+                        ssh_options=ssh_options)
+    lines = []
+    result = _rsync(cmd, src, stop, lines.append)
+
+    def parse(_):
+        entries = []
+        for line in lines:
+            try:
+                entry = _parse_list_line(line)
+            except RSyncOutputParseError as err:
+                LOGGER.debug("Skipping listing line: %s", err)
+                continue
+            if entry[3] != b'.':
+                entries.append(entry)
+        return entries
+
+    return result.map(parse)
+
+
+def _ignore_sigint():
+    """Ignore SIGINT in a child process or pool worker, which the parent
+    stops itself when interrupted"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _rsync(cmd, src, stop, on_output):
+    """Run an rsync command until it exits or is cancelled
+
+    Parameters
+    ----------
+    cmd: str
+        rsync command line.
+    src: str
+        Source being transferred, used in error messages.
+    stop: threading.Event
+        An event to signal that the process should be cancelled.
+    on_output: func
+        Called from a reader thread with each line rsync writes to stdout.
+
+    Returns
+    -------
+    Success(None) or Failure(exc)
+    """
+    # exec, so that terminating the process stops rsync itself, which then
+    # keeps the partial file, rather than the shell running it
+    proc = subprocess.Popen("exec " + cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            shell=True,
+                            preexec_fn=_ignore_sigint)
+
+    thread = threading.Thread(target=_read_lines,
+                              args=(proc.stdout, on_output))
+    thread.daemon = True
+    thread.start()
+
+    stderr = []
+    err_thread = threading.Thread(target=_read_stream,
+                                  args=(proc.stderr, stderr))
+    err_thread.daemon = True
+    err_thread.start()
+
+    if not _wait_for_exit(proc, stop):
+        proc.terminate()
+        proc.wait()
+        return Failure(TransferCancelledError(
+            "Transfer cancel signal received"
+        ))
+
+    thread.join()
+    err_thread.join()
+    rc = proc.returncode
+    if rc != 0:
+        err = b''.join(stderr)
+
+        return Failure(TransferFailedError(
+            "Rsync transfer for \"{}\" "
+            "failed with the following code: {}\n"
+            "Error: {}"
+            "See Rsync 'man' page for an explanation.\n"
+            .format(src, rc, err.decode("utf-8")), rc
+        ))
+    return Success(None)
+
+
+class _StatusUpdater(object):
+    """Counts the bytes rsync transfers and posts them to a progress queue
+    at most every `interval` seconds, and collects the manifest of files
+    that arrived.
+
+    Safe to share between the reader threads of several rsync processes.
+    Calling the updater parses the output of a single rsync; use `stream` to
+    get a parser for each additional concurrent rsync.
+
+    Attributes
+    ----------
+    files: list of (str, int, int, str)
+        Path (relative to the transferred directory), size, modification
+        time and checksum (None unless `checksum`) of each file that arrived.
+    checksum: bool
+        Whether rsync logs the checksum of each file.
+    """
+
+    def __init__(self, progress=None, interval=PROGRESS_INTERVAL,
+                 prefix=b'', checksum=False):
+        self.bytes_transferred = AtomicCounter()
+        self.progress = progress
+        self.interval = interval
+        self.checksum = checksum
+        self.files = []
+        self._pending = 0
+        # post the first bytes straight away, e.g. to time the first byte
+        self._posted = 0
+        self._lock = threading.Lock()
+        self._streams = [_OutputParser(self, prefix)]
+
+    def __call__(self, line):
+        self._streams[0](line)
+
+    def stream(self, prefix=b''):
+        """Parser for the output of another rsync contributing to this
+        transfer, whose file names start with `prefix`"""
+        parser = _OutputParser(self, prefix)
+        with self._lock:
+            self._streams.append(parser)
+        return parser
+
+    def add(self, nbytes):
+        """Count `nbytes` (possibly a negative correction) transferred"""
+        self.bytes_transferred.increment(nbytes)
+        with self._lock:
+            self._pending += nbytes
+            if time.time() - self._posted >= self.interval:
+                self._post()
+
+    def flush(self, complete=True):
+        """Settle the files still in flight and post any bytes not yet
+        posted to the progress queue. The files in flight only go in the
+        manifest if the transfer is `complete`."""
+        with self._lock:
+            streams = list(self._streams)
+        for parser in streams:
+            parser.settle(complete)
+        with self._lock:
+            self._post()
+
+    def _post(self):
+        if self.progress is not None and self._pending:
+            self.progress.put(self._pending)
+        self._pending = 0
+        self._posted = time.time()
+
+
+class _OutputParser(object):
+    """Parses the output of one rsync run with `--progress` and
+    `--out-format='%l %M %n'` (or `'%l %M %C %n'`).
+
+    rsync logs each file's line (its length, mtime and name) before
+    transferring it, then redraws a progress line as the file's data
+    arrives. Bytes are counted as progress lines arrive, so large files show
+    progress while they transfer. When the next file's line arrives, the
+    previous file is settled: the count is corrected to its logged length,
+    which also counts entries without progress lines such as directories,
+    and the file is added to the manifest.
+
+    With the checksum (`%C`) in the out-format, rsync logs each file's line
+    after transferring it instead, and prints just the file's name before its
+    progress lines. Progress is then counted against the file so named, and
+    its logged line settles it.
+    """
+
+    def __init__(self, status, prefix=b''):
+        self.status = status
+        self.prefix = prefix
+        # rsync logs the line of a file only once it knows its checksum
+        self.after = status.checksum
+        self._length = None
+        self._file = None
+        self._name = None
+        self._seen = 0
+
+    def __call__(self, line):
+        try:
+            length, mtime, name, digest = _parse_file_line(
+                line, self.status.checksum
+            )
+        except RSyncOutputParseError:
+            try:
+                seen = _parse_progress_line(line)
+            except RSyncOutputParseError as err:
+                if self.after:
+                    # the name of the file about to be transferred
+                    self.settle(False)
+                    self._name = line
+                    return
+                LOGGER.debug("Failed to parse bytes transeferred: %s", err)
+                return
+
+            self.status.add(seen - self._seen)
+            self._seen = seen
+            return
+
+        entry = self._entry(name, length, mtime, digest)
+        if self.after:
+            if name == self._name:
+                self.status.add(length - self._seen)
+                self._name = None
+                self._seen = 0
+            else:
+                # an entry without progress lines, e.g. a directory
+                self.status.add(length)
+            if entry is not None:
+                self.status.files.append(entry)
+            return
+
+        self.settle()
+        self._length = length
+        self._file = entry
+
+    def _entry(self, name, length, mtime, digest):
+        """Manifest entry of a logged file, None for a directory"""
+        if name.endswith(b'/'):
+            return None
+        if name.startswith(self.prefix):
+            name = name[len(self.prefix):]
+        return (name.decode("utf-8", "replace"), length, mtime, digest)
+
+    def settle(self, arrived=True):
+        """Correct the count for the current file to its logged length and,
+        if it `arrived`, add it to the manifest"""
+        if self._length is not None:
+            self.status.add(self._length - self._seen)
+        if arrived and self._file is not None:
+            self.status.files.append(self._file)
+        self._length = None
+        self._file = None
+        self._name = None
+        self._seen = 0
+
+
+def _shard(entries, shards):
+    """Partition a directory listing into `shards` size balanced lists of
+    paths. Directories all go in the first shard so they are created once."""
+    dirs = [name for kind, _, _, name in entries if kind == b'd']
+    files = [(name, size) for kind, size, _, name in entries if kind != b'd']
+
+    bins = partition(files, shards, key=lambda f: f[1])
+    bins[0] = [(d, 0) for d in dirs] + bins[0]
+
+    return [[name for name, _ in b] for b in bins if b]
+
+
 def _transfer_worker(src, dest, stop, host=None, port=22, user=None,
-                     keypath=None, partial=False, compress=False, retry=0,
-                     progress=None):
+                     keypath=None, partial=PARTIAL_DIR, compress=False,
+                     retry=0, progress=None, shards=1, ssh_options=None,
+                     governor=None, arrived=None, checksum=False):
     """Transfer function executed on worker processes
 
     Parameters
@@ -111,9 +642,11 @@ def _transfer_worker(src, dest, stop, host=None, port=22, user=None,
         SSH user name
     keypath: str, optional
         Path to private key
-    partial: bool, optional
-        Flag to enable partial uploads (default is True). This flag is passed
-        to rsync as `--partial`.
+    partial: str or bool, optional
+        Hidden directory, relative to each destination directory, to keep
+        partially transferred files in so a later attempt resumes them
+        (passed to rsync as `--partial-dir`). True keeps them in place
+        (`--partial`), False discards them. Default is PARTIAL_DIR.
     compress: bool, optional
         Enable compression of data prior to transfer (default is False). This
         flag is passed to rsync as `-z`.
@@ -122,76 +655,286 @@ def _transfer_worker(src, dest, stop, host=None, port=22, user=None,
         option to SSH.
     progress: Queue, optional
         Multiprocessing queues on which to post updates of bytes transferred.
+    shards: int, optional
+        Number of concurrent rsync streams to split a directory `src` across
+        (default is 1).
+    ssh_options: str, optional
+        Extra options for ssh, e.g. to share a multiplexed master connection.
+    governor: asynchy.bandwidth.BandwidthGovernor, optional
+        Governor to take a share of the bandwidth budget from for the
+        duration of the transfer.
+    arrived: dict, optional
+        Size and modification time of each file (by path relative to `src`)
+        that arrived in an earlier attempt. Only the other files of a
+        directory `src`, and those that changed since, are transferred.
+    checksum: bool, optional
+        Record the checksum the sender computed of each file in the manifest
+        (default is False). Requires rsync 3.2 on both ends.
 
     Returns
     -------
-    result: Success((src, dest, bytes_transferred)) or Failure(exc)
-        If the transfer succeeds the src, dest and total bytes transferred will
-        be return wrapped in a Success instance. If the transfer fails, a
-        Failure instance will be returned, which contains the exception that
-        was raised.
+    result: Success((src, dest, bytes_transferred, files)) or Failure(exc)
+        If the transfer succeeds the src, dest, total bytes transferred and
+        manifest of files that arrived will be return wrapped in a Success
+        instance. If the transfer fails, a Failure instance will be returned,
+        which contains the exception that was raised, with the manifest of
+        files that did arrive as its `files` attribute.
 
     See Also
     --------
     asynchy.utils.Try: Class that encapsulates the notion of a computation that
         could succeed or fail.
     """
-    cmd = _rsync_command(src, dest, host=host, port=port, user=user,
-                         keypath=keypath, retry=retry)
-    bytes_transferred = AtomicCounter()
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            shell=True,
-                            preexec_fn=RSyncTransfer._subprocess_init)
+    # rsync names the files of a directory src after its basename
+    status = _StatusUpdater(progress, prefix=os.path.basename(
+        os.path.normpath(src)).encode("utf-8") + b'/', checksum=checksum)
+    opts = dict(host=host, port=port, user=user, keypath=keypath,
+                partial=partial, compress=compress, retry=retry,
+                ssh_options=ssh_options, checksum=checksum)
 
-    def _update_status(stream, prog, bt):
-        p = 0
-        for i, line in enumerate(iter(stream.readline, b'')):
-            try:
-                bts = _parse_byte_number(line)
-                bt.increment(bts)
-                p += bts
+    share = None
+    if governor is not None:
+        acquired, share = governor.acquire(stop)
+        if not acquired:
+            return Failure(TransferCancelledError(
+                "Transfer cancel signal received"
+            ))
+    try:
+        if shards > 1 or arrived:
+            if share is not None:
+                opts['bwlimit'] = max(1, share // shards)
+            result = _sharded_transfer(src, dest, stop, opts, shards, status,
+                                       arrived)
+        else:
+            opts['bwlimit'] = share
+            result = _rsync(_rsync_command(src, dest, **opts), src, stop,
+                            status)
+    finally:
+        if governor is not None:
+            governor.release(share)
 
-                # update progress every 50 iterations
-                if i % 50 == 0 and prog is not None:
-                    prog.put(p)
-                    p = 0
+    return _with_manifest(result, src, dest, status)
 
-            except RSyncOutputParseError as err:
-                LOGGER.debug("Failed to parse bytes transeferred: %s",
-                             err)
 
-    thread = threading.Thread(target=_update_status,
-                              args=(proc.stdout, progress, bytes_transferred))
-    thread.daemon = True
-    thread.start()
+def _with_manifest(result, src, dest, status):
+    """The TransferResult of an rsync `result`, or its failure, carrying the
+    manifest of files that arrived"""
+    status.flush(isinstance(result, Success))
+    if isinstance(result, Failure):
+        result.failure.files = status.files
+        return result
+    return Success(TransferResult(src, dest, status.bytes_transferred.value,
+                                  status.files))
 
-    while proc.poll() is None:
-        if stop.is_set():
-            proc.terminate()
-            return Failure(TransferCancelledError(
-                "Transfer cancel signal received"
-            ))
-        # time.sleep(0.2)
 
-    thread.join()
-    rc = proc.returncode
-    if rc != 0:
-        _, err = proc.communicate()
+def _missing(entries, arrived):
+    """Entries of a directory listing that are not among the files that
+    `arrived` (path -> (size, mtime)) with the same size and modification
+    time. Directories are kept so they are created."""
+    return [entry for entry in entries if entry[0] == b'd' or
+            arrived.get(entry[3].decode("utf-8", "replace")) !=
+            (entry[1], int(entry[2]))]
 
-        return Failure(TransferFailedError(
-            "Rsync transfer for \"{}\" "
-            "failed with the following code: {}\n"
-            "Error: {}"
-            "See Rsync 'man' page for an explanation.\n"
-            .format(src, rc, err.decode("utf-8"))
+
+def _sharded_transfer(src, dest, stop, opts, shards, status, arrived=None):
+    """Split the directory `src` into `shards` size balanced sets of files
+    and transfer them concurrently with one rsync per set. Files that
+    `arrived` in an earlier attempt, with the same size and modification
+    time, are left out.
+
+    Returns
+    -------
+    Success(None) or Failure(exc)
+        The first failure among the shards, if any.
+    """
+    listing = _list_files(src, stop, host=opts['host'], port=opts['port'],
+                          user=opts['user'], keypath=opts['keypath'],
+                          retry=opts['retry'],
+                          ssh_options=opts['ssh_options'])
+    if isinstance(listing, Failure):
+        return listing
+    entries = listing.get_or_raise()
+    if arrived:
+        missing = _missing(entries, arrived)
+        LOGGER.info("Resuming %s: %d of %d entries still to transfer",
+                    src, len(missing), len(entries))
+        entries = missing
+
+    # create the destination up front so the shards do not race to do so
+    shard_dest = os.path.join(dest, os.path.basename(os.path.normpath(src)))
+    if not os.path.isdir(shard_dest):
+        os.makedirs(shard_dest)
+
+    paths = []
+    results = []
+    threads = []
+    try:
+        for names in _shard(entries, shards):
+            fd, path = tempfile.mkstemp(prefix="asynchy-shard-")
+            with os.fdopen(fd, "wb") as files_from:
+                files_from.write(b'\0'.join(names))
+            paths.append(path)
+
+            cmd = _rsync_command(src.rstrip('/') + '/', shard_dest,
+                                 files_from=path, **opts)
+            thread = threading.Thread(
+                target=lambda c, out: results.append(_rsync(c, src, stop,
+                                                            out)),
+                args=(cmd, status.stream())
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        LOGGER.debug("Transferring %s in %d shards", src, len(threads))
+        for thread in threads:
+            thread.join()
+    finally:
+        for path in paths:
+            os.remove(path)
+
+    failures = [r for r in results if isinstance(r, Failure)]
+    return failures[0] if failures else Success(None)
+
+
+# State each pool worker is initialised with, see `_init_worker`
+_worker = threading.local()
+
+
+class _SlotProgress(object):
+    """Progress "queue" that adds the bytes put to it to one slot of a
+    shared array. Each worker owns a slot, so there are no writers to race
+    with and no locking or IPC; the parent sums the slots."""
+
+    def __init__(self, slots, index):
+        self.slots = slots
+        self.index = index
+
+    def put(self, nbytes):
+        self.slots[self.index] += nbytes
+
+
+class _FirstByte(object):
+    """Progress wrapper recording when a transfer first reported bytes"""
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.time = None
+
+    def put(self, nbytes):
+        if self.time is None:
+            self.time = time.time()
+        self.progress.put(nbytes)
+
+
+def _alive(pid):
+    """Whether the process `pid` is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def _take_slot(owners):
+    """Claim a progress slot no running worker writes to, returning its index
+
+    `owners` is a shared array of the pid of the worker owning each slot, 0
+    if none does. The slot of a worker that died is free again. Workers of
+    a thread pool share a pid, but are never replaced.
+    """
+    pid = os.getpid()
+    with owners.get_lock():
+        owned = owners[:]
+        free = [i for i, owner in enumerate(owned)
+                if owner == 0 or (owner != pid and not _alive(owner))]
+        if not free:
+            # a worker replacing one that died was given its pid
+            free = [i for i, owner in enumerate(owned) if owner == pid]
+        owners[free[0]] = pid
+    return free[0]
+
+
+def _init_worker(cancel, slots, owners, governor=None, hosts=None):
+    """Pool initializer giving each worker the shared cancel flag, a progress
+    slot of its own (see `_take_slot`), the bandwidth governor and the pool
+    of hosts to balance transfers across.
+
+    Workers inherit these rather than receiving them with every task:
+    shared memory and locks cannot be pickled to process pools.
+    """
+    index = _take_slot(owners)
+    _worker.cancel = cancel
+    _worker.progress = _SlotProgress(slots, index)
+    _worker.governor = governor
+    _worker.hosts = hosts
+
+
+def _outcome(result):
+    """Whether a transfer result counts as a success of its host (None if it
+    says nothing about the host) and the bytes it transferred. Only
+    transient failures, e.g. dropped connections, count against the host."""
+    if isinstance(result, Success):
+        return True, result.success.bytes_transferred
+    if isinstance(result, Failure) and (
+            isinstance(result.failure, TransferCancelledError) or
+            classify(result.failure) != TRANSIENT):
+        return None, 0
+    return False, 0
+
+
+def _on_host(func, src, dest, kwargs):
+    """Run the transfer function `func` on a pool worker set up by
+    `_init_worker`. If the worker balances several hosts, the transfer runs
+    against the least loaded healthy one and its outcome is recorded.
+
+    `kwargs` may map host names to their ssh options as `host_options`.
+    """
+    kwargs = dict(kwargs)
+    host_options = kwargs.pop('host_options', None)
+    hosts = _worker.hosts
+    if hosts is None:
+        return func(src, dest, _worker.cancel, progress=_worker.progress,
+                    **kwargs)
+
+    index = hosts.acquire(_worker.cancel)
+    if index is None:
+        return Failure(TransferCancelledError(
+            "Transfer cancel signal received"
         ))
-    return Success(TransferResult(src, dest, bytes_transferred.value))
+
+    kwargs['host'] = hosts.names[index]
+    if host_options is not None:
+        kwargs['ssh_options'] = host_options.get(kwargs['host'])
+    progress = _FirstByte(_worker.progress)
+    start = time.time()
+    result = None
+    try:
+        result = func(src, dest, _worker.cancel, progress=progress, **kwargs)
+        return result
+    finally:
+        succeeded, nbytes = _outcome(result)
+        hosts.release(index, succeeded, nbytes, time.time() - start,
+                      None if progress.time is None
+                      else progress.time - start)
+
+
+def _pool_transfer_worker(src, dest, kwargs):
+    """`_transfer_worker` run on a pool worker set up by `_init_worker`"""
+    return _on_host(_transfer_worker, src, dest,
+                    dict(kwargs, governor=_worker.governor))
 
 
 class RSyncTransfer(Transfer):
     """Transfer files by shelling out to Rsync
 
+    Workers report progress into per-worker slots of a shared memory array
+    and check a shared cancel flag, so neither costs an IPC round trip. A
+    thread in the parent sums the slots into the `progress` queue at most
+    every PROGRESS_INTERVAL seconds and whenever a transfer completes.
+
+    The pool and the progress thread are only started by the first transfer.
+
     Attributes
     ----------
     host: str
@@ -202,28 +945,57 @@ class RSyncTransfer(Transfer):
         Path to private key
     port: int, optional
         Port to connect on. Default is 22.
-    partial: bool, optional
-        Flag to enable partial uploads (default is True). This flag is passed
-        to rsync as `--partial`.
+    partial: str or bool, optional
+        Hidden directory, relative to each destination directory, to keep
+        partially transferred files in so a later attempt resumes them
+        (passed to rsync as `--partial-dir`). True keeps them in place
+        (`--partial`), False discards them. Default is PARTIAL_DIR.
     compress: bool, optional
         Enable compression of data prior to transfer (default is False). This
         flag is passed to rsync as `-z`.
     retry: int, optional
         Number of SSH connect retries. Passed as retry + 1 ConnectionAttempts
         option to SSH.
-    pool: multiprocessing.pool.Pool, optional
-        Pool of processes that back this Transerrer. Default is a pool
-        with n processes, where n is equal to number of CPUs.
+    processes: int, optional
+        Number of workers in the pool that backs this Transferrer. Default is
+        the number of CPUs.
+    parallel: bool, optional
+        Use worker processes rather than threads (default is True).
+    shard_threshold: int, optional
+        EPNs whose expected size (bytes) is at least this are split across
+        `shards` concurrent rsync streams. Default is None, i.e. never split.
+    shards: int, optional
+        Number of concurrent rsync streams used for EPNs above
+        `shard_threshold`. Default is 4.
+    multiplex: bool, optional
+        Share one persistent SSH master connection to the host between all
+        transfers (default is True).
+    bandwidth: asynchy.bandwidth.Schedule, optional
+        Schedule of the total rate to share between all transfers. Default
+        is None, i.e. unlimited.
+    hosts: list of (str, int), optional
+        Mirrors serving the same data and the maximum number of concurrent
+        transfers on each. Each transfer runs against the least loaded
+        healthy one rather than `host`. Default is None.
+    checksum: bool, optional
+        Record the checksum the sender computed of each file in the manifest
+        of each transfer, for `asynchy.verify` to check the received files
+        against (default is False). Requires rsync 3.2 on both ends.
 
     See Also
     --------
     multiprocessing.Pool : Python process pool
+    asynchy.hosts.HostPool : Load balancing across mirrors
+    asynchy.ssh.SSHMaster : Multiplexed SSH master connection
     """
 
     _instance = None
+    _rsync_found = None
 
-    def __new__(cls, host, user, keypath, port=22, partial=False,
-                compress=False, retry=0, pool=Pool(processes=cpu_count())):
+    def __new__(cls, host, user, keypath, port=22, partial=PARTIAL_DIR,
+                compress=False, retry=0, processes=cpu_count(),
+                parallel=True, shard_threshold=None, shards=4,
+                multiplex=True, bandwidth=None, hosts=None, checksum=False):
         """Create a single instance of RSyncTransfer object backed by
         a multiprocessing pool. We do this to prevent creation of lots
         of processing Pools.
@@ -234,24 +1006,38 @@ class RSyncTransfer(Transfer):
                 " and make sure it is present in your path"
             )
         if RSyncTransfer._instance is None:
-            RSyncTransfer._instance = object.__new__(cls)
-            RSyncTransfer._instance.pool = pool
-            RSyncTransfer._instance.manager = SyncManager()
-            # init Manager
-            RSyncTransfer._instance.manager.start(
-                RSyncTransfer._subprocess_init
-            )
-            RSyncTransfer._instance._progress =\
-                RSyncTransfer._instance.manager.Queue()
-            RSyncTransfer._instance.host = host
-            RSyncTransfer._instance.user = user
-            RSyncTransfer._instance.keypath = keypath
-            RSyncTransfer._instance.port = port
-            RSyncTransfer._instance.partial = partial
-            RSyncTransfer._instance.compress = compress
-            RSyncTransfer._instance.retry = retry
-            RSyncTransfer._instance._cancel =\
-                RSyncTransfer._instance.manager.Event()
+            instance = object.__new__(cls)
+            instance.host = host
+            instance.user = user
+            instance.keypath = keypath
+            instance.port = port
+            instance.partial = partial
+            instance.compress = compress
+            instance.retry = retry
+            instance.shard_threshold = shard_threshold
+            instance.shards = shards
+            instance.hosts = hosts
+            instance.checksum = checksum
+            instance.host_pool = None
+            instance.masters = {}
+            if multiplex and all([user, keypath]):
+                for name in set([host] + [h for h, _ in hosts or []]):
+                    if name:
+                        instance.masters[name] = SSHMaster(
+                            name, user, keypath, port=port, retry=retry
+                        )
+            instance.master = instance.masters.get(host)
+
+            instance.processes = processes
+            instance.parallel = parallel
+            instance.bandwidth = bandwidth
+            instance._pool = None
+            instance._pool_lock = threading.Lock()
+            instance._progress = queue.Queue()
+            instance._collected = 0
+            instance._collect_lock = threading.Lock()
+
+            RSyncTransfer._instance = instance
 
         return RSyncTransfer._instance
 
@@ -260,43 +1046,160 @@ class RSyncTransfer(Transfer):
         """Are we py3?"""
         return sys.version_info >= (3, 0)
 
-    @staticmethod
-    def _subprocess_init():
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-
     @classmethod
     def _check_rsync(cls):
-        exist = subprocess.call('command -v rsync >> /dev/null', shell=True)
-        return 0 == exist
+        if cls._rsync_found is None:
+            cls._rsync_found = which("rsync") is not None
+        return cls._rsync_found
+
+    @property
+    def pool(self):
+        """The pool of workers, started on first use"""
+        with self._pool_lock:
+            if self._pool is None:
+                self._start()
+        return self._pool
+
+    def _start(self):
+        self._cancel = multiprocessing.Event()
+        self._slots = multiprocessing.RawArray('q', self.processes)
+        self.governor = None
+        if self.bandwidth is not None:
+            # every worker of the pool may be transferring at once
+            self.governor = BandwidthGovernor(
+                self.bandwidth, self.processes, lock=multiprocessing.Lock(),
+                counters=multiprocessing.RawArray('q', COUNTERS)
+            )
+
+        if self.hosts:
+            self.host_pool = HostPool(
+                self.hosts, lock=multiprocessing.Lock(),
+                stats=multiprocessing.RawArray('d',
+                                               HostPool.size(self.hosts))
+            )
 
-    def transfer(self, src, dest, callback):
+        initargs = (self._cancel, self._slots,
+                    multiprocessing.Array('i', self.processes),
+                    self.governor, self.host_pool)
+        if self.parallel:
+            # disable default interrupt handlers for Pool processes
+            default_int_handler = signal.signal(signal.SIGINT,
+                                                signal.SIG_IGN)
+            try:
+                self._pool = multiprocessing.pool.Pool(
+                    processes=self.processes, initializer=_init_worker,
+                    initargs=initargs
+                )
+            finally:
+                signal.signal(signal.SIGINT, default_int_handler)
+        else:
+            self._pool = multiprocessing.dummy.Pool(
+                processes=self.processes, initializer=_init_worker,
+                initargs=initargs
+            )
+
+        poller = threading.Thread(target=self._poll_progress,
+                                  name="asynchy-progress")
+        poller.daemon = True
+        poller.start()
+
+    def _collect(self):
+        """Post the bytes workers have reported since the last collection"""
+        with self._collect_lock:
+            total = sum(self._slots)
+            delta = total - self._collected
+            self._collected = total
+        if delta:
+            self._progress.put(delta)
+
+    def _poll_progress(self):
+        while not self._cancel.wait(PROGRESS_INTERVAL):
+            self._collect()
+        self._collect()
+
+    def _completion(self, callback):
+        """Wrap `callback` to collect a transfer's last progress first"""
+        def done(result):
+            self._collect()
+            callback(result)
+        return done
+
+    def _shards_for(self, size):
+        """Number of rsync streams to use for an EPN of `size` bytes"""
+        if (self.shard_threshold is not None and size is not None and
+                size >= self.shard_threshold):
+            return self.shards
+        return 1
+
+    def _ssh_options(self, host=None):
+        """Extra ssh options for workers, making sure the shared master
+        connection to `host` (default `self.host`) is up if we multiplex"""
+        master = self.masters.get(self.host if host is None else host)
+        if master is None:
+            return None
+
+        master.ensure()
+        return master.options()
+
+    def _host_options(self):
+        """ssh options for each of `hosts`, if we balance across several"""
+        if not self.hosts:
+            return None
+        return dict((name, self._ssh_options(name)) for name, _ in self.hosts)
+
+    def _kwargs(self, shards=1, arrived=None):
+        return dict(host=self.host, port=self.port, user=self.user,
+                    keypath=self.keypath, partial=self.partial,
+                    compress=self.compress, retry=self.retry, shards=shards,
+                    ssh_options=self._ssh_options(),
+                    host_options=self._host_options(), arrived=arrived,
+                    checksum=self.checksum)
+
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
         return self.pool.apply_async(
-            _transfer_worker,
-            (src, dest, self._cancel, self.host, self.port, self.user,
-             self.keypath, self.partial, self.compress, self.retry,
-             self._progress),
-            callback=callback
+            _pool_transfer_worker,
+            (src, dest, self._kwargs(self._shards_for(size), arrived)),
+            callback=self._completion(callback),
+            error_callback=self._completion(
+                lambda exc: callback(Failure(exc))
+            )
         )
 
     def transfer_batch(self, srcs, dest, callback):
-        args = [(src, dest, self._cancel, self.host, self.port,
-                 self.user, self.keypath, self.partial, self.compress,
-                 self.retry, self._progress)
-                for src in srcs]
+        kwargs = self._kwargs()
         return self.pool.starmap_async(
-            _transfer_worker,
-            args,
-            callback=callback
+            _pool_transfer_worker,
+            [(src, dest, kwargs) for src in srcs],
+            callback=self._completion(callback),
+            error_callback=self._completion(
+                lambda exc: callback([Failure(exc)])
+            )
         )
 
     def progress(self):
-        return self._instance._progress
+        return self._progress
 
     def cancel(self):
-        self._cancel.set()
-        self.pool.close()
-        # self.pool.join()
-        # self._progress.join()
-        self.manager.shutdown()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._cancel.set()
+                self._pool.close()
+        self.close()
+        if self.host_pool is not None:
+            for host in self.host_pool.stats():
+                LOGGER.info(
+                    "%s: %d transfers, latency %.2f s, throughput %.2f "
+                    "MiB/s%s", host['host'], host['transfers'],
+                    host['latency'], host['throughput'] / 1024 ** 2,
+                    "" if host['healthy'] else ", out of rotation"
+                )
 
         return True
+
+    def close(self):
+        """Stop the shared SSH master connections, which otherwise outlive
+        the run by their ControlPersist. They are started again if more
+        transfers are made."""
+        for master in self.masters.values():
+            master.stop()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Scheduling policies that decide the order in which EPNs are transferred.
+
+Each policy maps to an SQL ``ORDER BY`` clause over the ``epns`` table so
+that pending EPNs can still be streamed straight from the database. Because
+transfers are dispatched to whichever worker frees up first, transferring in
+order of decreasing size is the longest-processing-time-first (LPT) greedy
+rule for packing EPNs across workers: a huge EPN starts early rather than
+leaving every other worker idle while it finishes last.
+"""
+
+import heapq
+import time
+
+from .db import as_timestamp
+
+
+MODIFIED = "modified"
+LPT = "lpt"
+SMALLEST = "smallest"
+HYBRID = "hybrid"
+
+POLICIES = (MODIFIED, LPT, SMALLEST, HYBRID)
+"""Available scheduling policies
+
+modified
+    Transfer EPNs by modification date, in the requested order.
+lpt
+    Longest-processing-time first: largest EPNs first, which minimises the
+    time to finish a batch across several workers.
+smallest
+    Smallest EPNs first, which maximises the number of EPNs completed per
+    hour.
+hybrid
+    Smallest first, but an EPN's effective size is discounted as it ages so
+    large EPNs are not postponed indefinitely. EPNs older than `max_age` are
+    transferred first, oldest first.
+"""
+
+# Age (seconds) over which the hybrid policy halves an EPN's effective size
+AGING_PERIOD = 7 * 24 * 3600
+
+# Age (seconds) after which the hybrid policy schedules an EPN ahead of all
+# others
+MAX_AGE = 30 * 24 * 3600
+
+
+class UnknownPolicyError(Exception):
+    """Raised when an unknown scheduling policy is requested"""
+    pass
+
+
+def order_by(policy, order="ASC", now=None, aging_period=AGING_PERIOD,
+             max_age=MAX_AGE):
+    """Build the ORDER BY clause for a scheduling policy
+
+    Parameters
+    ----------
+    policy: str
+        One of `POLICIES`.
+    order: str, optional
+        "ASC" or "DESC". Only used by the `modified` policy.
+    now: float, optional
+        Current time as a UNIX timestamp. Defaults to `time.time()`.
+    aging_period: float, optional
+        Age (seconds) over which the `hybrid` policy halves an EPN's
+        effective size.
+    max_age: float, optional
+        Age (seconds) after which the `hybrid` policy schedules an EPN first.
+
+    Returns
+    -------
+    clause: str
+        ORDER BY clause.
+    params: tuple
+        Parameters to bind to the placeholders in `clause`.
+
+    Raises
+    ------
+    UnknownPolicyError
+        If `policy` is not one of `POLICIES`.
+    """
+    if policy == MODIFIED:
+        if order.upper() not in ("ASC", "DESC"):
+            raise ValueError("Order must be ASC or DESC, not {}".format(order))
+        return "ORDER BY modified {}".format(order.upper()), ()
+    if policy == LPT:
+        return "ORDER BY size DESC", ()
+    if policy == SMALLEST:
+        return "ORDER BY size ASC", ()
+    if policy == HYBRID:
+        now = time.time() if now is None else now
+        starved = now - max_age
+        return (
+            '''ORDER BY
+                   CASE WHEN {0} <= ? THEN 0 ELSE 1 END,
+                   CASE WHEN {0} <= ? THEN {0}
+                        ELSE size / (1.0 + MAX(? - {0}, 0) / ?)
+                   END'''.format(as_timestamp("modified")),
+            (starved, starved, now, float(aging_period))
+        )
+
+    raise UnknownPolicyError(
+        "Unknown scheduling policy '{}'. Choose one of: {}"
+        .format(policy, ", ".join(POLICIES))
+    )
+
+
+def partition(items, bins, key):
+    """Pack `items` into `bins` lists of roughly equal total `key` using the
+    longest-processing-time-first rule: take items largest first and add
+    each to the bin with the smallest total so far.
+
+    Parameters
+    ----------
+    items: iterable
+        Items to partition.
+    bins: int
+        Number of bins.
+    key: func
+        Single argument function returning the size of an item.
+
+    Returns
+    -------
+    [list]
+        `bins` lists of items. Some may be empty if there are fewer items
+        than bins.
+
+    Examples
+    --------
+    >>> partition([5, 4, 3, 3, 3], 2, key=lambda x: x)
+    [[5, 3], [4, 3, 3]]
+    """
+    result = [[] for _ in range(bins)]
+    heap = [(0, i) for i in range(bins)]
+    for item in sorted(items, key=key, reverse=True):
+        total, i = heapq.heappop(heap)
+        result[i].append(item)
+        heapq.heappush(heap, (total + key(item), i))
+
+    return result
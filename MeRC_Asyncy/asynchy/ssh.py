@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent multiplexed SSH connections.
+
+Every rsync run over SSH normally performs a full SSH handshake. For
+thousands of small EPNs the handshake costs about as much as the data and
+trips the remote's connection rate limits. An `SSHMaster` keeps one master
+connection per host open (OpenSSH ControlMaster) that every rsync shares
+through its control socket.
+"""
+
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SSHMaster(object):
+    """Multiplexed master SSH connection to a single host
+
+    Clients connect with `options`, which use ``ControlMaster=auto``: if the
+    master has died, the next client to connect becomes the new master and,
+    thanks to ``ControlPersist``, stays in the background for the others.
+    `ensure` additionally re-creates a dead master from the parent process.
+
+    Attributes
+    ----------
+    host: str
+        Remote SSH host name
+    user: str
+        SSH user name
+    keypath: str
+        Path to private key
+    port: int, optional
+        Port to connect on. Default is 22.
+    retry: int, optional
+        Number of SSH connect retries. Passed as retry + 1 ConnectionAttempts
+        option to SSH.
+    persist: int, optional
+        Seconds the master stays open after its last client disconnects.
+        Default is 600.
+    check_interval: float, optional
+        Minimum seconds between checks that the master is alive. Default
+        is 30.
+    """
+
+    def __init__(self, host, user, keypath, port=22, retry=0, persist=600,
+                 check_interval=30):
+        self.host = host
+        self.user = user
+        self.keypath = keypath
+        self.port = port
+        self.retry = retry
+        self.persist = persist
+        self.check_interval = check_interval
+        self._dir = None
+        self._checked = None
+        self._lock = threading.RLock()
+
+    @property
+    def control_path(self):
+        """Path of the control socket, in a directory created on first use
+        and removed by `stop`"""
+        with self._lock:
+            if self._dir is None:
+                # keep the socket path short, unix sockets are limited to
+                # ~100 chars
+                self._dir = tempfile.mkdtemp(prefix="asynchy-ssh-")
+            return self._dir + "/%C"
+
+    def options(self):
+        """SSH options for clients sharing this master"""
+        return "-o\"ControlMaster=auto\" -o\"ControlPath={}\" "\
+            "-o\"ControlPersist={}\"".format(self.control_path, self.persist)
+
+    def _ssh(self, *args):
+        cmd = ["ssh", "-p", str(self.port), "-i", self.keypath,
+               "-o", "BatchMode=yes",
+               "-o", "ConnectionAttempts={}".format(self.retry + 1),
+               "-o", "ControlPath={}".format(self.control_path)]
+        cmd.extend(args)
+        cmd.append("{}@{}".format(self.user, self.host))
+        return cmd
+
+    def check(self):
+        """Whether the master connection is alive"""
+        return subprocess.call(self._ssh("-O", "check"),
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+
+    def start(self):
+        """Open the master connection in the background
+
+        Returns
+        -------
+        bool
+            Whether the master was started.
+        """
+        # the backgrounded master inherits stderr, so don't wait on a pipe
+        with tempfile.TemporaryFile() as err:
+            rc = subprocess.call(
+                self._ssh("-M", "-N", "-f",
+                          "-o", "ControlPersist={}".format(self.persist)),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=err
+            )
+            if rc != 0:
+                err.seek(0)
+                LOGGER.warning("Failed to start SSH master for %s: %s",
+                               self.host, err.read().decode("utf-8").strip())
+                return False
+
+        LOGGER.debug("Started SSH master for %s", self.host)
+        return True
+
+    def ensure(self):
+        """Start the master if it is not running. Checks at most every
+        `check_interval` seconds, so it is cheap to call before every
+        transfer."""
+        with self._lock:
+            now = time.time()
+            if self._checked is not None and \
+                    now - self._checked < self.check_interval:
+                return
+            self._checked = now
+
+            if not self.check():
+                LOGGER.info("SSH master for %s is not running, starting it",
+                            self.host)
+                self.start()
+
+    def stop(self):
+        """Close the master connection and remove its control socket. The
+        master can be started again."""
+        with self._lock:
+            if self._dir is None:
+                return
+            subprocess.call(self._ssh("-O", "exit"),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+            self._checked = None
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""Transfer EPNs with huge numbers of small files as a single tar stream.
+
+rsync's per-file overhead dominates when an EPN holds hundreds of thousands
+of small files. `TarTransfer` instead runs ``tar -c`` on the source (over SSH
+for a remote host) and pipes the archive straight into ``tar -x`` at the
+destination, so the whole directory moves as one stream and nothing is
+staged on disk.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from multiprocessing.dummy import Pool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .retry import PARTIAL, PERMANENT, TRANSIENT
+from .rsync import _ignore_sigint, _wait_for_exit, _read_stream, _on_host
+from .transfer import (
+    Transfer,
+    TransferCancelledError,
+    TransferFailedError,
+    TransferResult
+)
+from .utils import Success, Failure
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Exit code of GNU tar when files changed as they were archived, like
+# rsync's 24
+_TAR_CHANGED = 1
+
+# Exit code of ssh when it fails to connect
+_SSH_FAILED = 255
+
+# Size of the chunks copied from the source to the destination tar
+CHUNK_SIZE = 1024 * 1024
+
+# Minimum time (seconds) between progress updates
+PROGRESS_INTERVAL = 0.5
+
+
+def _tar_command(src, host=None, port=22, user=None, keypath=None,
+                 retry=0, ssh_options=None):
+    """Build the command that writes `src` as a tar archive to stdout"""
+    src = os.path.normpath(src)
+    tar = "tar -C {} -cf - {}".format(
+        quote(os.path.dirname(src) or "."), quote(os.path.basename(src))
+    )
+    if not all([host, user, keypath]):
+        return tar
+
+    return "ssh -p {} -i {} -o BatchMode=yes -o ConnectionAttempts={} {}"\
+        "{}@{} {}".format(quote(str(port)), quote(keypath),
+                          quote(str(retry + 1)),
+                          ssh_options + " " if ssh_options else "",
+                          quote(user), quote(host), quote(tar))
+
+
+def _pump(src, dst, progress, counter):
+    """Copy the archive from `src` to `dst` counting the bytes and posting
+    them to `progress` at most every PROGRESS_INTERVAL seconds"""
+    pending = 0
+    last = 0
+    try:
+        for chunk in iter(lambda: os.read(src.fileno(), CHUNK_SIZE), b''):
+            dst.write(chunk)
+            counter[0] += len(chunk)
+            pending += len(chunk)
+            if progress is not None and time.time() - last >= \
+                    PROGRESS_INTERVAL:
+                progress.put(pending)
+                pending = 0
+                last = time.time()
+    except (IOError, OSError) as err:
+        # the extracting tar went away, its exit status tells us why
+        LOGGER.debug("Tar stream interrupted: %s", err)
+    finally:
+        for stream in (dst, src):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        if progress is not None and pending:
+            progress.put(pending)
+
+
+def _classify(archiving, returncode):
+    """Classify the failure of the tar archiving the source if `archiving`,
+    else of the one extracting it, like `asynchy.retry.classify`"""
+    if not archiving:
+        # writing to the destination failed, e.g. its disk is full
+        return TRANSIENT
+    if returncode < 0 or returncode == _SSH_FAILED:
+        return TRANSIENT
+    if returncode == _TAR_CHANGED:
+        return PARTIAL
+    return PERMANENT
+
+
+def _tar_worker(src, dest, stop, host=None, port=22, user=None,
+                keypath=None, retry=0, progress=None, ssh_options=None):
+    """Transfer function executed on worker processes
+
+    Parameters
+    ----------
+    src: str
+        Source directory. It is recreated, with its contents, inside dest.
+    dest: str
+        Base destination path.
+    stop: threading.Event
+        An event to signal that the process should be cancelled.
+    host: str, optional
+        Remote SSH host name. If not given, src is a local path.
+    port: int, optional
+        Port to connect on.
+    user: str, optional
+        SSH user name
+    keypath: str, optional
+        Path to private key
+    retry: int, optional
+        Number of SSH connect retries. Passed as retry + 1 ConnectionAttempts
+        option to SSH.
+    progress: Queue, optional
+        Queue on which to post updates of bytes transferred.
+    ssh_options: str, optional
+        Extra options for ssh, e.g. to share a multiplexed master connection.
+
+    Returns
+    -------
+    result: Success((src, dest, bytes_transferred)) or Failure(exc)
+        The bytes transferred are the size of the tar stream, which includes
+        a small per-file header overhead.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    reader = subprocess.Popen(
+        _tar_command(src, host, port, user, keypath, retry, ssh_options),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+        preexec_fn=_ignore_sigint
+    )
+    writer = subprocess.Popen(
+        ["tar", "-C", dest, "-xf", "-"],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+        preexec_fn=_ignore_sigint
+    )
+
+    counter = [0]
+    errors = ([], [])
+    threads = [
+        threading.Thread(target=_pump,
+                         args=(reader.stdout, writer.stdin, progress,
+                               counter)),
+        threading.Thread(target=_read_stream, args=(reader.stderr,
+                                                    errors[0])),
+        threading.Thread(target=_read_stream, args=(writer.stderr,
+                                                    errors[1])),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    if not (_wait_for_exit(reader, stop) and _wait_for_exit(writer, stop)):
+        for proc in (reader, writer):
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        return Failure(TransferCancelledError(
+            "Transfer cancel signal received"
+        ))
+
+    for thread in threads:
+        thread.join()
+
+    for proc, err, side in ((writer, errors[1], "extracting"),
+                            (reader, errors[0], "archiving")):
+        if proc.returncode != 0:
+            return Failure(TransferFailedError(
+                "Tar transfer for \"{}\" failed {} with the following "
+                "code: {}\nError: {}"
+                .format(src, side, proc.returncode,
+                        b''.join(err).decode("utf-8")), proc.returncode,
+                _classify(proc is reader, proc.returncode)
+            ))
+
+    return Success(TransferResult(src, dest, counter[0]))
+
+
+def _pool_tar_worker(src, dest, kwargs):
+    """`_tar_worker` run on a pool worker set up by
+    `asynchy.rsync._init_worker`"""
+    return _on_host(_tar_worker, src, dest, kwargs)
+
+
+class TarTransfer(Transfer):
+    """Transfer directories as a single tar stream over SSH
+
+    Can share the pool, progress, cancellation and SSH master connection of
+    an `asynchy.rsync.RSyncTransfer`, so that both report into the same
+    progress queue.
+
+    Attributes
+    ----------
+    host: str
+        Remote SSH host name. If None, sources are local paths.
+    user: str
+        SSH user name
+    keypath: str
+        Path to private key
+    port: int, optional
+        Port to connect on. Default is 22.
+    retry: int, optional
+        Number of SSH connect retries. Passed as retry + 1 ConnectionAttempts
+        option to SSH.
+    progress_queue: Queue, optional
+        Queue to post bytes transferred to when not sharing an
+        `RSyncTransfer`. Default is a new queue.
+    share_with: asynchy.rsync.RSyncTransfer, optional
+        Run transfers on the pool of this `RSyncTransfer`, sharing its
+        progress, cancellation and SSH master connection. Default is to run
+        them on a thread pool of 4 threads.
+    """
+
+    def __init__(self, host=None, user=None, keypath=None, port=22,
+                 retry=0, progress_queue=None, share_with=None):
+        self.host = host
+        self.user = user
+        self.keypath = keypath
+        self.port = port
+        self.retry = retry
+        self._shared = share_with
+        self._pool = None
+        if share_with is None:
+            self._progress = queue.Queue() if progress_queue is None \
+                else progress_queue
+            self._cancel = threading.Event()
+        else:
+            self._progress = share_with.progress()
+            self._cancel = None
+
+    @property
+    def pool(self):
+        """The pool that runs transfers, started on first use"""
+        if self._shared is not None:
+            return self._shared.pool
+        if self._pool is None:
+            self._pool = Pool(processes=4)
+        return self._pool
+
+    def _kwargs(self):
+        kwargs = dict(host=self.host, port=self.port, user=self.user,
+                      keypath=self.keypath, retry=self.retry,
+                      ssh_options=None)
+        if self._shared is not None:
+            kwargs.update(ssh_options=self._shared._ssh_options(self.host),
+                          host_options=self._shared._host_options())
+        return kwargs
+
+    def _task(self, src, dest, kwargs):
+        """Pool function and arguments transferring `src`"""
+        if self._shared is None:
+            return _tar_worker, (src, dest, self._cancel, self.host,
+                                 self.port, self.user, self.keypath,
+                                 self.retry, self._progress,
+                                 kwargs['ssh_options'])
+        return _pool_tar_worker, (src, dest, kwargs)
+
+    def _completion(self, callback):
+        if self._shared is None:
+            return callback
+        return self._shared._completion(callback)
+
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
+        func, args = self._task(src, dest, self._kwargs())
+        return self.pool.apply_async(
+            func, args,
+            callback=self._completion(callback),
+            error_callback=self._completion(
+                lambda exc: callback(Failure(exc))
+            )
+        )
+
+    def transfer_batch(self, srcs, dest, callback):
+        kwargs = self._kwargs()
+        tasks = [self._task(src, dest, kwargs) for src in srcs]
+        func = tasks[0][0] if tasks else _tar_worker
+        return self.pool.starmap_async(
+            func, [args for _, args in tasks],
+            callback=self._completion(callback),
+            error_callback=self._completion(
+                lambda exc: callback([Failure(exc)])
+            )
+        )
+
+    def progress(self):
+        return self._progress
+
+    def cancel(self):
+        if self._shared is not None:
+            # the RSyncTransfer we share with owns the pool and cancel flag
+            return True
+
+        self._cancel.set()
+        if self._pool is not None:
+            self._pool.close()
+
+        return True
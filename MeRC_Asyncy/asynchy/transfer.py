@@ -11,7 +11,30 @@ class TransferCancelledError(Exception):
 
 
 class TransferFailedError(Exception):
-    """Raised when a transfer fails"""
+    """Raised when a transfer fails
+
+    Attributes
+    ----------
+    returncode: int or None
+        Exit code of the process that failed, None if it did not run.
+    kind: str or None
+        How the failure is classified (see `asynchy.retry.classify`), None
+        to classify it by `returncode` as an rsync exit code.
+    files: list of (str, int, int, str)
+        Manifest of the files that arrived before the failure, if the
+        transfer keeps one (see `TransferResult`).
+    """
+
+    def __init__(self, message, returncode=None, kind=None):
+        super(TransferFailedError, self).__init__(message)
+        self.returncode = returncode
+        self.kind = kind
+
+    def __reduce__(self):
+        # keep the return code, kind (and manifest) when results are pickled
+        # from pool workers
+        return (self.__class__, (self.args[0], self.returncode),
+                self.__dict__)
 
 
 class Transfer(object):
@@ -20,7 +43,8 @@ class Transfer(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def transfer(self, src, dest, callback):
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
         """Transfer from file/directory from src to dest
 
         Parameters
@@ -39,6 +63,17 @@ class Transfer(object):
             exception, the result will be the exception wrapped in a `Failure`.
             Note: there are no guarantees that the number of bytes transferred
             is accurate -- the requirement for implementors is best effort.
+        size: int, optional
+            Expected size of src in bytes, if known. Implementors may use it
+            to decide how to transfer src, e.g. splitting large transfers
+            across several streams.
+        file_count: int, optional
+            Expected number of files in src, if known.
+        arrived: dict, optional
+            Size and modification time of each file of src (by path
+            relative to src) that arrived in an earlier attempt, see
+            `asynchy.db.read_manifest`. Implementors may skip these files
+            if they are unchanged at src.
 
         Returns
         -------
@@ -105,6 +140,12 @@ class Transfer(object):
         """
         pass
 
+    def close(self):
+        """Release what is kept between transfers, e.g. SSH connections,
+        once no more transfers will be made. Does nothing by default.
+        """
+        pass
+
     @abstractmethod
     def progress(self):
         """Returns a multiprocessing.Queue where a deltas for the number of
@@ -124,8 +165,77 @@ class Transfer(object):
         pass
 
 
+class RoutingTransfer(Transfer):
+    """Transfer that dispatches each transfer to one of several transfer
+    methods based on the expected size and file count of the source.
+
+    The transfers should share a progress queue; `progress` returns the
+    default transfer's.
+
+    Attributes
+    ----------
+    default: Transfer
+        Transfer used when no route matches.
+    routes: [(func, Transfer)]
+        Pairs of predicate and transfer. The first transfer whose predicate,
+        called with the `size` and `file_count` hints, returns True is used.
+
+    Examples
+    --------
+    Stream EPNs whose files average less than 64 KiB as a tar archive:
+
+    >>> routing = RoutingTransfer(rsync, [(small_files(64 * 1024), tar)])
+    """
+
+    def __init__(self, default, routes):
+        self.default = default
+        self.routes = routes
+
+    def route(self, size=None, file_count=None):
+        """The transfer to use for a source with the given hints"""
+        for matches, transfer in self.routes:
+            if matches(size, file_count):
+                return transfer
+        return self.default
+
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
+        return self.route(size, file_count).transfer(
+            src, dest, callback, size=size, file_count=file_count,
+            arrived=arrived
+        )
+
+    def transfer_batch(self, srcs, dest, callback):
+        return self.default.transfer_batch(srcs, dest, callback)
+
+    def cancel(self):
+        cancelled = [t.cancel() for _, t in self.routes]
+        return self.default.cancel() and all(cancelled)
+
+    def close(self):
+        for _, transfer in self.routes:
+            transfer.close()
+        self.default.close()
+
+    def progress(self):
+        return self.default.progress()
+
+
+def small_files(mean_size):
+    """Route predicate matching sources whose mean file size is below
+    `mean_size` bytes, i.e. whose file count divided by size is above
+    1 / `mean_size`"""
+    def matches(size, file_count):
+        if not size or not file_count:
+            return False
+        return float(file_count) / size > 1.0 / mean_size
+
+    return matches
+
+
 TransferResult = namedtuple('TransferResult',
-                            ['src', 'dest', 'bytes_transferred'])
+                            ['src', 'dest', 'bytes_transferred', 'files'])
+TransferResult.__new__.__defaults__ = (None,)
 """Type to represent successful transfer results.
 
 Attributes
@@ -136,4 +246,8 @@ dest: str
     Destination file or dir path
 bytes_transferred: int
     Total number of bytes transferred for this file or dir
+files: list of (str, int, int, str), optional
+    Manifest of the files that arrived: path relative to src, size,
+    modification time and checksum the sender computed (None if unknown).
+    None if the transfer does not keep one.
 """
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+"""Verify that the files received match the files that were sent.
+
+rsync exiting successfully is the only evidence that an EPN arrived intact.
+Verification checks that every file of the EPN at the source, listed with
+``rsync --list-only``, was received with the same size and hashes the
+received files against the checksums in the manifest recorded as they
+arrived, where the transfer recorded them (see the `checksum` option of
+`asynchy.rsync.RSyncTransfer`).
+
+Without a source listing, the manifest is all there is to check against.
+rsync only logs the files it sends, not those already up to date, and tar
+transfers log none, so an EPN is then only verified if its manifest holds
+as many files as `asynchy walk` counted in it.
+
+Hashing is spread over a pool of processes, each reading its files in large
+chunks so it is bound by I/O rather than by Python. Digests are cached in
+the checksums table, keyed by the file's device and inode and valid while
+its size and modification time are unchanged, so verifying the same files
+again only reads those that changed.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from .asynchy import _get_dest_path
+from .db import DB_TIMEOUT, ensure_schema
+from .rsync import CHECKSUM, _ignore_sigint, _list_files
+from .utils import Failure
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Hash algorithm, the one rsync is asked to log checksums with
+ALGORITHM = CHECKSUM
+
+# Size of the reads hashing a file
+CHUNK_SIZE = 4 * 1024 * 1024
+
+_CACHED_SQL = '''SELECT size, mtime_ns, algorithm, digest FROM checksums
+                 WHERE device = ? AND inode = ?'''
+
+_CACHE_SQL = '''INSERT OR REPLACE INTO checksums
+                    (device, inode, size, mtime_ns, algorithm, digest)
+                VALUES (?, ?, ?, ?, ?, ?)'''
+
+_UNCACHE_SQL = '''DELETE FROM checksums WHERE device = ? AND inode = ?'''
+
+
+Verification = namedtuple('Verification', ['epn', 'files', 'hashed',
+                                           'cached', 'unchecked', 'missing',
+                                           'mismatched', 'incomplete'])
+"""Outcome of verifying an EPN.
+
+Attributes
+----------
+epn: str
+    The EPN.
+files: int
+    Number of files expected: listed at the source, or in its manifest.
+hashed: int
+    Number of files read and hashed.
+cached: int
+    Number of files whose digest was cached.
+unchecked: int
+    Number of files whose size matches but that have no checksum recorded
+    to compare against.
+missing: list of str
+    Paths (relative to the EPN) of files that are not there.
+mismatched: list of str
+    Paths (relative to the EPN) of files whose size or digest differs.
+incomplete: bool
+    Whether the files expected are not known to be all the EPN's files: the
+    source could not be listed, or its manifest is empty or holds fewer
+    files than were walked. Such an EPN is never marked verified.
+"""
+
+
+def hash_file(path, algorithm=ALGORITHM, chunk_size=CHUNK_SIZE):
+    """Hex digest of the file at `path`
+
+    The file is read into a single reused buffer of `chunk_size` bytes, so
+    hashing a large file neither allocates per read nor holds the file in
+    memory.
+
+    Parameters
+    ----------
+    path: str
+        Path of the file.
+    algorithm: str, optional
+        Name of the hashlib algorithm. Default is ALGORITHM.
+    chunk_size: int, optional
+        Size of each read. Default is CHUNK_SIZE.
+
+    Returns
+    -------
+    str
+    """
+    digest = hashlib.new(algorithm)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as reader:
+        while True:
+            n = reader.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def _stat_key(st):
+    """(device, inode, size, mtime in ns) identifying a version of a file"""
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+
+def _hash_task(args):
+    """Hash a file on a pool worker
+
+    Returns
+    -------
+    (str, tuple, str)
+        The path, the `_stat_key` of the file that was hashed and its
+        digest. The key and digest are None if the file could not be read.
+    """
+    path, algorithm, chunk_size = args
+    try:
+        key = _stat_key(os.stat(path))
+        return path, key, hash_file(path, algorithm, chunk_size)
+    except (IOError, OSError) as err:
+        LOGGER.warning("Unable to hash %s: %s", path, err)
+        return path, None, None
+
+
+def _source_files(src, **kwargs):
+    """Size of each file under the source directory `src`, by path relative
+    to it
+
+    Returns
+    -------
+    Success(dict) or Failure(exc)
+    """
+    return _list_files(src, threading.Event(), **kwargs).map(
+        # decoded as the manifest's paths are, see `asynchy.rsync`
+        lambda entries: dict((name.decode("utf-8", "replace"), size)
+                             for kind, size, _, name in entries
+                             if kind == b'-')
+    )
+
+
+def verify_epn(conn, epn, root, pool=None, algorithm=ALGORITHM,
+               chunk_size=CHUNK_SIZE, source=None):
+    """Check the received files of `epn` against its source listing or
+    manifest
+
+    Digests computed are added to the checksums table but not committed.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the EPN database.
+    epn: str
+        The EPN.
+    root: str
+        Directory the files of the EPN were received in.
+    pool: multiprocessing.Pool, optional
+        Pool to hash the files on. Default is to hash them in this process.
+    algorithm: str, optional
+        Name of the hashlib algorithm the manifest's checksums were computed
+        with. Default is ALGORITHM.
+    chunk_size: int, optional
+        Size of each read when hashing. Default is CHUNK_SIZE.
+    source: dict, optional
+        Size of each file of the EPN at the source, by path, see
+        `_source_files`. Default is to expect the files of the manifest.
+
+    Returns
+    -------
+    Verification
+    """
+    manifest = dict(
+        (path, (size, checksum)) for path, size, checksum in conn.execute(
+            'SELECT path, size, checksum FROM files WHERE epn = ?', (epn,)
+        )
+    )
+    if source is None:
+        expected = manifest
+        row = conn.execute('SELECT file_count FROM epns WHERE epn = ?',
+                           (epn,)).fetchone()
+        file_count = None if row is None else row[0]
+        incomplete = not manifest or file_count is None or \
+            len(manifest) < file_count
+    else:
+        expected = {}
+        for path, size in source.items():
+            recorded = manifest.get(path)
+            # the checksum of an earlier version of the file is no use
+            checksum = recorded[1] if recorded and recorded[0] == size \
+                else None
+            expected[path] = (size, checksum)
+        incomplete = False
+
+    missing = []
+    mismatched = []
+    unchecked = cached = 0
+    to_hash = {}
+    for path, (size, checksum) in sorted(expected.items()):
+        local = os.path.join(root, path)
+        try:
+            key = _stat_key(os.stat(local))
+        except OSError:
+            missing.append(path)
+            continue
+
+        if key[2] != size:
+            mismatched.append(path)
+        elif checksum is None:
+            unchecked += 1
+        else:
+            row = conn.execute(_CACHED_SQL, key[:2]).fetchone()
+            if row is not None and tuple(row[:3]) == key[2:] + (algorithm,):
+                cached += 1
+                if row[3] != checksum:
+                    mismatched.append(path)
+            else:
+                to_hash[local] = (path, checksum)
+
+    tasks = [(local, algorithm, chunk_size) for local in to_hash]
+    hashed = pool.imap_unordered(_hash_task, tasks) if pool is not None \
+        else (_hash_task(task) for task in tasks)
+    rows = []
+    for local, key, digest in hashed:
+        path, checksum = to_hash[local]
+        if digest is None:
+            missing.append(path)
+            continue
+        rows.append(key + (algorithm, digest))
+        if digest != checksum:
+            mismatched.append(path)
+    conn.executemany(_CACHE_SQL, rows)
+
+    return Verification(epn, len(expected), len(rows), cached, unchecked,
+                        sorted(missing), sorted(mismatched), incomplete)
+
+
+def _repair(conn, epn, root, paths):
+    """Delete the local copies of `paths` of `epn` that are there, their
+    cached digests and manifest entries, and mark the EPN pending so the next
+    sync transfers them again"""
+    for path in paths:
+        local = os.path.join(root, path)
+        try:
+            key = _stat_key(os.stat(local))
+            conn.execute(_UNCACHE_SQL, key[:2])
+            os.remove(local)
+        except OSError:
+            pass
+        conn.execute('DELETE FROM files WHERE epn = ? AND path = ?',
+                     (epn, path))
+    conn.execute('UPDATE epns SET complete = 0, verified = NULL '
+                 'WHERE epn = ?', (epn,))
+
+
+def verify(db, dest_path, epns=None, processes=None, algorithm=ALGORITHM,
+           repair=False, src_prefix=None, host=None, user=None, keypath=None,
+           port=22, retry=0):
+    """Verify the received files of EPNs, recording when each EPN was last
+    verified
+
+    Parameters
+    ----------
+    db: str
+        Path to the EPN database.
+    dest_path: str
+        Base destination path the EPNs were transferred to.
+    epns: list of str, optional
+        EPNs to verify. Default is every complete EPN.
+    processes: int, optional
+        Number of processes hashing files. Default is the number of CPUs.
+    algorithm: str, optional
+        Name of the hashlib algorithm the manifest's checksums were computed
+        with. Default is ALGORITHM.
+    repair: bool, optional
+        Delete files that do not match the manifest and mark their EPNs
+        pending, so the next sync transfers them again (default is False).
+    src_prefix: str, optional
+        Source directory of the EPNs, listed to find every file each EPN
+        should have. Default is to check against the manifests only.
+    host: str, optional
+        Remote SSH host name. If not given, `src_prefix` is a local path.
+    user: str, optional
+        SSH user name
+    keypath: str, optional
+        Path to private key
+    port: int, optional
+        Port to connect on.
+    retry: int, optional
+        Number of SSH connect retries.
+
+    Returns
+    -------
+    list of Verification
+    """
+    conn = sqlite3.connect(db, timeout=DB_TIMEOUT)
+    ensure_schema(conn)
+    if epns is None:
+        epns = [row[0] for row in conn.execute(
+            'SELECT epn FROM epns WHERE complete = 1 ORDER BY epn'
+        )]
+
+    pool = multiprocessing.Pool(processes, initializer=_ignore_sigint)
+    results = []
+    try:
+        for epn in epns:
+            root = _get_dest_path(dest_path, epn)
+            source = None
+            if src_prefix is not None:
+                source = _source_files(
+                    os.path.join(src_prefix, epn), host=host, port=port,
+                    user=user, keypath=keypath, retry=retry
+                )
+                if isinstance(source, Failure):
+                    LOGGER.error("EPN %s not verified, unable to list its "
+                                 "source: %s", epn, source.failure)
+                    results.append(Verification(epn, 0, 0, 0, 0, [], [],
+                                                True))
+                    continue
+                source = source.get_or_raise()
+
+            with conn:
+                result = verify_epn(conn, epn, root, pool, algorithm,
+                                    source=source)
+                bad = result.missing + result.mismatched
+                if not bad and not result.incomplete:
+                    conn.execute('UPDATE epns SET verified = ? WHERE epn = ?',
+                                 (time.time(), epn))
+                elif bad and repair:
+                    _repair(conn, epn, root, bad)
+            results.append(result)
+
+            if bad:
+                LOGGER.error("EPN %s failed verification: %d files missing, "
+                             "%d differ%s: %s", epn, len(result.missing),
+                             len(result.mismatched),
+                             " (marked pending again)" if repair else "",
+                             ", ".join(bad[:10]))
+            elif result.incomplete:
+                LOGGER.warning("EPN %s not verified, its manifest may not "
+                               "list all its files (%d listed). List its "
+                               "source to verify it.", epn, result.files)
+            else:
+                LOGGER.info("EPN %s verified: %d files, %d hashed, %d "
+                            "cached, %d without checksum", epn,
+                            result.files, result.hashed, result.cached,
+                            result.unchecked)
+    finally:
+        pool.terminate()
+        pool.join()
+        conn.close()
+
+    return results
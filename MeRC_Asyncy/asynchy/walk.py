@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""Populate the EPN database by walking the remote.
+
+Each top-level directory of the remote root (e.g. ``/data``) is an EPN.
+Their listings (``rsync -r --list-only``) run concurrently on a pool of
+processes, one per directory. A listing is reduced to the EPN's size, file
+count and latest modification time as it streams in, so memory does not
+grow with the number of files however large the tree. The EPNs are written
+to the epns table in large transactions by a `asynchy.db.ResultWriter`.
+
+Walking again is incremental. The size, file count and latest modification
+time of an EPN are its fingerprint, and its directory's modification time
+is recorded alongside. A rescan only lists the EPNs whose directory changed
+(an entry was added, removed or renamed in it), or that are new, and puts
+those whose fingerprint changed back in the queue (complete = 0), so data
+that grew after it was transferred is picked up without listing the whole
+archive. Changes deeper down that leave the directory alone need a `full`
+walk.
+
+Modification times are stored as datetimes, the way AS-Walker stores them,
+so EPNs walked by either sort together.
+"""
+
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+from .db import DB_TIMEOUT, ResultWriter, ensure_schema
+from .rsync import (
+    RSyncOutputParseError,
+    _ignore_sigint,
+    _list_command,
+    _parse_list_line,
+    _rsync
+)
+from .ssh import SSHMaster
+from .utils import Failure
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of EPNs written per transaction
+BATCH_SIZE = 1000
+
+_KNOWN_SQL = '''SELECT epn, dir_mtime, size, file_count, modified
+                FROM epns'''
+
+_UPDATE_SQL = '''UPDATE epns
+                 SET size = ?, path = ?, modified = ?, file_count = ?,
+                     dir_mtime = ?
+                 WHERE epn = ?'''
+
+_INSERT_SQL = '''INSERT INTO epns
+                     (size, path, modified, file_count, dir_mtime, epn)
+                 SELECT ?, ?, ?, ?, ?, ?
+                 WHERE NOT EXISTS (SELECT 1 FROM epns WHERE epn = ?)'''
+
+# An EPN whose contents changed is transferred again from scratch: it was
+# not interrupted part way, and the manifest of its old contents would
+# have files deleted since reported missing
+_CHANGED_SQL = '''UPDATE epns
+                  SET complete = 0, attempts = 0, next_attempt = NULL,
+                      last_error = NULL, verified = NULL, started = NULL
+                  WHERE epn = ?'''
+
+_FORGET_FILES_SQL = '''DELETE FROM files WHERE epn = ?'''
+
+
+class _Tally(object):
+    """Reduces the streamed `rsync --list-only` output of an EPN to its
+    size, number of files and latest modification time
+
+    Listing lines are split but not fully parsed: ``%Y/%m/%d %H:%M:%S``
+    dates sort as strings, so only the latest is converted to a timestamp.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.files = 0
+        self.latest = None
+
+    def __call__(self, line):
+        fields = line.split(None, 4)
+        if len(fields) < 5 or fields[2][4:5] != b'/':
+            LOGGER.debug("Skipping listing line: %s", line)
+            return
+        try:
+            size = int(fields[1].replace(b',', b''))
+        except ValueError:
+            LOGGER.debug("Skipping listing line: %s", line)
+            return
+
+        stamp = fields[2] + b' ' + fields[3]
+        if self.latest is None or stamp > self.latest:
+            self.latest = stamp
+        if not fields[0].startswith(b'd'):
+            self.size += size
+            self.files += 1
+
+    @property
+    def modified(self):
+        """Latest modification time as a datetime like AS-Walker stores,
+        e.g. ``2018-06-14 10:00:00`` in local time, None if nothing was
+        listed"""
+        if self.latest is None:
+            return None
+        return self.latest.replace(b'/', b'-').decode("ascii")
+
+
+def _walk_epn(args):
+    """List the EPN directory `path` on a pool worker
+
+    Returns
+    -------
+    (str, Success((int, str, str, int)) or Failure(exc))
+        The EPN and either its size, path, latest modification time and
+        number of files, or why it could not be listed.
+    """
+    epn, path, kwargs = args
+    tally = _Tally()
+    result = _rsync(_list_command(path.rstrip('/') + '/', **kwargs), path,
+                    threading.Event(), tally)
+    return epn, result.map(
+        lambda _: (tally.size, path, tally.modified, tally.files)
+    )
+
+
+def list_epns(root, host=None, port=22, user=None, keypath=None, retry=0,
+              ssh_options=None):
+    """Names and modification times of the top-level directories of `root`
+
+    Returns
+    -------
+    list of (str, float)
+        The directories' names and modification times as UNIX timestamps,
+        by name.
+
+    Raises
+    ------
+    asynchy.transfer.TransferFailedError
+        If `root` cannot be listed.
+    """
+    names = []
+
+    def collect(line):
+        try:
+            kind, _, mtime, name = _parse_list_line(line)
+        except RSyncOutputParseError:
+            LOGGER.debug("Skipping listing line: %s", line)
+            return
+        if kind == b'd' and name != b'.':
+            names.append((name.decode("utf-8"), mtime))
+
+    cmd = _list_command(root.rstrip('/') + '/', host, port, user, keypath,
+                        retry, ssh_options, recursive=False)
+    _rsync(cmd, root, threading.Event(), collect).get_or_raise()
+    return sorted(names)
+
+
+def walk(db, root, host=None, user=None, keypath=None, port=22, retry=0,
+         processes=None, batch_size=BATCH_SIZE, multiplex=True, wal=True,
+         full=False):
+    """Add the EPNs under `root` to the database, and update those that
+    changed since they were last walked
+
+    Parameters
+    ----------
+    db: str
+        Path to the EPN database. It is created if it does not exist.
+    root: str
+        Directory whose top-level directories are EPNs, e.g. ``/data``.
+    host: str, optional
+        Remote SSH host name. If not given, `root` is a local path.
+    user: str, optional
+        SSH user name
+    keypath: str, optional
+        Path to private key
+    port: int, optional
+        Port to connect on.
+    retry: int, optional
+        Number of SSH connect retries.
+    processes: int, optional
+        Number of directories listed concurrently. Default is the number of
+        CPUs.
+    batch_size: int, optional
+        Number of EPNs written per transaction.
+    multiplex: bool, optional
+        Share one persistent SSH connection between all listings (default
+        is True).
+    wal: bool, optional
+        Switch the database to WAL mode (default is True).
+    full: bool, optional
+        List every EPN, not only those whose directory changed (default is
+        False).
+
+    Returns
+    -------
+    (int, list of str, list of str)
+        Number of EPNs listed, the EPNs walked before whose fingerprint
+        changed and the EPNs that could not be listed.
+    """
+    conn = sqlite3.connect(db, timeout=DB_TIMEOUT)
+    try:
+        ensure_schema(conn)
+        known = dict((row[0], row[1:]) for row in conn.execute(_KNOWN_SQL))
+    finally:
+        conn.close()
+
+    master = None
+    if multiplex and all([host, user, keypath]):
+        master = SSHMaster(host, user, keypath, port=port, retry=retry)
+        master.ensure()
+    kwargs = dict(host=host, port=port, user=user, keypath=keypath,
+                  retry=retry,
+                  ssh_options=None if master is None else master.options())
+
+    # start the workers before the writer thread, so that none is forked
+    # while the writer holds a lock
+    pool = multiprocessing.Pool(processes, initializer=_ignore_sigint)
+    # the writer counts statements, two per EPN
+    writer = ResultWriter(db, batch_size=2 * batch_size, wal=wal)
+    writer.start()
+    written = 0
+    changed = []
+    failed = []
+    try:
+        epns = list_epns(root, **kwargs)
+        dir_mtimes = dict(epns)
+        todo = [epn for epn, mtime in epns
+                if full or epn not in known or known[epn][0] != mtime]
+        LOGGER.info("Walking %d of %d EPNs under %s, the others are "
+                    "unchanged", len(todo), len(epns), root)
+
+        tasks = [(epn, os.path.join(root, epn), kwargs) for epn in todo]
+        for epn, result in pool.imap_unordered(_walk_epn, tasks):
+            if isinstance(result, Failure):
+                LOGGER.error("Unable to walk EPN %s: %s", epn,
+                             result.failure)
+                failed.append(epn)
+                continue
+            size, path, modified, files = result.success
+            row = (size, path, modified, files, dir_mtimes[epn], epn)
+            writer.execute(_UPDATE_SQL, row)
+            writer.execute(_INSERT_SQL, row + (epn,))
+
+            # EPNs only recorded by AS-Walker have no fingerprint to compare
+            old = known.get(epn)
+            if old is not None and old[0] is not None and \
+                    tuple(old[1:]) != (size, files, modified):
+                LOGGER.info("EPN %s changed, queueing it again", epn)
+                writer.execute(_CHANGED_SQL, (epn,))
+                writer.execute(_FORGET_FILES_SQL, (epn,))
+                changed.append(epn)
+
+            written += 1
+            if written % batch_size == 0:
+                LOGGER.info("Walked %d of %d EPNs", written, len(todo))
+    finally:
+        pool.terminate()
+        pool.join()
+        writer.close()
+        if master is not None:
+            master.stop()
+
+    return written, changed, failed
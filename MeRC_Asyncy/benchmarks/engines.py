@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Measure the Python-side cost of each concurrent transfer per engine.
+
+rsync is replaced by a stub that sleeps, so only the overhead of the engine
+babysitting its children is measured. For each engine, N transfers are kept
+in flight and we report, per concurrent transfer, the threads and Python
+processes used, the resident memory they add and the CPU they burn while
+the transfers run.
+
+Usage::
+
+    python benchmarks/engines.py [--transfers 100] [--window 3]
+
+Linux only (reads /proc).
+"""
+
+import argparse
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ENGINES = ("threads", "processes", "asyncio")
+
+STUB = "#!/bin/sh\nexec sleep 3600\n"
+
+
+def _proc_stat(pid):
+    """(ppid, cpu seconds, rss bytes, threads, comm) of a process"""
+    with open("/proc/{}/stat".format(pid)) as f:
+        data = f.read()
+    comm = data[data.index("(") + 1:data.rindex(")")]
+    fields = data[data.rindex(")") + 2:].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks,
+            int(fields[21]) * os.sysconf("SC_PAGE_SIZE"), int(fields[17]),
+            comm)
+
+
+def _python_processes():
+    """Stats of this process and its Python descendants (i.e. excluding
+    the rsync stubs)"""
+    procs = {}
+    for pid in os.listdir("/proc"):
+        if pid.isdigit():
+            try:
+                procs[int(pid)] = _proc_stat(pid)
+            except (IOError, OSError, ValueError):
+                pass
+
+    family = set([os.getpid()])
+    changed = True
+    while changed:
+        changed = False
+        for pid, st in procs.items():
+            if pid not in family and st[0] in family:
+                family.add(pid)
+                changed = True
+
+    return [procs[pid] for pid in family
+            if pid in procs and procs[pid][4].startswith("python")]
+
+
+def _sample():
+    procs = _python_processes()
+    return (len(procs), sum(p[3] for p in procs), sum(p[2] for p in procs),
+            sum(p[1] for p in procs))
+
+
+def _engine(name, transfers):
+    if name == "asyncio":
+        from asynchy.aiorsync import AsyncRSyncTransfer
+        return AsyncRSyncTransfer(None, None, None, concurrency=transfers)
+
+    from asynchy.rsync import RSyncTransfer
+    return RSyncTransfer(None, None, None, processes=transfers,
+                         parallel=name == "processes")
+
+
+def run(name, transfers, window):
+    """Run one engine and print its per transfer overhead"""
+    src, dest = tempfile.mkdtemp(), tempfile.mkdtemp()
+    base = _sample()
+    engine = _engine(name, transfers)
+
+    for _ in range(transfers):
+        engine.transfer(src, dest, lambda result: None)
+    time.sleep(1)
+    busy = _sample()
+    time.sleep(window)
+    end = _sample()
+
+    start = time.time()
+    engine.cancel()
+    cancel = time.time() - start
+
+    n = float(transfers)
+    print("{:<10} {:>8.2f} {:>10.2f} {:>12.1f} {:>14.3f} {:>10.2f}".format(
+        name, (busy[1] - base[1]) / n, (busy[0] - base[0]) / n,
+        (busy[2] - base[2]) / n / 1024, (end[3] - busy[3]) / window / n * 1000,
+        cancel
+    ))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--transfers", type=int, default=100,
+                        help="Number of concurrent transfers")
+    parser.add_argument("--window", type=float, default=3,
+                        help="Seconds over which CPU use is measured")
+    parser.add_argument("--engine", choices=ENGINES,
+                        help="Run a single engine (used internally)")
+    args = parser.parse_args()
+
+    if args.engine:
+        return run(args.engine, args.transfers, args.window)
+
+    # put the sleeping rsync stub first on the PATH of each engine's run
+    stubs = tempfile.mkdtemp()
+    stub = os.path.join(stubs, "rsync")
+    with open(stub, "w") as f:
+        f.write(STUB)
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+    env = dict(os.environ, PATH=stubs + os.pathsep + os.environ["PATH"])
+
+    print("{} concurrent transfers, per transfer:".format(args.transfers))
+    print("{:<10} {:>8} {:>10} {:>12} {:>14} {:>10}".format(
+        "engine", "threads", "processes", "RSS (KiB)", "CPU (ms/s)",
+        "cancel (s)"
+    ))
+    for engine in ENGINES:
+        subprocess.check_call(
+            [sys.executable, __file__, "--engine", engine,
+             "--transfers", str(args.transfers),
+             "--window", str(args.window)],
+            env=env, cwd=os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)))
+        )
+
+
+if __name__ == "__main__":
+    threading.current_thread().name = "benchmark"
+    main()
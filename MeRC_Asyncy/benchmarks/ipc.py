@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Measure the cost of the progress and cancel checks made by pool workers.
+
+Compares the `SyncManager` proxies `RSyncTransfer` used to share with its
+workers (a managed Queue for progress and a managed Event for cancellation)
+with the shared memory it uses now (a slot per worker in a shared array and
+a `multiprocessing.Event`). Each worker process times `--ops` cancel checks
+and progress updates; we report the mean cost per operation.
+
+Usage::
+
+    python benchmarks/ipc.py [--workers 4] [--ops 20000]
+"""
+
+import argparse
+import multiprocessing
+import time
+
+from multiprocessing.managers import SyncManager
+
+from asynchy.rsync import _SlotProgress, _take_slot
+
+_state = {}
+
+
+def _init(cancel, progress):
+    _state['cancel'] = cancel
+    _state['progress'] = progress
+
+
+def _init_slot(cancel, slots, owners):
+    _init(cancel, _SlotProgress(slots, _take_slot(owners)))
+
+
+def _work(ops):
+    """Seconds per cancel check and per progress update"""
+    cancel, progress = _state['cancel'], _state['progress']
+
+    start = time.time()
+    for _ in range(ops):
+        cancel.is_set()
+    checks = time.time() - start
+
+    start = time.time()
+    for _ in range(ops):
+        progress.put(1)
+    puts = time.time() - start
+
+    return checks / ops, puts / ops
+
+
+def _run(pool, workers, ops):
+    results = pool.map(_work, [ops] * workers, chunksize=1)
+    pool.close()
+    pool.join()
+    return (sum(r[0] for r in results) / workers,
+            sum(r[1] for r in results) / workers)
+
+
+def manager(workers, ops):
+    mgr = SyncManager()
+    mgr.start()
+    try:
+        progress = mgr.Queue()
+        pool = multiprocessing.Pool(workers, initializer=_init,
+                                    initargs=(mgr.Event(), progress))
+        result = _run(pool, workers, ops)
+        drained = 0
+        while not progress.empty():
+            drained += progress.get()
+        assert drained == workers * ops
+        return result
+    finally:
+        mgr.shutdown()
+
+
+def shared_memory(workers, ops):
+    slots = multiprocessing.RawArray('q', workers)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_slot,
+        initargs=(multiprocessing.Event(), slots,
+                  multiprocessing.Array('i', workers))
+    )
+    result = _run(pool, workers, ops)
+    assert sum(slots) == workers * ops
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of worker processes")
+    parser.add_argument("--ops", type=int, default=20000,
+                        help="Operations timed per worker")
+    args = parser.parse_args()
+
+    print("{} workers, {} operations each, per operation:".format(
+        args.workers, args.ops))
+    print("{:<15} {:>18} {:>18}".format(
+        "", "cancel check (us)", "progress put (us)"))
+    for name, run in (("SyncManager", manager),
+                      ("shared memory", shared_memory)):
+        check, put = run(args.workers, args.ops)
+        print("{:<15} {:>18.3f} {:>18.3f}".format(
+            name, check * 1e6, put * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Measure the startup time of the asynchy CLI.
+
+Runs each command line in a fresh interpreter `--runs` times and reports
+the fastest and median wall clock time, and the number of child processes
+left behind by importing the CLI (a pool forked at import time shows up
+here).
+
+Usage::
+
+    python benchmarks/startup.py [--runs 10]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+COMMANDS = (
+    ["--help"],
+    ["init", "--help"],
+    ["sync", "--help"],
+    ["serve", "--help"],
+    ["verify", "--help"],
+    ["walk", "--help"],
+    ["merge-db", "--help"],
+)
+
+RUN = "import sys; from asynchy.cli.base import cli; cli(sys.argv[1:])"
+
+COUNT_CHILDREN = """
+import os
+import asynchy.cli.base
+me = str(os.getpid())
+children = 0
+for pid in os.listdir("/proc"):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        continue
+    if stat[stat.rindex(")") + 2:].split()[1] == me:
+        children += 1
+print(children)
+"""
+
+
+def _time(args, runs, cwd):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", RUN] + args, cwd=cwd,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def _time_python(cwd):
+    start = time.time()
+    subprocess.check_call([sys.executable, "-c", "pass"], cwd=cwd)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Runs of each command")
+    args = parser.parse_args()
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    baseline = min(_time_python(cwd) for _ in range(args.runs))
+    print("python startup: {:.3f} s".format(baseline))
+    print("{:<20} {:>10} {:>10}".format("asynchy", "min (s)", "median (s)"))
+    for command in COMMANDS:
+        fastest, median = _time(command, args.runs, cwd)
+        print("{:<20} {:>10.3f} {:>10.3f}".format(
+            " ".join(command), fastest, median))
+
+    if os.path.isdir("/proc"):
+        children = subprocess.check_output(
+            [sys.executable, "-c", COUNT_CHILDREN], cwd=cwd
+        ).decode("ascii").strip()
+        print("child processes after import: {}".format(children))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.aiorsync`."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from asynchy import aiorsync
+from asynchy.transfer import TransferCancelledError
+
+
+class SleepTransfer(aiorsync.AsyncRSyncTransfer):
+    """Runs `sleep` instead of rsync"""
+
+    def _command(self, src, dest, bwlimit=None):
+        return ["sleep", src]
+
+
+class TestAsyncRSync(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        self.text = b"Hello world! Hello world!"
+        with open(os.path.join(self.src, "hello"), "wb") as f:
+            f.write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def test_transfer(self):
+        transfer = aiorsync.AsyncRSyncTransfer(None, None, None)
+        results = []
+        done = threading.Event()
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        result = transfer.transfer(self.src, self.dest, callback)
+        self.assertTrue(done.wait(10))
+        self.assertTrue(result.ready())
+        self.assertEqual(results[0].get_or_raise().src, self.src)
+
+        with open(os.path.join(self.dest, os.path.basename(self.src),
+                               "hello"), "rb") as f:
+            self.assertEqual(f.read(), self.text)
+
+    def test_concurrency_and_cancel(self):
+        transfer = SleepTransfer(None, None, None, concurrency=2)
+        results = []
+        results_lock = threading.Lock()
+        done = threading.Event()
+
+        def callback(result):
+            with results_lock:
+                results.append(result)
+                if len(results) == 4:
+                    done.set()
+
+        pending = [transfer.transfer("30", self.dest, callback)
+                   for _ in range(4)]
+        time.sleep(0.2)
+        self.assertEqual(transfer._active, 2)
+
+        start = time.time()
+        self.assertTrue(transfer.cancel())
+        self.assertLess(time.time() - start, 1.0)
+
+        for result in pending:
+            self.assertRaises(TransferCancelledError,
+                              result.get(5).get_or_raise)
+        self.assertTrue(done.wait(5))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.bandwidth`."""
+
+import datetime
+import threading
+import unittest
+
+import multiprocessing
+
+from asynchy import bandwidth
+from asynchy.bandwidth import BandwidthGovernor, Schedule
+
+
+class FixedSchedule(Schedule):
+
+    def __init__(self, rate):
+        Schedule.__init__(self)
+        self.current = rate
+
+    def rate(self, when=None):
+        return self.current
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = Schedule.from_config({
+            "default": None,
+            "windows": [
+                {"days": "mon-fri", "start": "08:00", "end": "18:00",
+                 "rate": 1000},
+                # unquoted 12:00 in YAML
+                {"days": "sat,sun", "start": 720, "end": "24:00",
+                 "rate": 5000},
+            ]
+        })
+
+    def test_rate(self):
+        # 2024-01-01 was a Monday
+        monday = datetime.datetime(2024, 1, 1)
+        self.assertEqual(self.schedule.rate(monday.replace(hour=9)), 1000)
+        self.assertIsNone(self.schedule.rate(monday.replace(hour=18)))
+        self.assertIsNone(self.schedule.rate(monday.replace(hour=7)))
+
+        saturday = datetime.datetime(2024, 1, 6)
+        self.assertIsNone(self.schedule.rate(saturday.replace(hour=9)))
+        self.assertEqual(self.schedule.rate(saturday.replace(hour=23)), 5000)
+
+    def test_parse_days(self):
+        self.assertEqual(bandwidth._parse_days("fri-mon"),
+                         frozenset([4, 5, 6, 0]))
+        self.assertEqual(bandwidth._parse_days("*"), frozenset(range(7)))
+        self.assertRaises(bandwidth.InvalidScheduleError,
+                          bandwidth._parse_days, "someday")
+
+    def test_invalid_window(self):
+        self.assertRaises(bandwidth.InvalidScheduleError,
+                          Schedule.from_config,
+                          {"windows": [{"start": "22:00", "end": "06:00",
+                                        "rate": 10}]})
+
+
+class TestBandwidthGovernor(unittest.TestCase):
+
+    def test_shares_never_exceed_budget(self):
+        governor = BandwidthGovernor(FixedSchedule(1000), 4)
+        shares = [governor.acquire()[1] for _ in range(4)]
+        self.assertEqual(shares, [250, 250, 250, 250])
+
+        # freed budget goes to the next transfer
+        governor.release(shares.pop())
+        governor.release(shares.pop())
+        self.assertEqual(governor.acquire()[1], 250)
+
+    def test_rebalances_when_budget_rises(self):
+        schedule = FixedSchedule(1000)
+        governor = BandwidthGovernor(schedule, 4)
+        self.assertEqual(governor.acquire()[1], 250)
+
+        # e.g. business hours end: later transfers split the new headroom
+        schedule.current = 4000
+        self.assertEqual(governor.acquire()[1], 1250)
+        self.assertEqual(governor.acquire()[1], 1250)
+        self.assertEqual(governor.acquire()[1], 1250)
+
+    def test_waits_for_headroom_when_budget_drops(self):
+        schedule = FixedSchedule(1000)
+        governor = BandwidthGovernor(schedule, 2)
+        share = governor.acquire()[1]
+        self.assertEqual(share, 500)
+
+        schedule.current = 400
+        self.assertEqual(governor.try_acquire(), (False, None))
+
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(governor.acquire(stop, interval=0.01),
+                         (False, None))
+
+        governor.release(share)
+        self.assertEqual(governor.acquire()[1], 200)
+
+    def test_unlimited(self):
+        governor = BandwidthGovernor(FixedSchedule(None), 2)
+        self.assertEqual(governor.acquire(), (True, None))
+        governor.release(None)
+
+    def test_waits_for_uncapped_transfers_when_capped(self):
+        schedule = FixedSchedule(None)
+        governor = BandwidthGovernor(schedule, 2)
+        self.assertEqual(governor.acquire(), (True, None))
+
+        # a capped window begins while the uncapped transfer still runs
+        schedule.current = 1000
+        self.assertEqual(governor.try_acquire(), (False, None))
+
+        governor.release(None)
+        self.assertEqual(governor.acquire(), (True, 500))
+
+    def test_shared_memory(self):
+        governor = BandwidthGovernor(
+            FixedSchedule(900), 3, lock=multiprocessing.Lock(),
+            counters=multiprocessing.RawArray('q', bandwidth.COUNTERS)
+        )
+        self.assertEqual(governor.acquire(), (True, 300))
+        self.assertEqual(governor.acquire(), (True, 300))
+        governor.release(300)
+        self.assertEqual(governor.try_acquire(), (True, 300))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.control`."""
+
+import unittest
+
+from asynchy.control import AIMDController
+
+
+class TestAIMDController(unittest.TestCase):
+
+    def run_interval(self, controller, now, throughput):
+        controller.observe(throughput * controller.interval, now=now)
+        return controller.update(now=now + controller.interval)
+
+    def test_no_decision_before_interval(self):
+        controller = AIMDController(1, 8, initial=2, interval=10)
+        controller.observe(100, now=0)
+        self.assertEqual(controller.update(now=5), 2)
+
+    def test_climbs_while_throughput_improves(self):
+        controller = AIMDController(1, 4, interval=10)
+        limits = [self.run_interval(controller, i * 10, (i + 1) * 100)
+                  for i in range(5)]
+        self.assertEqual(limits, [2, 3, 4, 4, 4])
+
+    def test_halves_when_throughput_drops(self):
+        controller = AIMDController(1, 16, initial=8, interval=10)
+        self.run_interval(controller, 0, 1000)
+        self.assertEqual(controller.limit, 9)
+        self.assertEqual(self.run_interval(controller, 10, 500), 4)
+
+    def test_reverts_increase_that_does_not_help(self):
+        controller = AIMDController(1, 16, initial=4, interval=10)
+        self.run_interval(controller, 0, 1000)
+        self.assertEqual(controller.limit, 5)
+        self.assertEqual(self.run_interval(controller, 10, 1010), 4)
+        # then probes upwards again
+        self.assertEqual(self.run_interval(controller, 20, 1000), 5)
+
+    def test_stays_within_bounds(self):
+        controller = AIMDController(2, 16, initial=3, interval=10)
+        self.run_interval(controller, 0, 1000)
+        self.assertEqual(self.run_interval(controller, 10, 10), 2)
+        self.assertRaises(ValueError, AIMDController, 4, 2)
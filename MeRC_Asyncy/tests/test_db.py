@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.db`."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from asynchy import asynchy, db, scheduling
+from tests.test_main import create_db, walker_datetime
+
+
+class TestResultWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        create_db(self.db, [("epn{}".format(i), i, i) for i in range(100)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_group_commit(self):
+        writer = db.ResultWriter(self.db, batch_size=40, interval=60)
+        writer.start()
+        for i in range(100):
+            writer.complete("epn{}".format(i), i)
+        writer.close()
+
+        # two full batches plus the remainder flushed on close
+        self.assertEqual(writer.rows, 100)
+        self.assertEqual(writer.commits, 3)
+        self.assertGreaterEqual(writer.max_latency, writer.mean_latency)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal'
+        )
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*), SUM(bytesTransferred) FROM epns '
+                         'WHERE complete = 1').fetchone(),
+            (100, sum(range(100)))
+        )
+        conn.close()
+
+    def test_wal_switched_off(self):
+        for wal, mode in [(True, 'wal'), (False, 'delete')]:
+            writer = db.ResultWriter(self.db, wal=wal)
+            writer.start()
+            writer.complete("epn1", 1)
+            writer.close()
+
+            conn = sqlite3.connect(self.db)
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], mode
+            )
+            conn.close()
+
+    def test_flush_on_interval(self):
+        writer = db.ResultWriter(self.db, batch_size=1000, interval=0.05)
+        writer.start()
+        writer.complete("epn1", 1)
+        writer.join(0.5)
+        self.assertEqual(writer.rows, 1)
+        writer.close()
+
+    def test_flush_blocks_until_committed(self):
+        writer = db.ResultWriter(self.db, batch_size=1000, interval=60)
+        writer.start()
+        writer.complete("epn1", 1)
+        writer.flush()
+        self.assertEqual((writer.rows, writer.commits), (1, 1))
+        writer.close()
+
+    def test_manifest(self):
+        conn = sqlite3.connect(self.db)
+        db.ensure_schema(conn)
+        writer = db.ResultWriter(self.db, interval=60)
+        writer.start()
+        writer.manifest("epn1", [(u"a", 10, 100, None),
+                                 (u"dir/b", 20, 200, u"0" * 32)])
+        writer.manifest("epn1", [(u"a", 11, 101, None)])
+        writer.manifest("epn2", [])
+        writer.close()
+
+        self.assertEqual(db.read_manifest(conn, "epn1"),
+                         {u"a": (11, 101), u"dir/b": (20, 200)})
+        self.assertEqual(db.read_manifest(conn, "epn2"), {})
+        self.assertEqual(
+            conn.execute("SELECT checksum FROM files WHERE path = 'dir/b'")
+            .fetchone(), (u"0" * 32,)
+        )
+        conn.close()
+
+    def test_ensure_schema_upgrades_files_table(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute(db._FILES_TABLE)
+        db.ensure_schema(conn)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+        self.assertEqual(columns[-1], "checksum")
+        tables = set(row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ))
+        self.assertTrue(set(["files", "checksums"]) <= tables)
+        conn.close()
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        create_db(self.db, [("epn{}".format(i), i, i) for i in range(500)])
+        self.conn = sqlite3.connect(self.db)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp)
+
+    def plan(self, query, params=()):
+        return [row[-1] for row in self.conn.execute(
+            'EXPLAIN QUERY PLAN ' + query, params
+        )]
+
+    def test_migrations_are_versioned(self):
+        self.assertEqual(db.schema_version(self.conn), 0)
+        db.ensure_schema(self.conn)
+        self.assertEqual(db.schema_version(self.conn), db.SCHEMA_VERSION)
+        indexes = set(row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ))
+        self.assertTrue(set(["epns_epn", "epns_pending_modified",
+                             "epns_pending_size"]) <= indexes)
+        self.assertGreater(self.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_stat1 WHERE tbl = 'epns'"
+        ).fetchone()[0], 0)
+
+        # migrations that already ran are not run again
+        self.conn.execute('DROP INDEX epns_epn')
+        db.ensure_schema(self.conn)
+        self.assertEqual(self.conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'epns_epn'"
+        ).fetchone()[0], 0)
+
+    def test_timestamps_become_datetimes(self):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE epns SET modified = 1500000000 WHERE epn = 'epn1'"
+            )
+        db.ensure_schema(self.conn)
+        self.assertEqual(self.conn.execute(
+            "SELECT modified FROM epns WHERE epn IN ('epn1', 'epn2') "
+            "ORDER BY epn"
+        ).fetchall(), [(walker_datetime(1500000000),), (walker_datetime(2),)])
+
+    def test_newer_schema_is_left_alone(self):
+        self.conn.execute('PRAGMA user_version = {}'
+                          .format(db.SCHEMA_VERSION + 1))
+        db.ensure_schema(self.conn)
+        self.assertEqual(db.schema_version(self.conn), db.SCHEMA_VERSION + 1)
+        columns = [row[1] for row in self.conn.execute(
+            'PRAGMA table_info(epns)'
+        )]
+        self.assertNotIn("claimed_by", columns)
+
+    def test_pending_queries_use_indexes(self):
+        db.ensure_schema(self.conn)
+        db.optimize(self.conn)
+        for policy, index, sorted_ in [
+                (scheduling.MODIFIED, "epns_pending_modified", True),
+                (scheduling.SMALLEST, "epns_pending_size", True),
+                (scheduling.LPT, "epns_pending_size", False),
+                (scheduling.HYBRID, "epns_pending_size", False)]:
+            query, params = asynchy._pending_query("ASC", 10, policy, 0)
+            plan = self.plan(query, params)
+            self.assertIn(
+                "SCAN epns USING COVERING INDEX {}".format(index), plan
+            )
+            if sorted_:
+                self.assertFalse([step for step in plan
+                                  if "TEMP B-TREE" in step], plan)
+
+        plan = self.plan('UPDATE epns SET complete = 1 WHERE epn = ?',
+                         ("epn1",))
+        self.assertEqual(plan, ["SEARCH epns USING INDEX epns_epn (epn=?)"])
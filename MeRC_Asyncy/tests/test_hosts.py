@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.hosts`."""
+
+import multiprocessing
+import threading
+import time
+import unittest
+
+from asynchy.hosts import HostPool
+
+
+class TestHostPool(unittest.TestCase):
+
+    def test_least_loaded(self):
+        pool = HostPool([("sftp1", 2), ("sftp2", 4)])
+        hosts = [pool.try_acquire() for _ in range(6)]
+        self.assertEqual(sorted(hosts), [0, 0, 1, 1, 1, 1])
+        # every slot is taken
+        self.assertIsNone(pool.try_acquire())
+
+        pool.release(0, True, 100, 1.0)
+        self.assertEqual(pool.try_acquire(), 0)
+
+    def test_ties_go_to_the_fastest_host(self):
+        pool = HostPool([("sftp1", 2), ("sftp2", 2)])
+        pool.release(pool.try_acquire(), True, 100, 1.0, latency=0.5)
+        pool.release(pool.try_acquire(), True, 1000, 1.0, latency=0.1)
+
+        stats = pool.stats()
+        self.assertEqual([h['throughput'] for h in stats], [100, 1000])
+        self.assertEqual([h['latency'] for h in stats], [0.5, 0.1])
+        self.assertEqual(pool.try_acquire(), 1)
+
+    def test_failing_host_leaves_rotation(self):
+        pool = HostPool([("sftp1", 4), ("sftp2", 4)], failure_threshold=2,
+                        cooldown=0.2)
+        for _ in range(2):
+            self.assertEqual(pool.try_acquire(), 0)
+            pool.release(0, False)
+
+        self.assertFalse(pool.stats()[0]['healthy'])
+        self.assertEqual([pool.try_acquire() for _ in range(4)],
+                         [1, 1, 1, 1])
+        self.assertIsNone(pool.try_acquire())
+
+        # after the cooldown, a single trial transfer
+        time.sleep(0.25)
+        self.assertEqual(pool.try_acquire(), 0)
+        self.assertIsNone(pool.try_acquire())
+        pool.release(0, True, 10, 1.0)
+        self.assertTrue(pool.stats()[0]['healthy'])
+        self.assertEqual(pool.try_acquire(), 0)
+        self.assertEqual(pool.try_acquire(), 0)
+
+    def test_cancelled_transfers_do_not_count(self):
+        pool = HostPool([("sftp1", 1)], failure_threshold=1)
+        pool.release(pool.try_acquire(), None)
+        self.assertTrue(pool.stats()[0]['healthy'])
+
+    def test_acquire_stops(self):
+        pool = HostPool([("sftp1", 1)])
+        pool.try_acquire()
+        stop = threading.Event()
+        stop.set()
+        self.assertIsNone(pool.acquire(stop, interval=0.01))
+
+    def test_shared_memory(self):
+        hosts = [("sftp1", 1), ("sftp2", 1)]
+        pool = HostPool(hosts, lock=multiprocessing.Lock(),
+                        stats=multiprocessing.RawArray('d',
+                                                       HostPool.size(hosts)))
+        self.assertEqual(sorted([pool.try_acquire(), pool.try_acquire()]),
+                         [0, 1])
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the sync loop in `asynchy.asynchy`."""
+
+import datetime
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from multiprocessing.dummy import Pool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from asynchy import asynchy
+from asynchy.control import AIMDController
+from asynchy.db import ensure_schema
+from asynchy.retry import RetryPolicy
+from asynchy.transfer import Transfer, TransferResult, TransferFailedError
+from asynchy.utils import Success, Failure
+
+
+def _fake_worker(src, dest, progress, sizes, returncode=None, delay=0):
+    time.sleep(delay)
+    size = sizes[os.path.basename(src)]
+    if size < 0 or returncode is not None:
+        return Failure(TransferFailedError("Failed: {}".format(src),
+                                           returncode))
+    progress.put(size)
+    return Success(TransferResult(src, dest, size))
+
+
+class FakeTransfer(Transfer):
+    """In-process transfer that "copies" EPNs of known sizes. EPNs in
+    `failures` fail with each of their exit codes in turn first."""
+
+    def __init__(self, sizes, processes=2, failures=None, delay=0):
+        self.sizes = sizes
+        self.delay = delay
+        self.failures = failures or {}
+        self.attempts = {}
+        self.pool = Pool(processes=processes)
+        self._progress = queue.Queue()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.max_outstanding = 0
+        self.closed = False
+
+    def transfer(self, src, dest, callback, size=None, file_count=None,
+                 arrived=None):
+        with self.lock:
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding,
+                                       self.outstanding)
+            epn = os.path.basename(src)
+            self.attempts[epn] = self.attempts.get(epn, 0) + 1
+            codes = self.failures.get(epn)
+            returncode = codes.pop(0) if codes else None
+
+        def done(result):
+            with self.lock:
+                self.outstanding -= 1
+            callback(result)
+
+        return self.pool.apply_async(
+            _fake_worker,
+            (src, dest, self._progress, self.sizes, returncode,
+             self.delay),
+            callback=done
+        )
+
+    def transfer_batch(self, srcs, dest, callback):
+        raise NotImplementedError()
+
+    def cancel(self):
+        self.pool.close()
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def progress(self):
+        return self._progress
+
+
+def walker_datetime(timestamp):
+    """The UNIX `timestamp` as AS-Walker stores modification times"""
+    return str(datetime.datetime.fromtimestamp(timestamp))
+
+
+def create_db(path, rows):
+    """Create an AS-Walker EPN database with (epn, size, modified) rows,
+    `modified` a UNIX timestamp that is stored as AS-Walker does"""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            '''CREATE TABLE epns (
+                   epn TEXT,
+                   size INTEGER,
+                   path TEXT,
+                   modified DATETIME,
+                   complete INTEGER DEFAULT 0,
+                   bytesTransferred INTEGER DEFAULT 0
+               )'''
+        )
+        conn.executemany(
+            'INSERT INTO epns (epn, size, modified) VALUES (?, ?, ?)',
+            [(epn, size, walker_datetime(modified))
+             for epn, size, modified in rows]
+        )
+    conn.close()
+
+
+def _run_node(db, dest, sizes, worker, results):
+    """Run main as one of several processes sharing `db`"""
+    transfer = FakeTransfer(sizes, delay=0.01)
+    asynchy.main(transfer, db, dest, "/data", window=2, worker=worker)
+    results.put(transfer.attempts)
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        self.rows = [("epn{}".format(i), 10 * (i + 1), i) for i in range(20)]
+        create_db(self.db, self.rows)
+        self.sizes = dict((epn, size) for epn, size, _ in self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def completed(self):
+        conn = sqlite3.connect(self.db)
+        rows = conn.execute(
+            'SELECT epn, bytesTransferred FROM epns WHERE complete = 1'
+        ).fetchall()
+        conn.close()
+        return dict(rows)
+
+    def test_main_completes_all(self):
+        transfer = FakeTransfer(self.sizes)
+        result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                              limit=None)
+
+        self.assertEqual(result, (len(self.rows), 0))
+        self.assertEqual(self.completed(), self.sizes)
+        # e.g. SSH masters are stopped after a run that was not cancelled
+        self.assertTrue(transfer.closed)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM epns WHERE started IS NULL').fetchone(),
+            (0,))
+        conn.close()
+
+    def test_main_leaves_wal_mode(self):
+        # an earlier run left the database in WAL mode
+        conn = sqlite3.connect(self.db)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+
+        asynchy.main(FakeTransfer(self.sizes), self.db, self.tmp, "/data",
+                     limit=None, wal=False)
+
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete'
+        )
+        conn.close()
+
+    def test_main_bounds_in_flight_transfers(self):
+        transfer = FakeTransfer(self.sizes, processes=4)
+        asynchy.main(transfer, self.db, self.tmp, "/data", limit=None,
+                     window=3)
+
+        self.assertEqual(len(self.completed()), len(self.rows))
+        self.assertLessEqual(transfer.max_outstanding, 3)
+
+    def test_get_epns(self):
+        epns, size = asynchy.get_epns(self.db, "DESC", limit=5)
+        self.assertEqual(size, sum(s for _, s, _ in self.rows[-5:]))
+        self.assertEqual([row[0] for row in epns],
+                         ["epn{}".format(i) for i in range(19, 14, -1)])
+
+    def test_pending_totals(self):
+        pending = asynchy._Pending(self.db, "node", 2, "DESC", 5,
+                                   asynchy.scheduling.MODIFIED)
+        self.assertEqual((pending.size, pending.count),
+                         (sum(s for _, s, _ in self.rows[-5:]), 5))
+        pending.close()
+
+        pending = asynchy._Pending(self.db, "node", 2, "DESC", None,
+                                   asynchy.scheduling.MODIFIED)
+        self.assertEqual((pending.size, pending.count),
+                         (sum(self.sizes.values()), len(self.rows)))
+        pending.close()
+
+    def test_get_epns_resumes_interrupted_first(self):
+        conn = sqlite3.connect(self.db)
+        ensure_schema(conn)
+        with conn:
+            conn.execute("UPDATE epns SET started = 1 "
+                         "WHERE epn IN ('epn7', 'epn12')")
+        conn.close()
+
+        epns, _ = asynchy.get_epns(self.db, "DESC", limit=4)
+        self.assertEqual([row[0] for row in epns],
+                         ["epn12", "epn7", "epn19", "epn18"])
+
+    def test_claim_epns(self):
+        conn = sqlite3.connect(self.db, isolation_level=None)
+        ensure_schema(conn)
+        first = asynchy.claim_epns(conn, "a", 5, lease=0.2)
+        second = asynchy.claim_epns(conn, "b", 5, lease=60)
+        self.assertEqual([row[0] for row in first],
+                         ["epn{}".format(i) for i in range(5)])
+        self.assertEqual([row[0] for row in second],
+                         ["epn{}".format(i) for i in range(5, 10)])
+
+        # claimed EPNs are not pending for anyone else...
+        epns, _ = asynchy.get_epns(self.db)
+        self.assertEqual(len(list(epns)), len(self.rows) - 10)
+
+        # ...until their lease expires
+        time.sleep(0.25)
+        third = asynchy.claim_epns(conn, "c", 5, lease=60)
+        self.assertEqual(third, first)
+        conn.close()
+
+    def test_main_processes_share_database(self):
+        results = multiprocessing.Queue()
+        nodes = [multiprocessing.Process(
+            target=_run_node,
+            args=(self.db, self.tmp, self.sizes, "node{}".format(i), results)
+        ) for i in range(3)]
+        for node in nodes:
+            node.start()
+        attempts = [results.get(timeout=30) for _ in nodes]
+        for node in nodes:
+            node.join()
+
+        # every EPN transferred by exactly one of the nodes
+        transferred = [epn for node in attempts for epn in node]
+        self.assertEqual(sorted(transferred), sorted(self.sizes))
+        self.assertEqual(self.completed(), self.sizes)
+
+    def test_main_failures_are_not_marked_complete(self):
+        self.sizes["epn3"] = -1
+        transfer = FakeTransfer(self.sizes)
+        result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                              limit=None)
+
+        self.assertEqual(result, (len(self.rows) - 1, 1))
+        completed = self.completed()
+        self.assertNotIn("epn3", completed)
+        self.assertEqual(len(completed), len(self.rows) - 1)
+
+        # its claim is released for others to retry
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM epns WHERE claimed_by IS NOT NULL '
+            'AND complete = 0').fetchone(), (0,))
+        conn.close()
+
+    def test_main_window_follows_controller(self):
+        controller = AIMDController(1, 2, interval=60)
+        transfer = FakeTransfer(self.sizes, processes=4)
+        asynchy.main(transfer, self.db, self.tmp, "/data", limit=None,
+                     window=4, controller=controller)
+
+        self.assertEqual(len(self.completed()), len(self.rows))
+        self.assertLessEqual(transfer.max_outstanding, 1)
+
+    def failures(self):
+        conn = sqlite3.connect(self.db)
+        rows = conn.execute(
+            '''SELECT epn, complete, attempts, next_attempt IS NOT NULL
+               FROM epns WHERE attempts > 0'''
+        ).fetchall()
+        conn.close()
+        return dict((row[0], list(row[1:])) for row in rows)
+
+    def test_main_retries_transient_failures(self):
+        transfer = FakeTransfer(self.sizes, failures={"epn3": [255, 12],
+                                                      "epn5": [23]})
+        result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                              limit=None,
+                              retry_policy=RetryPolicy(3, base_delay=0.01))
+
+        self.assertEqual(result, (len(self.rows), 0))
+        self.assertEqual(self.completed(), self.sizes)
+        self.assertEqual(transfer.attempts["epn3"], 3)
+        self.assertEqual(transfer.attempts["epn5"], 2)
+        self.assertEqual(self.failures()["epn3"], [1, 2, True])
+
+    def test_main_gives_up_on_permanent_failures(self):
+        transfer = FakeTransfer(self.sizes, failures={"epn3": [3],
+                                                      "epn4": [30, 30]})
+        result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                              limit=None,
+                              retry_policy=RetryPolicy(2, base_delay=0.01))
+
+        self.assertEqual(result, (len(self.rows) - 2, 2))
+        self.assertEqual(transfer.attempts["epn3"], 1)
+        failures = self.failures()
+        # permanent: out of the queue for good
+        self.assertEqual(failures["epn3"], [-1, 1, False])
+        # transient: left for a later run once its backoff has passed
+        self.assertEqual(failures["epn4"], [0, 2, True])
+
+        # only epn4 is pending again, its (short) backoff having passed
+        epns, _ = asynchy.get_epns(self.db)
+        self.assertEqual([row[0] for row in epns], ["epn4"])
+
+    def test_main_keeps_partial_failures_pending(self):
+        transfer = FakeTransfer(self.sizes, failures={"epn5": [23, 24]})
+        result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                              limit=None,
+                              retry_policy=RetryPolicy(2, base_delay=0.01))
+
+        self.assertEqual(result, (len(self.rows) - 1, 1))
+        self.assertEqual(transfer.attempts["epn5"], 2)
+        # out of attempts, but claimable again once its backoff has passed
+        self.assertEqual(self.failures()["epn5"], [0, 2, True])
+        time.sleep(0.05)
+        epns, _ = asynchy.get_epns(self.db)
+        self.assertEqual([row[0] for row in epns], ["epn5"])
+
+    def test_main_follows_database_until_sigterm(self):
+        def add_and_stop():
+            time.sleep(0.2)
+            conn = sqlite3.connect(self.db)
+            with conn:
+                conn.execute('INSERT INTO epns (epn, size, modified) '
+                             'VALUES (?, ?, ?)',
+                             ("late", 5, walker_datetime(100)))
+            conn.close()
+            time.sleep(0.5)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        self.sizes["late"] = 5
+        transfer = FakeTransfer(self.sizes)
+        handlers = (signal.getsignal(signal.SIGINT),
+                    signal.getsignal(signal.SIGTERM))
+        stopper = threading.Thread(target=add_and_stop)
+        stopper.start()
+        try:
+            result = asynchy.main(transfer, self.db, self.tmp, "/data",
+                                  poll_interval=0.05, report_interval=0.1)
+        finally:
+            stopper.join()
+            signal.signal(signal.SIGINT, handlers[0])
+            signal.signal(signal.SIGTERM, handlers[1])
+
+        # every EPN transferred exactly once, including the one added late
+        self.assertEqual(result, (len(self.rows) + 1, 0))
+        self.assertEqual(self.completed(), self.sizes)
+        self.assertEqual(set(transfer.attempts.values()), {1})
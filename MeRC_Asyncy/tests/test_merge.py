@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.merge`."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from asynchy import merge
+from tests.test_main import create_db
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        create_db(self.db, [("epn1", 10, 100), ("epn2", 10, 100)])
+        conn = sqlite3.connect(self.db)
+        with conn:
+            conn.execute("UPDATE epns SET complete = 1, "
+                         "bytesTransferred = 10 WHERE epn = 'epn1'")
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _source(self, name, rows):
+        path = os.path.join(self.tmp, name)
+        create_db(path, rows)
+        return path
+
+    def _rows(self):
+        conn = sqlite3.connect(self.db)
+        try:
+            return conn.execute(
+                "SELECT epn, size, "
+                "CAST(strftime('%s', modified, 'utc') AS INTEGER), "
+                "complete, bytesTransferred FROM epns ORDER BY epn"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def test_merge_newest(self):
+        sources = [
+            self._source("a.db", [("epn1", 20, 200), ("epn2", 5, 50),
+                                  ("epn3", 1, 100)]),
+            self._source("b.db", [("epn3", 2, 90), ("epn4", 1, 100),
+                                  ("epn4", 3, 100)]),
+        ]
+
+        counts = merge.merge(self.db, sources)
+
+        self.assertEqual(counts, [merge.MergeCount(sources[0], 3, 1, 1),
+                                  merge.MergeCount(sources[1], 3, 1, 1)])
+        self.assertEqual(self._rows(), [
+            ("epn1", 20, 200, 1, 10),
+            ("epn2", 10, 100, 0, 0),
+            ("epn3", 1, 100, 0, 0),
+            ("epn4", 3, 100, 0, 0),
+        ])
+
+    def test_merge_largest(self):
+        source = self._source("a.db", [("epn1", 5, 200), ("epn2", 20, 50)])
+
+        merge.merge(self.db, [source], prefer=merge.LARGEST)
+
+        self.assertEqual([row[:3] for row in self._rows()],
+                         [("epn1", 10, 100), ("epn2", 20, 50)])
+
+    def test_merge_walker_into_walked(self):
+        # earlier versions of `asynchy walk` stored UNIX timestamps
+        walked = self._source("walked.db", [("epn3", 1, 300)])
+        for path in (self.db, walked):
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.execute("UPDATE epns SET modified = "
+                             "strftime('%s', modified, 'utc')")
+            conn.close()
+        walker = self._source("walker.db", [("epn1", 20, 200),
+                                            ("epn2", 20, 50),
+                                            ("epn3", 2, 200)])
+
+        merge.merge(self.db, [walked, walker])
+
+        self.assertEqual([row[:3] for row in self._rows()],
+                         [("epn1", 20, 200), ("epn2", 10, 100),
+                          ("epn3", 1, 300)])
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute(
+            "SELECT DISTINCT typeof(modified) FROM epns"
+        ).fetchall(), [("text",)])
+        conn.close()
+
+    def test_merge_more_sources_than_can_be_attached(self):
+        sources = [self._source("{}.db".format(i),
+                                [("epn{}".format(i), i, i)])
+                   for i in range(merge.MAX_ATTACHED + 2)]
+
+        counts = merge.merge(self.db, sources)
+
+        self.assertEqual(sum(c.inserted for c in counts),
+                         merge.MAX_ATTACHED)
+        self.assertEqual(len(self._rows()), merge.MAX_ATTACHED + 2)
+
+    def test_merge_errors(self):
+        self.assertRaises(merge.MergeError, merge.merge, self.db,
+                          [os.path.join(self.tmp, "missing.db")])
+
+        conn = sqlite3.connect(self.db)
+        with conn:
+            conn.execute("INSERT INTO epns (epn) VALUES ('epn1')")
+        conn.close()
+        self.assertRaises(merge.MergeError, merge.merge, self.db,
+                          [self._source("a.db", [])])
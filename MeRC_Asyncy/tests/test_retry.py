@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.retry`."""
+
+import pickle
+import unittest
+
+from asynchy import retry
+from asynchy.transfer import TransferFailedError
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_classify(self):
+        for rc, kind in ((255, retry.TRANSIENT), (12, retry.TRANSIENT),
+                         (30, retry.TRANSIENT), (None, retry.TRANSIENT),
+                         (-9, retry.TRANSIENT), (11, retry.TRANSIENT),
+                         (23, retry.PARTIAL),
+                         (24, retry.PARTIAL), (3, retry.PERMANENT),
+                         (2, retry.PERMANENT)):
+            exc = TransferFailedError("failed", rc)
+            self.assertEqual(retry.classify(exc), kind, rc)
+        self.assertEqual(retry.classify(OSError()), retry.TRANSIENT)
+        # e.g. tar's exit code 1, files changed as they were read
+        self.assertEqual(
+            retry.classify(TransferFailedError("failed", 1, retry.PARTIAL)),
+            retry.PARTIAL
+        )
+
+    def test_returncode_survives_pickling(self):
+        exc = pickle.loads(pickle.dumps(
+            TransferFailedError("failed", 23, retry.PARTIAL)
+        ))
+        self.assertEqual((str(exc), exc.returncode, exc.kind),
+                         ("failed", 23, retry.PARTIAL))
+
+    def test_backoff_grows_with_jitter(self):
+        policy = retry.RetryPolicy(5, base_delay=10, max_delay=60)
+        for attempts, delay in ((1, 10), (2, 20), (3, 40), (4, 60), (9, 60)):
+            for _ in range(20):
+                backoff = policy.backoff(attempts)
+                self.assertGreaterEqual(backoff, delay / 2.0)
+                self.assertLessEqual(backoff, delay)
+
+    def test_decide(self):
+        policy = retry.RetryPolicy(3, base_delay=1)
+
+        kind, delay, again = policy.decide(TransferFailedError("", 255), 1)
+        self.assertEqual((kind, again), (retry.TRANSIENT, True))
+        self.assertIsNotNone(delay)
+
+        # out of attempts in this run, but not given up on
+        kind, delay, again = policy.decide(TransferFailedError("", 255), 3)
+        self.assertFalse(again)
+        self.assertIsNotNone(delay)
+
+        _, delay, again = policy.decide(TransferFailedError("", 23), 2)
+        self.assertTrue(again)
+        # partial: never given up on, e.g. an EPN still being written
+        _, delay, again = policy.decide(TransferFailedError("", 23), 3)
+        self.assertFalse(again)
+        self.assertIsNotNone(delay)
+
+        kind, delay, again = policy.decide(TransferFailedError("", 1), 1)
+        self.assertEqual((kind, delay, again), (retry.PERMANENT, None, False))
+
+    def test_retry_queue(self):
+        retries = retry.RetryQueue()
+        self.assertIsNone(retries.time_to_next())
+        retries.push(20, "b")
+        retries.push(10, "a")
+
+        self.assertEqual(len(retries), 2)
+        self.assertEqual(retries.time_to_next(now=5), 5)
+        self.assertIsNone(retries.pop_ready(now=5))
+        self.assertEqual(retries.pop_ready(now=25), "a")
+        self.assertEqual(retries.pop_ready(now=25), "b")
+        self.assertFalse(retries)
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import multiprocessing
+import multiprocessing.dummy
 import os
 import shutil
+import subprocess
 import tempfile
 import threading
+import time
 import unittest
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from asynchy import rsync
 
 
@@ -44,6 +54,311 @@ class TestRsync(unittest.TestCase):
         line2 = b'510033        \n'
         self.assertEqual(rsync._parse_byte_number(line2), 510033)
 
+    def test_parse_progress_line(self):
+        line = b'   510,033  48%    6.49MB/s    0:00:01'
+        self.assertEqual(rsync._parse_progress_line(line), 510033)
+        self.assertRaises(rsync.RSyncOutputParseError,
+                          rsync._parse_progress_line, b'510033        ')
+
+    def test_parse_file_line(self):
+        length, mtime, name, digest = rsync._parse_file_line(
+            b'1024 2018/06/14-10:00:00 a dir/a file'
+        )
+        self.assertEqual((length, name, digest),
+                         (1024, b'a dir/a file', None))
+        self.assertEqual(time.localtime(mtime)[:6], (2018, 6, 14, 10, 0, 0))
+        self.assertRaises(rsync.RSyncOutputParseError,
+                          rsync._parse_file_line,
+                          b'   510,033  48%    6.49MB/s    0:00:01')
+
+    def test_parse_file_line_checksum(self):
+        digest = b'd41d8cd98f00b204e9800998ecf8427e'
+        self.assertEqual(
+            rsync._parse_file_line(
+                b'0 2018/06/14-10:00:00 ' + digest + b' dir/a file', True
+            )[2:],
+            (b'dir/a file', digest.decode("ascii"))
+        )
+        self.assertEqual(
+            rsync._parse_file_line(
+                b'4096 2018/06/14-10:00:00 ' + b' ' * 32 + b' dir/', True
+            )[2:],
+            (b'dir/', None)
+        )
+        self.assertRaises(rsync.RSyncOutputParseError,
+                          rsync._parse_file_line,
+                          b'0 2018/06/14-10:00:00 dir/a file', True)
+
+    def test_line_splitter(self):
+        splitter = rsync._LineSplitter()
+        self.assertEqual(splitter.feed(b'1024      \n     10  1%'),
+                         [b'1024      '])
+        self.assertEqual(splitter.feed(b'\r   1,024 100%\r\ntail'),
+                         [b'     10  1%', b'   1,024 100%'])
+        self.assertEqual(splitter.close(), [b'tail'])
+
+    def test_status_updater_counts_in_flight_bytes(self):
+        progress = queue.Queue()
+        status = rsync._StatusUpdater(progress, interval=0, prefix=b'epn/')
+        lines = [b'4096 2018/06/14-10:00:00 epn/',
+                 b'1048576 2018/06/14-10:00:00 epn/data.h5',
+                 b'    32,768   3%    0.00kB/s    0:00:00',
+                 b'   524,288  50%   10.00MB/s    0:00:00']
+        for line in lines:
+            status(line)
+
+        # the directory is settled, the file counted as far as it has got
+        self.assertEqual(status.bytes_transferred.value, 4096 + 524288)
+
+        status(b' 1,048,576 100%   10.00MB/s    0:00:00 (xfr#1, to-chk=0/2)')
+        status.flush()
+        self.assertEqual(status.bytes_transferred.value, 4096 + 1048576)
+        posted = 0
+        while not progress.empty():
+            posted += progress.get()
+        self.assertEqual(posted, 4096 + 1048576)
+        self.assertEqual([f[:2] for f in status.files],
+                         [(u'data.h5', 1048576)])
+
+    def test_status_updater_leaves_unfinished_file_out_of_manifest(self):
+        status = rsync._StatusUpdater(interval=0)
+        status(b'10 2018/06/14-10:00:00 a')
+        status(b'20 2018/06/14-10:00:00 b')
+        status(b'         5  25%    0.00kB/s    0:00:00')
+        status.flush(complete=False)
+        self.assertEqual([f[0] for f in status.files], [u'a'])
+
+    def test_status_updater_checksum_logs_after_transfer(self):
+        status = rsync._StatusUpdater(interval=0, prefix=b'epn/',
+                                      checksum=True)
+        digest = b'd41d8cd98f00b204e9800998ecf8427e'
+        lines = [b'4096 2018/06/14-10:00:00 ' + b' ' * 32 + b' epn/',
+                 b'epn/a',
+                 b'       512  50%    0.00kB/s    0:00:00',
+                 # the directory is logged while a is in flight
+                 b'4096 2018/06/14-10:00:00 ' + b' ' * 32 + b' epn/sub/',
+                 b'     1,024 100%    0.00kB/s    0:00:00 (xfr#1)',
+                 b'1024 2018/06/14-10:00:00 ' + digest + b' epn/a',
+                 b'epn/b',
+                 b'        10  50%    0.00kB/s    0:00:00']
+        for line in lines:
+            status(line)
+
+        self.assertEqual(status.bytes_transferred.value, 4096 * 2 + 1024 + 10)
+        status(b'        20 100%    0.00kB/s    0:00:00 (xfr#2)')
+        status(b'20 2018/06/14-10:00:00 ' + digest + b' epn/b')
+        status(b'epn/c')
+        status(b'         5  25%    0.00kB/s    0:00:00')
+        status.flush(complete=False)
+
+        self.assertEqual(status.bytes_transferred.value,
+                         4096 * 2 + 1024 + 20 + 5)
+        self.assertEqual([f[:2] + f[3:] for f in status.files],
+                         [(u'a', 1024, digest.decode("ascii")),
+                          (u'b', 20, digest.decode("ascii"))])
+
+    def test_status_updater_rate_limits_posts(self):
+        progress = queue.Queue()
+        status = rsync._StatusUpdater(progress, interval=60)
+        status(b'1048576 2018/06/14-10:00:00 data.h5')
+        for done in range(1, 101):
+            status(b' %d %d%%' % (done * 10485, done))
+        # the first bytes are posted straight away, the rest held back
+        self.assertEqual(progress.get_nowait(), 10485)
+        self.assertTrue(progress.empty())
+        status.flush()
+        self.assertEqual(progress.get(), 1048576 - 10485)
+
     def test_rsync_dirs(self):
         t = rsync._transfer_worker(self.src, self.dest, self.rcv)
         self.assertEqual(t.get_or_raise()[2], 96 + len(self.text))
+
+    def test_rsync_command_bwlimit(self):
+        cmd = rsync._rsync_command("/src", "/dest", bwlimit=512)
+        self.assertIn("--bwlimit=512 ", cmd)
+        self.assertNotIn("--bwlimit", rsync._rsync_command("/src", "/dest"))
+
+    def test_rsync_command_partial(self):
+        self.assertIn("--partial-dir=.rsync-partial ",
+                      rsync._rsync_command("/src", "/dest"))
+        cmd = rsync._rsync_command("/src", "/dest", partial=True)
+        self.assertIn("--partial ", cmd)
+        self.assertNotIn("--partial-dir", cmd)
+        self.assertNotIn("--partial",
+                         rsync._rsync_command("/src", "/dest", partial=False))
+
+    def test_cancel_terminates_rsync_itself(self):
+        # rsync only keeps its partial file if it gets the signal, not the
+        # shell that started it
+        marker = os.path.join(self.dest, "terminated")
+        cmd = ("python -c 'import signal, sys, time; "
+               "signal.signal(signal.SIGTERM, lambda *_: "
+               "open(sys.argv[1], \"w\").close() or sys.exit(20)); "
+               "time.sleep(30)' " + marker)
+        timer = threading.Timer(0.5, self.rcv.set)
+        timer.start()
+        result = rsync._rsync(cmd, self.src, self.rcv, lambda line: None)
+
+        self.assertRaises(rsync.TransferCancelledError, result.get_or_raise)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_wait_for_exit(self):
+        proc = subprocess.Popen(["sleep", "0.1"])
+        self.assertTrue(rsync._wait_for_exit(proc, self.rcv))
+        self.assertEqual(proc.returncode, 0)
+
+    def test_wait_for_exit_cancelled(self):
+        proc = subprocess.Popen(["sleep", "30"])
+        timer = threading.Timer(0.2, self.rcv.set)
+        timer.start()
+
+        start, cpu = time.time(), time.process_time()
+        self.assertFalse(rsync._wait_for_exit(proc, self.rcv))
+        # cancellation is noticed within a second and without spinning
+        self.assertLess(time.time() - start, 1.0)
+        self.assertLess(time.process_time() - cpu, 0.1)
+
+        proc.kill()
+        proc.wait()
+
+    def test_parse_list_line(self):
+        kind, size, mtime, name = rsync._parse_list_line(
+            b'-rw-r--r--      1,024 2018/06/14 10:00:00 a dir/a file\n'
+        )
+        self.assertEqual((kind, size, name), (b'-', 1024, b'a dir/a file'))
+        self.assertEqual(time.localtime(mtime)[:6], (2018, 6, 14, 10, 0, 0))
+
+        kind, _, _, name = rsync._parse_list_line(
+            b'lrwxrwxrwx          4 2018/06/14 10:00:00 link -> target\n'
+        )
+        self.assertEqual((kind, name), (b'l', b'link'))
+
+        self.assertRaises(rsync.RSyncOutputParseError,
+                          rsync._parse_list_line,
+                          b'receiving incremental file list\n')
+
+    def test_shard(self):
+        entries = [(b'd', 4096, 0, b'sub'),
+                   (b'-', 100, 0, b'sub/big'),
+                   (b'-', 60, 0, b'a'),
+                   (b'-', 50, 0, b'b')]
+        shards = rsync._shard(entries, 2)
+
+        self.assertEqual(shards, [[b'sub', b'sub/big'], [b'a', b'b']])
+        self.assertEqual(len(rsync._shard(entries[:2], 4)), 1)
+
+    def test_rsync_manifest(self):
+        result = rsync._transfer_worker(self.src, self.dest, self.rcv)
+        files = result.get_or_raise().files
+        self.assertEqual([f[:2] for f in files],
+                         [(os.path.basename(self.path), len(self.text))])
+        self.assertIsNone(files[0][3])
+
+    def test_rsync_manifest_checksum(self):
+        other = os.path.join(self.src, "other")
+        with open(other, "wb") as f:
+            f.write(self.text * 3)
+
+        result = rsync._transfer_worker(self.src, self.dest, self.rcv,
+                                        checksum=True).get_or_raise()
+        self.assertEqual(sorted((f[0], f[1], f[3]) for f in result.files),
+                         sorted([(os.path.basename(self.path),
+                                  len(self.text),
+                                  hashlib.md5(self.text).hexdigest()),
+                                 ("other", len(self.text) * 3,
+                                  hashlib.md5(self.text * 3).hexdigest())]))
+        self.assertEqual(result.bytes_transferred,
+                         os.lstat(self.src).st_size + len(self.text) * 4)
+
+    def test_rsync_resumes_missing_files(self):
+        with open(os.path.join(self.src, "missing"), "wb") as f:
+            f.write(self.text)
+
+        arrived = {os.path.basename(self.path):
+                   (len(self.text), int(os.stat(self.path).st_mtime))}
+        result = rsync._transfer_worker(self.src, self.dest, self.rcv,
+                                        arrived=arrived)
+
+        self.assertEqual([f[0] for f in result.get_or_raise().files],
+                         ["missing"])
+        copy = os.path.join(self.dest, os.path.basename(self.src))
+        self.assertEqual(os.listdir(copy), ["missing"])
+
+    def test_rsync_resumes_rewritten_files(self):
+        # rewritten since it arrived, keeping its size
+        os.utime(self.path, (1500000000, 1500000000))
+        arrived = {os.path.basename(self.path):
+                   (len(self.text), 1500000000 - 60)}
+        result = rsync._transfer_worker(self.src, self.dest, self.rcv,
+                                        arrived=arrived)
+
+        self.assertEqual([f[:3] for f in result.get_or_raise().files],
+                         [(os.path.basename(self.path), len(self.text),
+                           1500000000)])
+
+    def test_rsync_sharded(self):
+        sub = os.path.join(self.src, "sub")
+        os.mkdir(sub)
+        for i in range(5):
+            with open(os.path.join(sub, "f{}".format(i)), "wb") as f:
+                f.write(self.text * (i + 1))
+
+        t = rsync._transfer_worker(self.src, self.dest, self.rcv, shards=3)
+        self.assertEqual(t.get_or_raise()[0], self.src)
+
+        copy = os.path.join(self.dest, os.path.basename(self.src))
+        for i in range(5):
+            with open(os.path.join(copy, "sub", "f{}".format(i)), "rb") as f:
+                self.assertEqual(f.read(), self.text * (i + 1))
+        self.assertTrue(
+            os.path.exists(os.path.join(copy, os.path.basename(self.path)))
+        )
+
+    def test_pool_workers_report_into_slots(self):
+        cancel = multiprocessing.Event()
+        slots = multiprocessing.RawArray('q', 2)
+        pool = multiprocessing.dummy.Pool(
+            processes=2, initializer=rsync._init_worker,
+            initargs=(cancel, slots, multiprocessing.Array('i', 2))
+        )
+        try:
+            results = pool.starmap(
+                rsync._pool_transfer_worker,
+                [(self.src, self.dest, {}), (self.path, self.dest, {})]
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        transferred = sum(r.get_or_raise().bytes_transferred
+                          for r in results)
+        self.assertEqual(sum(slots), transferred)
+
+        cancel.set()
+        pool = multiprocessing.dummy.Pool(
+            processes=1, initializer=rsync._init_worker,
+            initargs=(cancel, slots, multiprocessing.Array('i', 2))
+        )
+        try:
+            result = pool.apply(rsync._pool_transfer_worker,
+                                (self.src, self.dest, {}))
+        finally:
+            pool.close()
+        self.assertRaises(rsync.TransferCancelledError,
+                          result.get_or_raise)
+
+    def test_replacement_worker_takes_a_free_slot(self):
+        proc = subprocess.Popen(["true"])
+        proc.wait()
+        owners = multiprocessing.Array('i', 3)
+        # slot 0 is owned by a live worker, slot 1 by one that exited
+        owners[0] = os.getppid()
+        owners[1] = proc.pid
+
+        self.assertEqual(rsync._take_slot(owners), 1)
+        self.assertEqual(owners[1], os.getpid())
+        self.assertEqual(rsync._take_slot(owners), 2)
+        # with no free slot, a worker given the pid of one that exited takes
+        # the slot of that one
+        owners[1] = os.getppid()
+        self.assertEqual(rsync._take_slot(owners), 2)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.scheduling`."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from asynchy import asynchy, scheduling
+from tests.test_main import create_db, walker_datetime
+
+DAY = 24 * 3600
+
+
+class TestScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        self.now = 1000 * DAY
+        create_db(self.db, [
+            ("small-new", 10, self.now),
+            ("large-new", 1000, self.now - 1),
+            ("medium-old", 100, self.now - 20 * DAY),
+            ("huge-ancient", 5000, self.now - 40 * DAY),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def order(self, policy, **kwargs):
+        epns, _ = asynchy.get_epns(self.db, policy=policy, **kwargs)
+        return [row[0] for row in epns]
+
+    def test_modified(self):
+        self.assertEqual(
+            self.order(scheduling.MODIFIED, order="DESC"),
+            ["small-new", "large-new", "medium-old", "huge-ancient"]
+        )
+
+    def test_lpt(self):
+        self.assertEqual(
+            self.order(scheduling.LPT),
+            ["huge-ancient", "large-new", "medium-old", "small-new"]
+        )
+
+    def test_smallest(self):
+        self.assertEqual(
+            self.order(scheduling.SMALLEST, limit=2),
+            ["small-new", "medium-old"]
+        )
+
+    def hybrid_order(self):
+        clause, params = scheduling.order_by(scheduling.HYBRID, now=self.now)
+        db_conn = sqlite3.connect(self.db)
+        rows = db_conn.execute(
+            "SELECT epn FROM epns {}".format(clause), params
+        ).fetchall()
+        db_conn.close()
+        return [epn for epn, in rows]
+
+    def test_hybrid(self):
+        # the starved EPN goes first, then aging discounts medium-old's
+        # size (100 / (1 + 20/7) ~= 26) below large-new but not small-new
+        self.assertEqual(
+            self.hybrid_order(),
+            ["huge-ancient", "small-new", "medium-old", "large-new"]
+        )
+
+    def test_hybrid_datetimes(self):
+        # AS-Walker stores datetimes, earlier walks UNIX timestamps
+        db_conn = sqlite3.connect(self.db)
+        with db_conn:
+            db_conn.executemany(
+                "UPDATE epns SET modified = ? WHERE epn = ?",
+                [(walker_datetime(self.now), "small-new"),
+                 (self.now - 1, "large-new"),
+                 (walker_datetime(self.now - 20 * DAY), "medium-old"),
+                 (walker_datetime(self.now - 40 * DAY), "huge-ancient")]
+            )
+        db_conn.close()
+
+        self.assertEqual(
+            self.hybrid_order(),
+            ["huge-ancient", "small-new", "medium-old", "large-new"]
+        )
+
+    def test_unknown_policy(self):
+        self.assertRaises(scheduling.UnknownPolicyError,
+                          scheduling.order_by, "random")
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.ssh`."""
+
+import os
+import unittest
+
+from asynchy import rsync, ssh
+
+
+class RecordingMaster(ssh.SSHMaster):
+    """SSHMaster that records checks and starts instead of running ssh"""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingMaster, self).__init__(*args, **kwargs)
+        self.alive = False
+        self.checks = 0
+        self.starts = 0
+
+    def check(self):
+        self.checks += 1
+        return self.alive
+
+    def start(self):
+        self.starts += 1
+        self.alive = True
+        return True
+
+
+class TestSSHMaster(unittest.TestCase):
+
+    def test_options(self):
+        master = ssh.SSHMaster("sftp.test.com", "user", "/path/to/key")
+        cmd = rsync._rsync_command("/data/1", "/dest", host=master.host,
+                                   user=master.user, keypath=master.keypath,
+                                   ssh_options=master.options())
+
+        self.assertIn("ControlMaster=auto", cmd)
+        self.assertIn("ControlPath={}".format(master.control_path), cmd)
+        master.stop()
+
+    def test_check_without_master(self):
+        master = ssh.SSHMaster("sftp.test.com", "user", "/path/to/key")
+        self.assertFalse(master.check())
+        path = master.control_path
+        master.stop()
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_control_dir_created_on_first_use(self):
+        master = ssh.SSHMaster("sftp.test.com", "user", "/path/to/key")
+        self.assertIsNone(master._dir)
+        # nothing to close or remove
+        master.stop()
+
+        first = master.control_path
+        master.stop()
+        self.assertFalse(os.path.exists(os.path.dirname(first)))
+        # started again after it was stopped
+        self.assertTrue(os.path.isdir(os.path.dirname(master.control_path)))
+        master.stop()
+
+    def test_ensure_recreates_dead_master(self):
+        master = RecordingMaster("sftp.test.com", "user", "/path/to/key",
+                                 check_interval=0)
+        master.ensure()
+        master.ensure()
+        self.assertEqual((master.checks, master.starts), (2, 1))
+
+        # the master dies and is restarted on the next check
+        master.alive = False
+        master.ensure()
+        self.assertEqual((master.checks, master.starts), (3, 2))
+        master.stop()
+
+    def test_ensure_is_rate_limited(self):
+        master = RecordingMaster("sftp.test.com", "user", "/path/to/key",
+                                 check_interval=60)
+        for _ in range(10):
+            master.ensure()
+        self.assertEqual(master.checks, 1)
+        master.stop()
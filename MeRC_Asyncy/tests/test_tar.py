@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.tar`."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from asynchy import retry, tar
+from asynchy.transfer import (
+    RoutingTransfer,
+    TransferCancelledError,
+    small_files
+)
+
+
+class TestTar(unittest.TestCase):
+
+    def setUp(self):
+        self.rcv = threading.Event()
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+
+        self.files = {}
+        for d in range(3):
+            os.mkdir(os.path.join(self.src, "d{}".format(d)))
+            for f in range(50):
+                name = os.path.join("d{}".format(d), "f{}".format(f))
+                self.files[name] = os.urandom(f * 10)
+                with open(os.path.join(self.src, name), "wb") as fh:
+                    fh.write(self.files[name])
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def test_tar_transfer(self):
+        transfer = tar.TarTransfer()
+        done = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        transfer.transfer(self.src, self.dest, callback)
+        self.assertTrue(done.wait(10))
+        result = results[0].get_or_raise()
+
+        copy = os.path.join(self.dest, os.path.basename(self.src))
+        for name, data in self.files.items():
+            with open(os.path.join(copy, name), "rb") as fh:
+                self.assertEqual(fh.read(), data)
+
+        # the tar stream carries at least the file data
+        self.assertGreaterEqual(result.bytes_transferred,
+                                sum(len(d) for d in self.files.values()))
+        progress = transfer.progress()
+        posted = 0
+        while not progress.empty():
+            posted += progress.get()
+        self.assertEqual(posted, result.bytes_transferred)
+
+    def test_tar_missing_source(self):
+        result = tar._tar_worker(os.path.join(self.src, "missing"),
+                                 self.dest, self.rcv)
+        self.assertRaises(tar.TransferFailedError, result.get_or_raise)
+        self.assertEqual(retry.classify(result.failure), retry.PERMANENT)
+
+    def test_classify(self):
+        for archiving, rc, kind in ((True, 1, retry.PARTIAL),
+                                    (True, 2, retry.PERMANENT),
+                                    (True, 255, retry.TRANSIENT),
+                                    (True, -15, retry.TRANSIENT),
+                                    (False, 2, retry.TRANSIENT)):
+            self.assertEqual(tar._classify(archiving, rc), kind,
+                             (archiving, rc))
+
+    def test_tar_cancelled(self):
+        self.rcv.set()
+        result = tar._tar_worker(self.src, self.dest, self.rcv)
+        self.assertRaises(TransferCancelledError, result.get_or_raise)
+
+    def test_routing(self):
+        small, default = object(), object()
+        routing = RoutingTransfer(default, [(small_files(1024), small)])
+
+        self.assertIs(routing.route(10 * 1024 ** 2, 100000), small)
+        self.assertIs(routing.route(10 * 1024 ** 2, 10), default)
+        self.assertIs(routing.route(10 * 1024 ** 2, None), default)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.verify`."""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from asynchy import db, verify
+from tests.test_main import create_db
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        self.dest = os.path.join(self.tmp, "dest")
+        create_db(self.db, [("epn1", 0, 0), ("epn2", 0, 0)])
+
+        self.files = {u"a": b"Hello world!", u"sub/b": b"x" * 100000}
+        os.makedirs(os.path.join(self.dest, "epn1", "sub"))
+        manifest = []
+        for path, data in self.files.items():
+            with open(os.path.join(self.dest, "epn1", path), "wb") as f:
+                f.write(data)
+            manifest.append(("epn1", path, len(data), 0,
+                             hashlib.md5(data).hexdigest()))
+        manifest.append(("epn2", u"c", 1, 0, None))
+
+        conn = sqlite3.connect(self.db)
+        db.ensure_schema(conn)
+        with conn:
+            # as walked
+            conn.execute("UPDATE epns SET complete = 1, file_count = 1")
+            conn.execute("UPDATE epns SET file_count = 2 WHERE epn = 'epn1'")
+            conn.executemany(db._MANIFEST_SQL, manifest)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _verified(self):
+        conn = sqlite3.connect(self.db)
+        try:
+            return dict(conn.execute("SELECT epn, verified IS NOT NULL "
+                                     "FROM epns"))
+        finally:
+            conn.close()
+
+    def test_hash_file(self):
+        path = os.path.join(self.dest, "epn1", "sub", "b")
+        self.assertEqual(verify.hash_file(path, chunk_size=4096),
+                         hashlib.md5(self.files[u"sub/b"]).hexdigest())
+
+    def test_verify(self):
+        results = verify.verify(self.db, self.dest, processes=2)
+
+        self.assertEqual([(r.epn, r.files, r.hashed, r.missing)
+                          for r in results],
+                         [("epn1", 2, 2, []), ("epn2", 1, 0, [u"c"])])
+        self.assertEqual(results[0].mismatched, [])
+        self.assertEqual(self._verified(), {"epn1": 1, "epn2": 0})
+
+    def test_verify_incomplete_manifest(self):
+        conn = sqlite3.connect(self.db)
+        with conn:
+            # a file was up to date, so rsync did not log it
+            conn.execute("UPDATE epns SET file_count = 3 WHERE epn = 'epn1'")
+            # transferred with tar
+            conn.execute("INSERT INTO epns (epn, complete) "
+                         "VALUES ('epn3', 1)")
+        conn.close()
+
+        results = verify.verify(self.db, self.dest, ["epn1", "epn3"],
+                                processes=1)
+
+        self.assertEqual([(r.epn, r.files, r.missing, r.incomplete)
+                          for r in results],
+                         [("epn1", 2, [], True), ("epn3", 0, [], True)])
+        self.assertEqual(self._verified(),
+                         {"epn1": 0, "epn2": 0, "epn3": 0})
+
+    def test_verify_against_source(self):
+        src = os.path.join(self.tmp, "src")
+        shutil.copytree(os.path.join(self.dest, "epn1"),
+                        os.path.join(src, "epn1"))
+        # at the source but not in the manifest
+        for path in ("up-to-date", "lost"):
+            with open(os.path.join(src, "epn1", path), "wb") as f:
+                f.write(b"x")
+        shutil.copy(os.path.join(src, "epn1", "up-to-date"),
+                    os.path.join(self.dest, "epn1"))
+
+        result = verify.verify(self.db, self.dest, ["epn1"], processes=1,
+                               src_prefix=src)[0]
+
+        self.assertEqual((result.files, result.hashed, result.unchecked,
+                          result.missing, result.incomplete),
+                         (4, 2, 1, [u"lost"], False))
+        self.assertEqual(self._verified()["epn1"], 0)
+
+        os.remove(os.path.join(src, "epn1", "lost"))
+        result = verify.verify(self.db, self.dest, ["epn1"], processes=1,
+                               src_prefix=src)[0]
+        self.assertEqual((result.files, result.missing), (3, []))
+        self.assertEqual(self._verified()["epn1"], 1)
+
+        result = verify.verify(self.db, self.dest, ["epn2"], processes=1,
+                               src_prefix=src)[0]
+        self.assertTrue(result.incomplete)
+
+    def test_source_files_with_undecodable_name(self):
+        src = os.path.join(self.tmp, "src")
+        os.makedirs(src)
+        with open(os.path.join(src.encode("utf-8"), b"bad\xff"), "wb") as f:
+            f.write(b"x")
+
+        files = verify._source_files(src).get_or_raise()
+        self.assertEqual(list(files.values()), [1])
+
+    def test_verify_uses_cached_digests(self):
+        verify.verify(self.db, self.dest, ["epn1"], processes=1)
+        result = verify.verify(self.db, self.dest, ["epn1"], processes=1)[0]
+        self.assertEqual((result.hashed, result.cached), (0, 2))
+
+        # same size, new contents and modification time
+        path = os.path.join(self.dest, "epn1", "a")
+        with open(path, "wb") as f:
+            f.write(b"Hello world?")
+        os.utime(path, (0, 0))
+
+        result = verify.verify(self.db, self.dest, ["epn1"], processes=1)[0]
+        self.assertEqual((result.hashed, result.cached), (1, 1))
+        self.assertEqual(result.mismatched, [u"a"])
+
+    def test_verify_repair(self):
+        path = os.path.join(self.dest, "epn1", "sub", "b")
+        with open(path, "ab") as f:
+            f.write(b"x")
+
+        result = verify.verify(self.db, self.dest, ["epn1"], processes=1,
+                               repair=True)[0]
+
+        self.assertEqual(result.mismatched, [u"sub/b"])
+        self.assertFalse(os.path.exists(path))
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(db.read_manifest(conn, "epn1"),
+                         {u"a": (len(self.files[u"a"]), 0)})
+        self.assertEqual(conn.execute("SELECT complete FROM epns WHERE "
+                                      "epn = 'epn1'").fetchone(), (0,))
+        conn.close()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for `asynchy.walk`."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from asynchy import asynchy, db, walk
+from tests.test_main import create_db
+
+
+class TestWalk(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "epns.db")
+        self.root = os.path.join(self.tmp, "data")
+
+        os.makedirs(os.path.join(self.root, "epn1", "sub"))
+        os.makedirs(os.path.join(self.root, "epn2"))
+        self._write(os.path.join("epn1", "a"), 10, 1000000000)
+        self._write(os.path.join("epn1", "sub", "b"), 20, 1500000000)
+        # files at the top level are not EPNs
+        self._write("README", 5, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, path, size, mtime):
+        path = os.path.join(self.root, path)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (mtime, mtime))
+
+    def _rows(self):
+        conn = sqlite3.connect(self.db)
+        try:
+            return conn.execute(
+                "SELECT epn, size, path, file_count, complete FROM epns "
+                "ORDER BY epn"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def test_tally(self):
+        tally = walk._Tally()
+        for line in [b'receiving incremental file list',
+                     b'drwxr-xr-x          4,096 2019/01/01 00:00:00 .',
+                     b'-rw-r--r--      1,000,000 2018/06/14 10:00:00 a b',
+                     b'lrwxrwxrwx              1 2017/01/01 00:00:00 l -> a',
+                     b'drwxr-xr-x          4,096 2016/01/01 00:00:00 sub']:
+            tally(line)
+
+        self.assertEqual((tally.size, tally.files), (1000001, 2))
+        self.assertEqual(tally.modified, "2019-01-01 00:00:00")
+
+    def test_walked_epns_sort_with_walker_epns(self):
+        create_db(self.db, [("walker-2015", 1, 1420070400),
+                            ("walker-2018", 1, 1514764800)])
+        for path, mtime in [(os.path.join("epn1", "sub"), 1500000000),
+                            ("epn1", 1500000000), ("epn2", 1510000000)]:
+            os.utime(os.path.join(self.root, path), (mtime, mtime))
+
+        walk.walk(self.db, self.root, processes=1)
+
+        epns, _ = asynchy.get_epns(self.db)
+        self.assertEqual([row[0] for row in epns],
+                         ["walker-2015", "epn1", "epn2", "walker-2018"])
+
+    def test_list_epns(self):
+        self.assertEqual([name for name, _ in walk.list_epns(self.root)],
+                         ["epn1", "epn2"])
+
+    def test_walk(self):
+        written, changed, failed = walk.walk(self.db, self.root,
+                                             processes=2, batch_size=1)
+
+        self.assertEqual((written, changed, failed), (2, [], []))
+        self.assertEqual(self._rows(), [
+            ("epn1", 30, os.path.join(self.root, "epn1"), 2, 0),
+            ("epn2", 0, os.path.join(self.root, "epn2"), 0, 0),
+        ])
+
+    def test_walk_updates_existing_epns(self):
+        create_db(self.db, [("epn1", 1, 0)])
+        conn = sqlite3.connect(self.db)
+        with conn:
+            conn.execute("UPDATE epns SET complete = 1")
+        conn.close()
+        self._write(os.path.join("epn2", "c"), 7, 0)
+
+        walk.walk(self.db, self.root, processes=1)
+        walk.walk(self.db, self.root, processes=1)
+
+        self.assertEqual([(epn, size, count, complete)
+                          for epn, size, _, count, complete in self._rows()],
+                         [("epn1", 30, 2, 1), ("epn2", 7, 1, 0)])
+
+    def test_rewalk_only_lists_changed_epns(self):
+        epn1 = os.path.join(self.root, "epn1")
+        os.utime(epn1, (1000000000, 1000000000))
+        walk.walk(self.db, self.root, processes=1)
+        conn = sqlite3.connect(self.db)
+        with conn:
+            conn.execute("UPDATE epns SET complete = 1, started = 1")
+            conn.executemany(db._MANIFEST_SQL,
+                             [("epn1", "a", 10, 0, None),
+                              ("epn2", "gone", 1, 0, None)])
+        conn.close()
+
+        # deeper changes leave the EPN's directory alone
+        self._write(os.path.join("epn1", "sub", "c"), 5, 0)
+        self.assertEqual(walk.walk(self.db, self.root, processes=1),
+                         (0, [], []))
+
+        self._write(os.path.join("epn1", "d"), 5, 0)
+        os.utime(epn1, (1600000000, 1600000000))
+        self.assertEqual(walk.walk(self.db, self.root, processes=1),
+                         (1, ["epn1"], []))
+        self.assertEqual([row[3:] for row in self._rows()],
+                         [(4, 0), (0, 1)])
+        # transferred again from scratch
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(conn.execute(
+            "SELECT epn, started FROM epns ORDER BY epn"
+        ).fetchall(), [("epn1", None), ("epn2", 1)])
+        self.assertEqual(conn.execute("SELECT epn FROM files").fetchall(),
+                         [("epn2",)])
+        conn.close()
+
+        # unchanged contents are not queued again
+        self.assertEqual(walk.walk(self.db, self.root, processes=1,
+                                   full=True),
+                         (2, [], []))